@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Microbenchmarks for walking the snapshot tree of a VM.
+
+Compares the old traversal (``list.pop(0)``, and every child wrapped in a new
+list) with ``vmware._iter_snapshots`` on synthetic trees that are wide (many
+siblings) and deep (a long chain, like a VM that's snapshotted over and over).
+
+Usage::
+
+    python benchmarks/bench_snapshot_tree.py [--size 2000] [--repeat 5]
+"""
+import argparse
+import timeit
+
+from vlab_snapshot_api.lib.worker import records, vmware
+
+
+class Snap(object):
+    """Just enough of a vim.vm.SnapshotTree to walk"""
+    __slots__ = ('name', 'description', 'snapshot', 'childSnapshotList')
+
+    def __init__(self, index):
+        self.name = '{:06x}_{}_{}'.format(index, 1000 + index, 2000 + index)
+        self.description = ''
+        self.snapshot = None
+        self.childSnapshotList = []
+
+
+def wide_tree(size):
+    """One root snapshot, with ``size - 1`` children
+
+    :Returns: List
+    """
+    root = Snap(0)
+    root.childSnapshotList = [Snap(x) for x in range(1, size)]
+    return [root]
+
+
+def deep_tree(size):
+    """A chain of ``size`` snapshots, each the child of the one before it
+
+    :Returns: List
+    """
+    snaps = [Snap(x) for x in range(size)]
+    for parent, child in zip(snaps, snaps[1:]):
+        parent.childSnapshotList = [child]
+    return [snaps[0]]
+
+
+def old_get_snapshots(snap_root):
+    """The traversal before ``_iter_snapshots``, for comparison
+
+    :Returns: List
+    """
+    snapshots = []
+    branches = [snap_root]
+    while branches:
+        current = branches.pop(0)
+        for snap_object in current:
+            record = records.from_tree(snap_object)
+            if record is not None:
+                snapshots.append(record)
+            for child in snap_object.childSnapshotList:
+                branches.append([child])
+    return snapshots
+
+
+def run(size, repeat):
+    """Time every traversal against every tree shape, and print the results
+
+    :Returns: None
+    """
+    for shape, make_tree in (('wide', wide_tree), ('deep', deep_tree)):
+        tree = make_tree(size)
+        first_id = '{:06x}'.format(0)
+        cases = (('old list', lambda: old_get_snapshots(tree)),
+                 ('iter all', lambda: list(vmware._iter_snapshots(tree))),
+                 ('count', lambda: vmware._count_snapshots(tree)),
+                 ('find first', lambda: vmware._find_by_id(tree, first_id)),
+                 ('index', lambda: vmware._snapshot_index(tree)))
+        for name, func in cases:
+            best = min(timeit.repeat(func, number=10, repeat=repeat)) / 10
+            print('{:5} {:10} {:>10.1f} usec'.format(shape, name, best * 1000000))
+
+
+def main():
+    """Parse the CLI args, and run the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=2000, help='Snapshots per tree')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case; the best is reported')
+    args = parser.parse_args()
+    run(args.size, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
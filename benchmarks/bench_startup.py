@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Measures the cold start, and memory, of the API and worker processes.
+
+Imports a module in a brand new interpreter, over and over, and reports how
+long the import took, the peak RSS of the process, how many modules it
+loaded, and whether pyVmomi was one of them. Every uWSGI worker imports
+``vlab_snapshot_api.app``, so anything it pulls in is paid for once per
+worker, in both time and memory.
+
+Usage::
+
+    python benchmarks/bench_startup.py [--repeat 10] [--module vlab_snapshot_api.app ...]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ('vlab_snapshot_api.app', 'vlab_snapshot_api.lib.worker.tasks')
+# runs in the new interpreter; ru_maxrss is KiB on Linux
+PROBE = """
+import sys, time, json, resource, importlib
+started = time.perf_counter()
+importlib.import_module({module!r})
+took = time.perf_counter() - started
+print(json.dumps({{'seconds': took,
+                   'rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   'modules': len(sys.modules),
+                   'pyvmomi': 'pyVmomi' in sys.modules}}))
+"""
+
+
+def probe(module):
+    """Import a module in a new interpreter
+
+    :Returns: Dictionary
+    """
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', PROBE.format(module=module)],
+                                     cwd=ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(module, repeat):
+    """Import a module ``repeat`` times, after one untimed import to warm the
+    OS file cache
+
+    :Returns: Dictionary
+    """
+    probe(module)
+    found = [probe(module) for _ in range(repeat)]
+    return {'import_ms': round(statistics.median(x['seconds'] for x in found) * 1000, 1),
+            'rss_mib': round(statistics.median(x['rss_kib'] for x in found) / 1024, 1),
+            'modules': found[-1]['modules'],
+            'pyvmomi': found[-1]['pyvmomi']}
+
+
+def main():
+    """Parse the CLI args, and run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--module', action='append', help='A module to import; can be given many times')
+    args = parser.parse_args()
+
+    print('{:40} {:>10} {:>9} {:>8} {:>8}'.format('module', 'import ms', 'RSS MiB', 'modules', 'pyVmomi'))
+    for module in args.module or DEFAULT_MODULES:
+        result = measure(module, args.repeat)
+        print('{:40} {:>10.1f} {:>9.1f} {:>8} {:>8}'.format(module, result['import_ms'], result['rss_mib'],
+                                                           result['modules'], 'yes' if result['pyvmomi'] else 'no'))
+
+
+if __name__ == '__main__':
+    main()
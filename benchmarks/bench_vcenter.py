@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks of the snapshot operations against a simulated vCenter.
+
+Runs ``show_snapshot``, ``create_snapshot``, ``apply_snapshot``,
+``delete_snapshot`` and ``reap_snapshots`` unchanged against the fake vCenter
+in ``tests/fake_vcenter.py``. For each one it reports the latency, the number
+of round-trips to vCenter (by phase; see ``instrument.py``), and the peak
+memory allocated. Most cases run with vCenter tasks that finish at once; the
+``slow tasks`` case makes every task take ``SLOW_TASK_SECONDS``, so the
+round-trips spent waiting on a task are counted too.
+
+Round-trip counts are the same on every machine, so they make a good
+regression check; latency and memory depend on the machine. ``--save`` writes
+the results to ``benchmarks/baselines.json``, and ``--check`` fails when
+a case makes more round-trips than its baseline. Add ``--check-latency`` to
+also fail when a case is slower than ``--tolerance`` allows; only do that
+against baselines saved on the same machine.
+
+Usage::
+
+    python benchmarks/bench_vcenter.py [--users 1000] [--vms-per-user 10] [--snapshots 3]
+                                       [--latency 0.002] [--save | --check [--check-latency]]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fake_vcenter import Simulator
+from vlab_snapshot_api.lib.worker import instrument, reaper, session_pool, vmware
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+# less than the 1 second consume_task sleeps for, so each task costs a fixed
+# number of polls on any machine
+SLOW_TASK_SECONDS = 0.2
+
+
+def measure(func, repeat):
+    """Run a case ``repeat`` times, after one untimed run to warm the session
+    pool and the resolver cache.
+
+    :Returns: Dictionary
+    """
+    func()
+    latencies = []
+    calls = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        with instrument.recording() as recorder:
+            started = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - started)
+        calls.append(recorder.summary())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    last = calls[-1]
+    return {'p50_ms': round(statistics.median(latencies) * 1000, 3),
+            'p95_ms': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 3),
+            'calls': sum(x['calls'] for x in last.values()),
+            'calls_by_phase': {phase: stats['calls'] for phase, stats in sorted(last.items())},
+            'peak_kib': round(peak / 1024, 1)}
+
+
+def cases(sim, logger):
+    """The operations to benchmark, as (name, function, repeat) tuples
+
+    :Returns: List
+    """
+    username, machine = 'user0', 'vm0'
+
+    def create_and_delete():
+        created = vmware.create_snapshot(username, machine, True, logger)
+        vmware.delete_snapshot(username, created[machine][0]['id'], machine, logger)
+
+    def apply():
+        snap_id = vmware.show_snapshot(username)[0][machine][-1]['id']
+        vmware.apply_snapshot(username, snap_id, machine, logger)
+
+    def create_and_delete_slow():
+        sim.task_seconds = SLOW_TASK_SECONDS
+        try:
+            create_and_delete()
+        finally:
+            sim.task_seconds = 0.0
+
+    def reap():
+        vcenter = sim.connect()
+        instrument.install(vcenter)
+        reaper.reap_snapshots(vcenter, logger)
+
+    return [('show_snapshot', lambda: vmware.show_snapshot(username), 20),
+            ('create+delete', create_and_delete, 20),
+            ('create+delete slow tasks', create_and_delete_slow, 3),
+            ('show+apply', apply, 20),
+            ('reap_snapshots', reap, 3)]
+
+
+def check(results, baselines, tolerance=None):
+    """Compare results to the baselines. Latency is only compared when a
+    ``tolerance`` is given.
+
+    :Returns: List of regressions
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result['calls'] > baseline['calls']:
+            regressions.append('{}: {} round-trips, baseline is {}'.format(name, result['calls'], baseline['calls']))
+        if tolerance is not None and result['p50_ms'] > baseline['p50_ms'] * (1 + tolerance):
+            regressions.append('{}: p50 {}ms, baseline is {}ms'.format(name, result['p50_ms'], baseline['p50_ms']))
+    return regressions
+
+
+def main():
+    """Parse the CLI args, and run the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--vms-per-user', type=int, default=10)
+    parser.add_argument('--snapshots', type=int, default=3, help='Length of the snapshot chain of every VM')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every round-trip')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--check', action='store_true', help='Exit 1 if a case makes more round-trips than its baseline')
+    parser.add_argument('--check-latency', action='store_true', help='With --check, also exit 1 if a case is slower than its baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='How much slower than the baseline is OK')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    sim = Simulator.build(users=args.users, vms_per_user=args.vms_per_user,
+                          snapshots_per_vm=args.snapshots, latency=args.latency)
+    print('Built {} VMs with {} snapshots in {:.1f}s'.format(len(sim.vms), sim.snapshot_count(),
+                                                             time.perf_counter() - started))
+    session_pool.init_pool(factory=sim.connect)
+    results = {}
+    try:
+        for name, func, repeat in cases(sim, MagicMock()):
+            results[name] = measure(func, repeat)
+            result = results[name]
+            print('{:26} p50 {:>9.3f}ms  p95 {:>9.3f}ms  {:>6} round-trips {}  peak {:>9.1f}KiB'.format(
+                  name, result['p50_ms'], result['p95_ms'], result['calls'],
+                  result['calls_by_phase'], result['peak_kib']))
+    finally:
+        session_pool.close_pool()
+
+    params = {'users': args.users, 'vms_per_user': args.vms_per_user,
+              'snapshots': args.snapshots, 'latency': args.latency}
+    if args.save:
+        with open(BASELINES, 'w') as the_file:
+            json.dump({'params': params, 'results': results}, the_file, indent=2, sort_keys=True)
+            the_file.write('\n')
+        print('Saved baselines to {}'.format(BASELINES))
+    if args.check:
+        with open(BASELINES) as the_file:
+            baselines = json.load(the_file)
+        if baselines['params'] != params:
+            print('Baselines were taken with {}; rerun with the same params'.format(baselines['params']))
+            sys.exit(2)
+        regressions = check(results, baselines['results'], args.tolerance if args.check_latency else None)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+A load generator for the snapshot API.
+
+Drives GET, POST, PUT and DELETE on ``/api/1/inf/snapshot`` of the Flask
+``app`` from many threads at once, the way a single uWSGI worker would be
+driven. Requests go straight into the WSGI app (no sockets), and Celery sends
+its tasks to kombu's in-memory broker; no RabbitMQ, vCenter or worker is
+needed. ``--stub-celery`` swaps Celery for a stub whose ``send_task`` only
+makes up a task id, to see what's left of the request path without it.
+
+Besides throughput, it reports the p50 and p99 latency of every request and
+of each stage of it:
+
+- ``jwt``: decoding the auth token in ``@requires``
+- ``schema``: the JSON schema check in ``@validate_input``
+- ``send_task``: handing the task to Celery
+- ``ujson``: serializing the response body
+- ``flask``: everything else (routing, the view, building the response)
+
+Stage times are wall-clock, so with ``--concurrency`` above 1 they include
+waiting on the GIL (like a threaded uWSGI worker would). Use
+``--concurrency 1`` to see what each stage costs on its own.
+
+Usage::
+
+    python benchmarks/load_api.py [--concurrency 8] [--requests 2000]
+                                  [--methods GET,POST,PUT,DELETE] [--users 50]
+                                  [--stub-celery]
+"""
+import os
+import sys
+import time
+import uuid
+import logging
+import argparse
+import threading
+import itertools
+from collections import defaultdict
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ujson
+from celery import Celery
+from vlab_api_common import flask_common, http_auth
+from vlab_api_common.http_auth import generate_v2_test_token
+
+from vlab_snapshot_api.app import app
+from vlab_snapshot_api.lib.views import snapshot
+
+
+STAGES = ('jwt', 'schema', 'send_task', 'ujson', 'flask')
+_LOCAL = threading.local()
+
+
+def timed(stage, func):
+    """Wrap ``func`` so the time spent in it is charged to ``stage`` of the
+    request the current thread is making
+
+    :Returns: Function
+    """
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            spent = getattr(_LOCAL, 'spent', None)
+            if spent is not None:
+                spent[stage] += time.perf_counter() - started
+    return wrapper
+
+
+class TimedUjson(object):
+    """Stands in for the ``ujson`` module within ``views/snapshot.py``"""
+    dumps = staticmethod(timed('ujson', ujson.dumps))
+    loads = staticmethod(ujson.loads)
+
+
+class StubTask(object):
+    """Just enough of a celery.result.AsyncResult"""
+    __slots__ = ('id',)
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+    def ready(self):
+        return False
+
+
+class StubCelery(object):
+    """A Celery app that never sends anything"""
+    def send_task(self, name, args=None, queue=None, **kwargs):
+        return StubTask()
+
+    def AsyncResult(self, task_id):
+        return StubTask()
+
+
+def memory_celery():
+    """A Celery app that sends tasks to an in-memory broker
+
+    :Returns: celery.Celery
+    """
+    celery_app = Celery('snapshot', backend='cache+memory://', broker='memory://')
+    celery_app.conf.broker_heartbeat = 0
+    return celery_app
+
+
+def requests_for(method, username, token, snap_id):
+    """The arguments for ``FlaskClient.open`` of one request
+
+    :Returns: Dictionary
+    """
+    headers = {'X-Auth': token, 'X-REQUEST-ID': 'load-{}'.format(username)}
+    kwargs = {'method': method, 'path': '/api/1/inf/snapshot', 'headers': headers}
+    if method == 'POST':
+        kwargs['json'] = {'name': 'vm0', 'shift': True, 'mode': 'crash'}
+    elif method in ('PUT', 'DELETE'):
+        kwargs['json'] = {'name': 'vm0', 'id': snap_id}
+    return kwargs
+
+
+def percentile(values, pct):
+    """The value at a percentile of an already sorted list
+
+    :Returns: Float
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run(methods, concurrency, total, users):
+    """Make ``total`` requests from ``concurrency`` threads, cycling through
+    ``methods`` and ``users``
+
+    :Returns: Tuple (seconds, latencies, status codes); latencies are by method, then stage
+    """
+    tokens = [generate_v2_test_token(username='user{}'.format(x)) for x in range(users)]
+    plan = itertools.cycle([(methods[x % len(methods)], 'user{}'.format(x % users), tokens[x % users])
+                            for x in range(users * len(methods))])
+    plan_lock = threading.Lock()
+    remaining = [total]
+    latencies = defaultdict(lambda: defaultdict(list))
+    statuses = defaultdict(lambda: defaultdict(int))
+    results_lock = threading.Lock()
+    snap_id = '{:06x}'.format(1)
+
+    def worker():
+        client = app.test_client()
+        mine = defaultdict(lambda: defaultdict(list))
+        codes = defaultdict(lambda: defaultdict(int))
+        while True:
+            with plan_lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+                method, username, token = next(plan)
+            _LOCAL.spent = defaultdict(float)
+            started = time.perf_counter()
+            resp = client.open(**requests_for(method, username, token, snap_id))
+            took = time.perf_counter() - started
+            spent, _LOCAL.spent = _LOCAL.spent, None
+            codes[method][resp.status_code] += 1
+            mine[method]['total'].append(took)
+            for stage in STAGES[:-1]:
+                mine[method][stage].append(spent[stage])
+            mine[method]['flask'].append(max(took - sum(spent.values()), 0))
+        with results_lock:
+            for method, stages in mine.items():
+                for stage, values in stages.items():
+                    latencies[method][stage].extend(values)
+            for method, found in codes.items():
+                for code, count in found.items():
+                    statuses[method][code] += count
+
+    threads = [threading.Thread(target=worker, name='load-{}'.format(x)) for x in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies, statuses
+
+
+def report(seconds, latencies, statuses):
+    """Print the throughput, and the latency of every stage, by method
+
+    :Returns: None
+    """
+    count = sum(len(stages['total']) for stages in latencies.values())
+    print('{} requests in {:.2f}s: {:.0f} req/s'.format(count, seconds, count / seconds))
+    print('{:7} {:10} {:>9} {:>9}'.format('method', 'stage', 'p50 ms', 'p99 ms'))
+    for method in sorted(latencies):
+        stages = latencies[method]
+        codes = ', '.join('{}x{}'.format(count, code) for code, count in sorted(statuses[method].items()))
+        print('{:7} {} requests ({})'.format(method, len(stages['total']), codes))
+        for stage in ('total',) + STAGES:
+            values = sorted(stages[stage])
+            if not any(values):
+                # i.e. GET does not validate a body
+                continue
+            print('{:7} {:10} {:>9.3f} {:>9.3f}'.format('', stage, percentile(values, 50) * 1000,
+                                                       percentile(values, 99) * 1000))
+
+
+def main():
+    """Parse the CLI args, and run the load test"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--concurrency', type=int, default=8, help='How many requests are in flight at once')
+    parser.add_argument('--requests', type=int, default=2000, help='How many requests to make in total')
+    parser.add_argument('--methods', default='GET,POST,PUT,DELETE', help='The HTTP methods to cycle through')
+    parser.add_argument('--users', type=int, default=50, help='How many different users make requests')
+    parser.add_argument('--stub-celery', action='store_true', help='Replace Celery with a stub that sends nothing')
+    args = parser.parse_args()
+    methods = [x.strip().upper() for x in args.methods.split(',') if x.strip()]
+
+    # the access log of every request would drown out the report
+    flask_common.logger.setLevel(logging.WARNING)
+    celery_app = StubCelery() if args.stub_celery else memory_celery()
+    celery_app.send_task = timed('send_task', celery_app.send_task)
+    app.celery_app = celery_app
+    with patch.object(http_auth, 'decode', timed('jwt', http_auth.decode)), \
+         patch.object(flask_common, 'validate', timed('schema', flask_common.validate)), \
+         patch.object(snapshot, 'ujson', TimedUjson):
+        # warm up; the first request compiles the routes, and connects to the broker
+        run(methods, 1, len(methods), 1)
+        seconds, latencies, statuses = run(methods, args.concurrency, args.requests, args.users)
+    report(seconds, latencies, statuses)
+
+
+if __name__ == '__main__':
+    main()
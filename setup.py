@@ -15,5 +15,5 @@ setup(name="vlab-snapshot-api",
       package_files={'vlab_snapshot_api' : ['app.ini']},
       description="Snapshots for vLab machines",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery[redis]', 'gevent']
       )
@@ -0,0 +1,608 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process stand in for a vCenter server.
+
+pyVmomi sends every method call, and every lazy property read, of a managed
+object through the object's stub. ``FakeStub`` answers those calls from an
+in-memory inventory instead of sending SOAP to a server. The managed objects
+(i.e. ``vim.VirtualMachine``) and data objects (i.e. ``vim.vm.SnapshotTree``)
+are the real pyVmomi classes. So ``vmware.py`` and ``reaper.py`` run
+unchanged against it, including the PropertyCollector and SearchIndex calls
+they make.
+
+The inventory is made with ``Simulator.build``::
+
+    datacenter/vm/<users_dir>/<username>/<machine name>
+
+Every VM has a chain of vLab snapshots, each the child of the one before it.
+``latency`` is added to every round-trip, and vCenter tasks take
+``task_seconds`` to complete. ``Simulator.calls`` counts the round-trips by
+SOAP method.
+"""
+import time
+import datetime
+import itertools
+import threading
+from collections import Counter
+
+from pyVmomi import vim, vmodl
+
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import records
+
+
+PC = vmodl.query.PropertyCollector
+# the SOAP methods a vCenter task is started with -> the TaskInfo.descriptionId
+TASK_METHODS = {'CreateSnapshot_Task': 'VirtualMachine.createSnapshot',
+                'RemoveSnapshot_Task': 'vm.Snapshot.remove',
+                'RevertToSnapshot_Task': 'vm.Snapshot.revert'}
+
+
+class FakeSnap(object):
+    """A snapshot in the simulated inventory"""
+    __slots__ = ('moid', 'name', 'description', 'created', 'parent', 'children', 'memory', 'quiesced')
+
+    def __init__(self, moid, name, description, created, parent=None, memory=False, quiesced=False):
+        self.moid = moid
+        self.name = name
+        self.description = description
+        self.created = created
+        self.parent = parent
+        self.children = []
+        self.memory = memory
+        self.quiesced = quiesced
+
+
+class FakeVM(object):
+    """A virtual machine in the simulated inventory"""
+    __slots__ = ('moid', 'name', 'folder', 'host', 'datastores', 'power_state',
+                 'change_version', 'roots', 'current', 'snaps')
+
+    def __init__(self, moid, name, folder, host, datastores):
+        self.moid = moid
+        self.name = name
+        self.folder = folder
+        self.host = host
+        self.datastores = datastores
+        self.power_state = vim.VirtualMachine.PowerState.poweredOn
+        self.change_version = 0
+        self.roots = []
+        self.current = None
+        self.snaps = {} # moid -> FakeSnap
+
+
+class FakeTask(object):
+    """A vCenter task that completes ``done_at``, by calling ``effect``"""
+    __slots__ = ('moid', 'description_id', 'entity', 'queued', 'done_at', 'effect', 'error', 'done')
+
+    def __init__(self, moid, description_id, entity, queued, done_at, effect):
+        self.moid = moid
+        self.description_id = description_id
+        self.entity = entity
+        self.queued = queued
+        self.done_at = done_at
+        self.effect = effect
+        self.error = None
+        self.done = False
+
+
+class Simulator(object):
+    """The state of the simulated vCenter server, shared by every session.
+
+    :param latency: Seconds added to every round-trip
+    :type latency: Float
+
+    :param task_seconds: How long a vCenter task takes to complete
+    :type task_seconds: Float
+    """
+    def __init__(self, latency=0.0, task_seconds=0.0):
+        self.latency = latency
+        self.task_seconds = task_seconds
+        self.calls = Counter()
+        self.vms = {}
+        self.tasks = {}
+        self._owners = {} # snapshot moid -> FakeVM
+        self._folders = {} # moid -> (name, parent moid, [child moids])
+        self._children = {} # (parent moid, name) -> moid
+        self._hosts = []
+        self._datastores = []
+        self._results = {}
+        self._running = []
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._add_folder('group-d1', 'Datacenters', None)
+        self._add_folder('datacenter-1', 'datacenter', 'group-d1')
+        self._add_folder('group-v1', 'vm', None)
+        self.users_folder = self._add_folder('group-v2', const.INF_VCENTER_USERS_DIR, 'group-v1')
+
+    @classmethod
+    def build(cls, users=10, vms_per_user=5, snapshots_per_vm=3, hosts=8, datastores=4,
+              expired=0.0, latency=0.0, task_seconds=0.0):
+        """Create a simulator with a synthetic inventory
+
+        :Returns: Simulator
+
+        :param users: How many users have a lab
+        :type users: Integer
+
+        :param vms_per_user: How many VMs are in every lab
+        :type vms_per_user: Integer
+
+        :param snapshots_per_vm: The length of the snapshot chain of every VM
+        :type snapshots_per_vm: Integer
+
+        :param hosts: How many ESXi hosts the VMs are spread over
+        :type hosts: Integer
+
+        :param datastores: How many datastores the VMs are spread over
+        :type datastores: Integer
+
+        :param expired: The fraction of snapshots that have already expired
+        :type expired: Float
+
+        :param latency: Seconds added to every round-trip
+        :type latency: Float
+
+        :param task_seconds: How long a vCenter task takes to complete
+        :type task_seconds: Float
+        """
+        sim = cls(latency=latency, task_seconds=task_seconds)
+        sim._hosts = ['host-{}'.format(x) for x in range(1, hosts + 1)]
+        sim._datastores = ['datastore-{}'.format(x) for x in range(1, datastores + 1)]
+        now = int(time.time())
+        expire_every = int(1 / expired) if expired else 0
+        count = 0
+        for user in range(users):
+            folder = sim._add_folder('group-v{}'.format(100 + user), 'user{}'.format(user), sim.users_folder)
+            for index in range(vms_per_user):
+                vm = sim.add_vm(folder, 'vm{}'.format(index))
+                for _ in range(snapshots_per_vm):
+                    count += 1
+                    created = now - 60
+                    if expire_every and count % expire_every == 0:
+                        expires = now - 1
+                    else:
+                        expires = now + const.VLAB_SNAPSHOT_EXPIRES_AFTER
+                    name = records.encode_name('{:06x}'.format(count), created, expires)
+                    sim.add_snapshot(vm, name)
+        return sim
+
+    def _next_moid(self, prefix):
+        return '{}-{}'.format(prefix, next(self._ids))
+
+    def _add_folder(self, moid, name, parent):
+        self._folders[moid] = (name, parent, [])
+        if parent is not None:
+            self._folders[parent][2].append(moid)
+            self._children[(parent, name)] = moid
+        return moid
+
+    def add_vm(self, folder, name):
+        """Create a VM in a folder
+
+        :Returns: FakeVM
+        """
+        number = len(self.vms)
+        host = self._hosts[number % len(self._hosts)] if self._hosts else 'host-1'
+        datastore = self._datastores[number % len(self._datastores)] if self._datastores else 'datastore-1'
+        vm = FakeVM(self._next_moid('vm'), name, folder, host, [datastore])
+        self.vms[vm.moid] = vm
+        self._folders[folder][2].append(vm.moid)
+        self._children[(folder, name)] = vm.moid
+        return vm
+
+    def add_snapshot(self, vm, name, description='', memory=False, quiesced=False):
+        """Take a snapshot of a VM; it's a child of the VM's current snapshot
+
+        :Returns: FakeSnap
+        """
+        snap = FakeSnap(self._next_moid('snapshot'), name, description, time.time(),
+                        parent=vm.current, memory=memory, quiesced=quiesced)
+        if vm.current is None:
+            vm.roots.append(snap)
+        else:
+            vm.current.children.append(snap)
+        vm.current = snap
+        vm.snaps[snap.moid] = snap
+        self._owners[snap.moid] = vm
+        vm.change_version += 1
+        return snap
+
+    def remove_snapshot(self, vm, snap):
+        """Delete a snapshot; its children move up to its parent
+
+        :Returns: None
+        """
+        siblings = snap.parent.children if snap.parent is not None else vm.roots
+        index = siblings.index(snap)
+        for child in snap.children:
+            child.parent = snap.parent
+        siblings[index:index + 1] = snap.children
+        if vm.current is snap:
+            vm.current = snap.parent
+        del vm.snaps[snap.moid]
+        del self._owners[snap.moid]
+        vm.change_version += 1
+
+    def snapshot_count(self):
+        """How many snapshots every VM has, in total
+
+        :Returns: Integer
+        """
+        return sum(len(vm.snaps) for vm in self.vms.values())
+
+    def connect(self):
+        """Open a new session; the ``factory`` of a ``SessionPool``
+
+        :Returns: FakeVCenter
+        """
+        return FakeVCenter(self)
+
+    # Everything below is called by FakeStub
+    def settle(self):
+        """Complete every task that's due
+
+        :Returns: None
+        """
+        now = time.time()
+        with self._lock:
+            still_running = []
+            for task in self._running:
+                if task.done_at > now:
+                    still_running.append(task)
+                    continue
+                try:
+                    task.effect()
+                except Exception as doh:
+                    task.error = str(doh)
+                task.done = True
+            self._running = still_running
+
+    def start_task(self, method, entity, effect):
+        """Start a vCenter task
+
+        :Returns: String
+        """
+        now = time.time()
+        task = FakeTask(self._next_moid('task'), TASK_METHODS[method], entity, now,
+                        now + self.task_seconds, effect)
+        with self._lock:
+            self.tasks[task.moid] = task
+            self._running.append(task)
+        if not self.task_seconds:
+            self.settle()
+        return task.moid
+
+    def kind_of(self, moid):
+        """The pyVmomi type of a managed object in the inventory
+
+        :Returns: type
+        """
+        if moid in self.vms:
+            return vim.VirtualMachine
+        if moid in self.tasks:
+            return vim.Task
+        if moid.startswith('datacenter'):
+            return vim.Datacenter
+        if moid in self._folders:
+            return vim.Folder
+        if moid.startswith('host'):
+            return vim.HostSystem
+        if moid.startswith('datastore'):
+            return vim.Datastore
+        return vim.vm.Snapshot
+
+    def folder(self, moid):
+        """The name, parent and child moids of a folder
+
+        :Returns: Tuple
+        """
+        return self._folders[moid]
+
+    def child(self, parent, name):
+        """Find an object by name within a folder
+
+        :Returns: String, or None
+        """
+        if parent == 'datacenter-1':
+            # a datacenter's vmFolder
+            parent = 'group-v1'
+        return self._children.get((parent, name))
+
+    def descendants(self, moid, recursive):
+        """Every object within a folder
+
+        :Returns: List
+        """
+        found = []
+        stack = [moid]
+        while stack:
+            for child in self._folders[stack.pop()][2]:
+                found.append(child)
+                if recursive and child in self._folders:
+                    stack.append(child)
+        return found
+
+    def snapshot_owner(self, moid):
+        """Find the VM a snapshot belongs to
+
+        :Returns: FakeVM
+        """
+        try:
+            return self._owners[moid]
+        except KeyError:
+            raise vmodl.fault.ManagedObjectNotFound(msg='No snapshot {}'.format(moid))
+
+    def store_result(self, objects, page_size):
+        """Page the results of a RetrievePropertiesEx call
+
+        :Returns: vmodl.query.PropertyCollector.RetrieveResult
+        """
+        if not page_size or len(objects) <= page_size:
+            return PC.RetrieveResult(objects=objects)
+        token = str(next(self._ids))
+        with self._lock:
+            self._results[token] = objects[page_size:]
+        return PC.RetrieveResult(objects=objects[:page_size], token=token)
+
+    def next_page(self, token, page_size):
+        """The next page of a RetrievePropertiesEx call
+
+        :Returns: vmodl.query.PropertyCollector.RetrieveResult
+        """
+        with self._lock:
+            objects = self._results.pop(token, [])
+        return self.store_result(objects, page_size)
+
+    def cancel(self, token):
+        """Drop the rest of a RetrievePropertiesEx call
+
+        :Returns: None
+        """
+        with self._lock:
+            self._results.pop(token, None)
+
+
+class FakeStub(object):
+    """Answers the SOAP calls of one session from a ``Simulator``
+
+    :param sim: The simulated vCenter server
+    :type sim: Simulator
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self._page_size = None
+
+    def mo(self, moid):
+        """Create a managed object bound to this session
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+        """
+        return self.sim.kind_of(moid)(moid, stub=self)
+
+    def InvokeMethod(self, mo, info, args, *more):
+        self._round_trip(info.wsdlName)
+        kwargs = dict(zip([param.name for param in info.params], args))
+        handler = getattr(self, '_{}'.format(info.wsdlName), None)
+        if handler is None:
+            raise NotImplementedError('The fake vCenter does not support {}'.format(info.wsdlName))
+        return handler(mo, **kwargs)
+
+    def InvokeAccessor(self, mo, info):
+        self._round_trip('RetrieveProperty')
+        return self._property(mo._moId, info.name)
+
+    def _round_trip(self, method):
+        self.sim.calls[method] += 1
+        if self.sim.latency:
+            time.sleep(self.sim.latency)
+        self.sim.settle()
+
+    # Properties
+    def _property(self, moid, path):
+        """Read a property, like ``snapshot.rootSnapshotList``; None when unset"""
+        name, _, rest = path.partition('.')
+        value = self._top_property(moid, name)
+        for attr in rest.split('.') if rest else []:
+            if value is None:
+                break
+            value = getattr(value, attr)
+        return value
+
+    def _top_property(self, moid, name):
+        sim = self.sim
+        if moid in sim.vms:
+            return self._vm_property(sim.vms[moid], name)
+        if moid in sim.tasks:
+            if name == 'info':
+                return self._task_info(sim.tasks[moid])
+        elif moid in ('group-d1', 'group-v1') or moid in sim._folders:
+            folder_name, parent, children = sim.folder(moid)
+            if name == 'name':
+                return folder_name
+            if name == 'parent':
+                return self.mo(parent) if parent else None
+            if name == 'childEntity':
+                return [self.mo(x) for x in children]
+            if name == 'vmFolder':
+                return self.mo('group-v1')
+        elif name == 'name':
+            return moid
+        elif name == 'currentSession':
+            return vim.UserSession(key='session', userName=const.INF_VCENTER_USER)
+        raise AttributeError('The fake vCenter has no property {} on {}'.format(name, moid))
+
+    def _vm_property(self, vm, name):
+        if name == 'name':
+            return vm.name
+        if name == 'parent':
+            return self.mo(vm.folder)
+        if name == 'datastore':
+            return [self.mo(x) for x in vm.datastores]
+        if name == 'runtime':
+            return vim.vm.RuntimeInfo(host=self.mo(vm.host), powerState=vm.power_state)
+        if name == 'config':
+            return vim.vm.ConfigInfo(name=vm.name, changeVersion=str(vm.change_version))
+        if name == 'snapshot':
+            if not vm.roots:
+                return None
+            current = self.mo(vm.current.moid) if vm.current else None
+            return vim.vm.SnapshotInfo(rootSnapshotList=self._snapshot_trees(vm), currentSnapshot=current)
+        raise AttributeError('The fake vCenter has no VM property {}'.format(name))
+
+    def _snapshot_trees(self, vm):
+        """Build the SnapshotTree data objects of a VM, without recursion"""
+        the_vm = self.mo(vm.moid)
+        trees = {}
+        order = []
+        stack = list(vm.roots)
+        while stack:
+            snap = stack.pop()
+            order.append(snap)
+            stack.extend(snap.children)
+        for snap in order:
+            trees[snap.moid] = vim.vm.SnapshotTree(snapshot=self.mo(snap.moid), vm=the_vm, name=snap.name,
+                                                   description=snap.description, id=int(snap.moid.split('-')[1]),
+                                                   createTime=datetime.datetime.utcfromtimestamp(snap.created),
+                                                   state=vm.power_state, quiesced=snap.quiesced,
+                                                   childSnapshotList=[])
+        for snap in order:
+            trees[snap.moid].childSnapshotList = [trees[x.moid] for x in snap.children]
+        return [trees[x.moid] for x in vm.roots]
+
+    def _task_info(self, task):
+        if not task.done:
+            state = vim.TaskInfo.State.running
+        elif task.error:
+            state = vim.TaskInfo.State.error
+        else:
+            state = vim.TaskInfo.State.success
+        error = vmodl.MethodFault(msg=task.error) if task.error else None
+        complete = datetime.datetime.utcfromtimestamp(task.done_at) if task.done else None
+        return vim.TaskInfo(key=task.moid, task=self.mo(task.moid), descriptionId=task.description_id,
+                            entity=self.mo(task.entity), state=state, cancelled=False, cancelable=False,
+                            queueTime=datetime.datetime.utcfromtimestamp(task.queued),
+                            completeTime=complete, error=error, progress=100 if task.done else 0)
+
+    # Methods
+    def _RetrieveServiceContent(self, mo):
+        return vim.ServiceInstanceContent(rootFolder=self.mo('group-d1'),
+                                          propertyCollector=vmodl.query.PropertyCollector('propertyCollector', stub=self),
+                                          searchIndex=vim.SearchIndex('SearchIndex', stub=self),
+                                          sessionManager=vim.SessionManager('SessionManager', stub=self))
+
+    def _FindByInventoryPath(self, mo, inventoryPath):
+        moid = None
+        parts = inventoryPath.strip('/').split('/')
+        if parts[:2] == ['datacenter', 'vm']:
+            moid = 'group-v1'
+            for name in parts[2:]:
+                moid = self.sim.child(moid, name)
+                if moid is None:
+                    break
+        return self.mo(moid) if moid else None
+
+    def _FindChild(self, mo, entity, name):
+        moid = self.sim.child(entity._moId, name)
+        return self.mo(moid) if moid else None
+
+    def _RetrievePropertiesEx(self, mo, specSet, options=None):
+        objects = []
+        for spec in specSet:
+            for moid in self._matches(spec):
+                objects.append(self._object_content(moid, spec))
+        page_size = options.maxObjects if options is not None else None
+        self._page_size = page_size
+        result = self.sim.store_result(objects, page_size)
+        return result if result.objects else None
+
+    def _ContinueRetrievePropertiesEx(self, mo, token):
+        return self.sim.next_page(token, self._page_size)
+
+    def _CancelRetrievePropertiesEx(self, mo, token):
+        self.sim.cancel(token)
+
+    def _matches(self, spec):
+        """The moids of every object a FilterSpec selects"""
+        kinds = tuple(prop.type for prop in spec.propSet)
+        found = []
+        for obj_spec in spec.objectSet:
+            moid = obj_spec.obj._moId
+            if obj_spec.selectSet:
+                recursive = any(x.selectSet for x in obj_spec.selectSet)
+                found.extend(self.sim.descendants(moid, recursive))
+            if not obj_spec.skip:
+                found.append(moid)
+        return [x for x in found if issubclass(self.sim.kind_of(x), kinds)]
+
+    def _object_content(self, moid, spec):
+        props = []
+        for prop_spec in spec.propSet:
+            for path in prop_spec.pathSet:
+                value = self._property(moid, path)
+                if isinstance(value, list):
+                    # unset when empty; otherwise a typed array, like the SOAP deserializer makes
+                    value = type(value[0]).Array(value) if value else None
+                if value is not None:
+                    props.append(vmodl.DynamicProperty(name=path, val=value))
+        return PC.ObjectContent(obj=self.mo(moid), propSet=props)
+
+    def _CreateSnapshot_Task(self, mo, name, description=None, memory=False, quiesce=False):
+        vm = self.sim.vms[mo._moId]
+        effect = lambda: self.sim.add_snapshot(vm, name, description or '', memory=memory, quiesced=quiesce)
+        return self.mo(self.sim.start_task('CreateSnapshot_Task', vm.moid, effect))
+
+    def _RemoveSnapshot_Task(self, mo, removeChildren=False, consolidate=None):
+        vm = self.sim.snapshot_owner(mo._moId)
+        snap = vm.snaps[mo._moId]
+
+        def effect():
+            if snap.moid not in vm.snaps:
+                raise RuntimeError('The snapshot was already deleted')
+            if removeChildren:
+                for child in list(snap.children):
+                    self.sim.remove_snapshot(vm, child)
+            self.sim.remove_snapshot(vm, snap)
+        return self.mo(self.sim.start_task('RemoveSnapshot_Task', vm.moid, effect))
+
+    def _RevertToSnapshot_Task(self, mo, host=None, suppressPowerOn=None):
+        vm = self.sim.snapshot_owner(mo._moId)
+        snap = vm.snaps[mo._moId]
+
+        def effect():
+            vm.current = snap
+            if not snap.memory:
+                vm.power_state = vim.VirtualMachine.PowerState.poweredOff
+        return self.mo(self.sim.start_task('RevertToSnapshot_Task', vm.moid, effect))
+
+
+class FakeVCenter(object):
+    """Stands in for ``vlab_inf_common.vmware.vCenter``
+
+    :param sim: The simulated vCenter server
+    :type sim: Simulator
+    """
+    # the round-trips a real login makes: RetrieveServiceContent, Login, and
+    # reading the ServiceContent again
+    LOGIN_CALLS = 3
+
+    def __init__(self, sim):
+        self._sim = sim
+        stub = FakeStub(sim)
+        self._conn = vim.ServiceInstance('ServiceInstance', stub=stub)
+        sim.calls['Login'] += 1
+        if sim.latency:
+            time.sleep(sim.latency * self.LOGIN_CALLS)
+
+    @property
+    def content(self):
+        return self._conn.RetrieveContent()
+
+    def close(self):
+        pass
+
+    def get_by_name(self, name, vimtype):
+        for moid, (folder_name, _, _) in self._sim._folders.items():
+            if folder_name == name:
+                return self._conn._stub.mo(moid)
+        raise ValueError('Unable to locate object named {}'.format(name))
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in admission.py
+"""
+import os
+import tempfile
+import unittest
+from collections import Counter
+from unittest.mock import patch, MagicMock
+
+from vlab_snapshot_api.lib.worker import admission
+
+
+class TestAdmissionController(unittest.TestCase):
+    """A set of test cases for the AdmissionController object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.controller = admission.AdmissionController(admission.LocalStore(),
+                                                        per_host=2,
+                                                        per_datastore=1,
+                                                        interval=0,
+                                                        timeout=0,
+                                                        lease=60)
+
+    def test_acquire(self):
+        """``acquire`` returns a Ticket when there are free slots"""
+        ticket = self.controller.acquire(Counter({'datastore:ds1': 1}))
+
+        self.assertTrue(isinstance(ticket, admission.Ticket))
+        self.assertEqual(self.controller.usage(), {'held': 1, 'waiting': 0})
+
+    def test_acquire_full(self):
+        """``acquire`` raises ValueError when the slots stay in use until the timeout"""
+        self.controller.acquire(Counter({'datastore:ds1': 1}))
+
+        with self.assertRaises(ValueError):
+            self.controller.acquire(Counter({'datastore:ds1': 1}))
+
+    def test_acquire_waiting(self):
+        """``acquire`` calls ``waiting`` while it waits, so the caller can free slots it holds"""
+        held = self.controller.acquire(Counter({'datastore:ds1': 1}))
+        self.controller.timeout = 5
+        waiting = MagicMock(side_effect=lambda: self.controller.release(held))
+
+        ticket = self.controller.acquire(Counter({'datastore:ds1': 1}), waiting=waiting)
+
+        self.assertTrue(isinstance(ticket, admission.Ticket))
+        self.assertEqual(waiting.call_count, 1)
+
+    def test_acquire_timeout_leaves_queue(self):
+        """``acquire`` stops waiting in line once it times out"""
+        self.controller.acquire(Counter({'datastore:ds1': 1}))
+        try:
+            self.controller.acquire(Counter({'datastore:ds1': 1}))
+        except ValueError:
+            pass
+
+        self.assertEqual(self.controller.usage()['waiting'], 0)
+
+    def test_acquire_other_resource(self):
+        """``acquire`` is not limited by slots of a different datastore"""
+        self.controller.acquire(Counter({'datastore:ds1': 1}))
+        ticket = self.controller.acquire(Counter({'datastore:ds2': 1}))
+
+        self.assertTrue(isinstance(ticket, admission.Ticket))
+
+    def test_acquire_host_limit(self):
+        """``acquire`` allows ``per_host`` operations on the same host"""
+        self.controller.acquire(Counter({'host:h1': 1}))
+        self.controller.acquire(Counter({'host:h1': 1}))
+
+        with self.assertRaises(ValueError):
+            self.controller.acquire(Counter({'host:h1': 1}))
+
+    def test_acquire_capped(self):
+        """``acquire`` caps a request bigger than the limit, instead of waiting forever"""
+        ticket = self.controller.acquire(Counter({'datastore:ds1': 5}))
+
+        self.assertTrue(isinstance(ticket, admission.Ticket))
+
+    def test_release(self):
+        """``release`` frees the slots of a ticket"""
+        ticket = self.controller.acquire(Counter({'datastore:ds1': 1}))
+        self.controller.release(ticket)
+        again = self.controller.acquire(Counter({'datastore:ds1': 1}))
+
+        self.assertTrue(isinstance(again, admission.Ticket))
+
+    def test_release_none(self):
+        """``release`` ignores None"""
+        self.controller.release(None)
+
+        self.assertEqual(self.controller.usage(), {'held': 0, 'waiting': 0})
+
+    @patch.object(admission.time, 'time')
+    def test_lease(self, fake_time):
+        """Slots that are never released expire after ``lease`` seconds"""
+        fake_time.return_value = 100
+        self.controller.acquire(Counter({'datastore:ds1': 1}))
+        fake_time.return_value = 161
+        ticket = self.controller.acquire(Counter({'datastore:ds1': 1}))
+
+        self.assertTrue(isinstance(ticket, admission.Ticket))
+
+    def test_fifo(self):
+        """A request waits behind an earlier request for the same resource, even if it would fit"""
+        state = {'held': {}, 'queue': [['earlier', 100, {'datastore:ds1': 1, 'host:h1': 1}]]}
+
+        admitted = self.controller._try_admit(state, 'later', {'host:h1': 1}, 100)
+
+        self.assertFalse(admitted)
+        self.assertEqual([x[0] for x in state['queue']], ['earlier', 'later'])
+
+    def test_fifo_disjoint(self):
+        """A request does not wait behind an earlier request for different resources"""
+        state = {'held': {}, 'queue': [['earlier', 100, {'datastore:ds1': 1}]]}
+
+        admitted = self.controller._try_admit(state, 'later', {'datastore:ds2': 1}, 100)
+
+        self.assertTrue(admitted)
+
+    def test_stale(self):
+        """A waiter that stopped checking in loses its place in line"""
+        state = {'held': {}, 'queue': [['dead', 100, {'datastore:ds1': 1}]]}
+
+        admitted = self.controller._try_admit(state, 'alive', {'datastore:ds1': 1}, 100 + self.controller.stale_after + 1)
+
+        self.assertTrue(admitted)
+
+
+class TestFileStore(unittest.TestCase):
+    """A set of test cases for the FileStore object"""
+    def setUp(self):
+        """Runs before every test case"""
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def test_locked(self):
+        """``locked`` writes the changes to the state back to the file"""
+        store = admission.FileStore(self.path)
+        with store.locked() as state:
+            state['foo'] = 1
+        with admission.FileStore(self.path).locked() as state:
+            found = state
+
+        self.assertEqual(found, {'foo': 1})
+
+    def test_shared(self):
+        """Two controllers using the same file share the slots"""
+        one = admission.AdmissionController(admission.FileStore(self.path), per_datastore=1, interval=0, timeout=0)
+        two = admission.AdmissionController(admission.FileStore(self.path), per_datastore=1, interval=0, timeout=0)
+        one.acquire(Counter({'datastore:ds1': 1}))
+
+        with self.assertRaises(ValueError):
+            two.acquire(Counter({'datastore:ds1': 1}))
+
+
+class TestHelpers(unittest.TestCase):
+    """A set of test cases for the functions in admission.py"""
+    def test_needs_of(self):
+        """``needs_of`` counts a slot for the host, and every datastore of a VM"""
+        host, ds1, ds2 = MagicMock(), MagicMock(), MagicMock()
+        host._moId = 'host-1'
+        ds1._moId = 'datastore-1'
+        ds2._moId = 'datastore-2'
+
+        needs = admission.needs_of(host, [ds1, ds2])
+        expected = {'host:host-1': 1, 'datastore:datastore-1': 1, 'datastore:datastore-2': 1}
+
+        self.assertEqual(needs, expected)
+
+    def test_needs_of_no_host(self):
+        """``needs_of`` skips the host when it's unknown"""
+        needs = admission.needs_of(None, [])
+
+        self.assertEqual(needs, {})
+
+    @patch.object(admission, 'const')
+    def test_get_controller_file(self, fake_const):
+        """``get_controller`` uses a FileStore when VLAB_ADMISSION_STATE is set"""
+        fake_const.VLAB_ADMISSION_STATE = '/tmp/admission.json'
+        with patch.object(admission, '_CONTROLLER', None):
+            controller = admission.get_controller()
+
+        self.assertTrue(isinstance(controller._store, admission.FileStore))
+
+    @patch.object(admission, 'const')
+    def test_get_controller_local(self, fake_const):
+        """``get_controller`` uses a LocalStore when VLAB_ADMISSION_STATE is not set"""
+        fake_const.VLAB_ADMISSION_STATE = ''
+        with patch.object(admission, '_CONTROLLER', None):
+            controller = admission.get_controller()
+
+        self.assertTrue(isinstance(controller._store, admission.LocalStore))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,6 +52,26 @@ class TestSnapshotViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_checkpoint_schema(self):
+        """The schema defined for POST on /lab is valid"""
+        try:
+            Draft4Validator.check_schema(snapshot.SnapshotView.CHECKPOINT_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_revert_schema(self):
+        """The schema defined for PUT on /lab is valid"""
+        try:
+            Draft4Validator.check_schema(snapshot.SnapshotView.REVERT_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
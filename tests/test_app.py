@@ -0,0 +1,32 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the ``app.py`` module
+"""
+import sys
+import unittest
+import subprocess
+
+from vlab_snapshot_api.lib.worker import tasks
+
+
+class TestApp(unittest.TestCase):
+    """A set of test cases for the Flask app"""
+    def test_no_vsphere(self):
+        """Importing the API app does not import pyVmomi; only the workers talk to vCenter"""
+        # a new interpreter, because other tests have already imported the workers
+        code = 'import sys; import vlab_snapshot_api.app; print("pyVmomi" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code])
+
+        self.assertEqual(output.strip(), b'False')
+
+    def test_result_backend(self):
+        """The API and the workers share a result backend that any thread can read; rpc:// is per thread"""
+        code = 'import vlab_snapshot_api.app as a; print(a.app.celery_app.conf.result_backend)'
+        api_backend = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code]).strip()
+
+        self.assertFalse(api_backend.startswith(b'rpc'))
+        self.assertEqual(api_backend.decode(), tasks.app.conf.result_backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+"""
+Runs the snapshot operations, unchanged, against the simulated vCenter in
+``fake_vcenter.py``. Unlike the other suites, pyVmomi is not mocked out here.
+"""
+import unittest
+from unittest.mock import MagicMock
+
+from tests.fake_vcenter import Simulator
+from vlab_snapshot_api.lib.worker import instrument, reaper, resolver, session_pool, vmware
+
+
+class TestFakeVCenter(unittest.TestCase):
+    """A suite of test cases for the snapshot operations against a simulated vCenter"""
+    def setUp(self):
+        """Runs before every test case"""
+        resolver._RESOLVER = None
+        self.sim = Simulator.build(users=3, vms_per_user=2, snapshots_per_vm=2)
+        session_pool.init_pool(factory=self.sim.connect)
+        self.logger = MagicMock()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        session_pool.close_pool()
+        resolver._RESOLVER = None
+
+    def test_show_snapshot(self):
+        """``show_snapshot`` finds every snapshot of every VM in the lab"""
+        info, _ = vmware.show_snapshot('user1')
+
+        self.assertEqual(sorted(info.keys()), ['vm0', 'vm1'])
+        self.assertEqual(len(info['vm0']), 2)
+
+    def test_create_snapshot(self):
+        """``create_snapshot`` adds a snapshot to the VM"""
+        created = vmware.create_snapshot('user0', 'vm0', False, self.logger)
+
+        self.assertEqual(len(created['vm0']), 1)
+        self.assertEqual(self.sim.snapshot_count(), 13)
+
+    def test_delete_snapshot(self):
+        """``delete_snapshot`` removes the snapshot from the VM"""
+        snap_id = vmware.show_snapshot('user0')[0]['vm0'][0]['id']
+
+        vmware.delete_snapshot('user0', snap_id, 'vm0', self.logger)
+        info, _ = vmware.show_snapshot('user0')
+
+        self.assertEqual([x['id'] for x in info['vm0'] if x['id'] == snap_id], [])
+
+    def test_apply_snapshot(self):
+        """``apply_snapshot`` runs a RevertToSnapshot_Task on the VM"""
+        snap_id = vmware.show_snapshot('user2')[0]['vm1'][0]['id']
+
+        vmware.apply_snapshot('user2', snap_id, 'vm1', self.logger)
+
+        self.assertEqual(self.sim.calls['RevertToSnapshot_Task'], 1)
+
+    def test_round_trips(self):
+        """Every round-trip to the simulated vCenter is recorded"""
+        vmware.show_snapshot('user0')
+        with instrument.recording() as recorder:
+            vmware.show_snapshot('user0')
+
+        self.assertTrue(recorder.summary()['work']['calls'] > 0)
+
+    def test_reap_snapshots(self):
+        """``reap_snapshots`` deletes only the expired snapshots"""
+        sim = Simulator.build(users=2, vms_per_user=2, snapshots_per_vm=2, expired=0.5)
+
+        reaper.reap_snapshots(sim.connect(), self.logger)
+
+        self.assertEqual(sim.snapshot_count(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
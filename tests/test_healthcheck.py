@@ -2,7 +2,11 @@
 """
 A suite of tests for the healthcheck API end point
 """
+import sys
 import unittest
+from unittest.mock import patch
+
+import pkg_resources
 
 from flask import Flask
 
@@ -28,6 +32,35 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(expected, resp.status_code)
 
+    @patch.object(healthcheck, 'get_registry')
+    def test_health_check_coalesce(self, fake_get_registry):
+        """The /api/1/inf/snapshot/healthcheck end point reports how often snapshot.show tasks are reused"""
+        fake_get_registry.return_value.counter.side_effect = lambda key: {'show_hits': 3, 'show_misses': 1}[key]
+
+        resp = self.app.get('/api/1/inf/snapshot/healthcheck')
+
+        self.assertEqual(resp.json['show_coalesce']['hit_ratio'], 0.75)
+
+    @patch.object(healthcheck, 'VERSION', '1.2.3')
+    def test_health_check_version(self):
+        """The /api/1/inf/snapshot/healthcheck end point reports the version found at startup"""
+        resp = self.app.get('/api/1/inf/snapshot/healthcheck')
+
+        self.assertEqual(resp.json['version'], '1.2.3')
+
+
+class TestGetVersion(unittest.TestCase):
+    """A set of test cases for the ``_get_version`` function"""
+    @patch.object(pkg_resources, 'get_distribution')
+    def test_get_version_not_installed(self, fake_get_distribution):
+        """``_get_version`` returns 'unknown' on Python < 3.8 when the package is not installed"""
+        fake_get_distribution.side_effect = pkg_resources.DistributionNotFound()
+        # importing a module set to None in sys.modules raises ImportError
+        with patch.dict(sys.modules, {'importlib.metadata': None}):
+            version = healthcheck._get_version()
+
+        self.assertEqual(version, 'unknown')
+
 
 if __name__ == '__main__':
     unittest.main()
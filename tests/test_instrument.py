@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in instrument.py
+"""
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_snapshot_api.lib.worker import instrument
+
+
+class FakeStub(object):
+    """Just enough of a pyVmomi SoapStubAdapter to wrap"""
+    def __init__(self):
+        self.methods = []
+
+    def InvokeMethod(self, mo, info, args):
+        self.methods.append(info.wsdlName)
+        return 'method result'
+
+    def InvokeAccessor(self, mo, info):
+        # a property read is a RetrievePropertiesEx under the covers
+        inner = MagicMock()
+        inner.wsdlName = 'RetrievePropertiesEx'
+        self.InvokeMethod(mo, inner, [])
+        return 'property value'
+
+
+class VirtualMachine(object):
+    """Stands in for a managed object"""
+
+
+def make_info(name):
+    """Create the method (or property) info pyVmomi hands to the stub"""
+    info = MagicMock()
+    info.wsdlName = name
+    info.name = name
+    return info
+
+
+class TestInstrument(unittest.TestCase):
+    """A set of test cases for instrument.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.stub = FakeStub()
+        self.vcenter = MagicMock()
+        self.vcenter._conn._stub = self.stub
+        instrument.install(self.vcenter)
+
+    def test_method(self):
+        """``install`` records SOAP method calls, under the current phase"""
+        with instrument.recording('myTxn', 'myTask') as recorder:
+            with instrument.phase('wait'):
+                output = self.stub.InvokeMethod(VirtualMachine(), make_info('CreateSnapshot_Task'), [])
+
+        self.assertEqual(output, 'method result')
+        self.assertEqual(recorder.summary()['wait']['calls'], 1)
+
+    def test_accessor(self):
+        """``install`` records property reads once, by the property path"""
+        with instrument.recording() as recorder:
+            output = self.stub.InvokeAccessor(VirtualMachine(), make_info('name'))
+        calls = recorder.calls()
+
+        self.assertEqual(output, 'property value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:4], ('work', 'RetrieveProperty', 'VirtualMachine.name', 1))
+
+    def test_install_twice(self):
+        """``install`` only wraps a session once"""
+        instrument.install(self.vcenter)
+        with instrument.recording() as recorder:
+            self.stub.InvokeMethod(VirtualMachine(), make_info('Foo'), [])
+
+        self.assertEqual(recorder.summary()['work']['calls'], 1)
+
+    def test_not_recording(self):
+        """Calls made while nothing is recording still work"""
+        output = self.stub.InvokeMethod(VirtualMachine(), make_info('Foo'), [])
+
+        self.assertEqual(output, 'method result')
+        self.assertTrue(instrument.current() is None)
+
+    def test_metrics(self):
+        """Every call is counted in ``metrics.VCENTER_CALLS``"""
+        before = instrument.metrics.VCENTER_CALLS.value('Bar')
+        self.stub.InvokeMethod(VirtualMachine(), make_info('Bar'), [])
+
+        self.assertEqual(instrument.metrics.VCENTER_CALLS.value('Bar'), before + 1)
+
+    def test_in_phase(self):
+        """``in_phase`` charges the calls a function makes to a phase"""
+        @instrument.in_phase('resolve')
+        def lookup():
+            return self.stub.InvokeMethod(VirtualMachine(), make_info('FindChild'), [])
+
+        with instrument.recording() as recorder:
+            lookup()
+            self.stub.InvokeMethod(VirtualMachine(), make_info('Foo'), [])
+
+        self.assertEqual(set(recorder.summary().keys()), {'resolve', 'work'})
+
+    def test_bound(self):
+        """``bound`` lets another thread add to a recording"""
+        with instrument.recording() as recorder:
+            def worker():
+                with instrument.bound(recorder, phase='delete'):
+                    self.stub.InvokeMethod(VirtualMachine(), make_info('RemoveSnapshot_Task'), [])
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(recorder.summary()['delete']['calls'], 1)
+
+    def test_recording_restores(self):
+        """``recording`` puts back the Recorder that was active before it"""
+        with instrument.recording() as outer:
+            with instrument.recording():
+                pass
+            found = instrument.current()
+
+        self.assertTrue(found is outer)
+
+    def test_timed(self):
+        """``timed`` counts a block of code as a single round-trip"""
+        with instrument.recording() as recorder:
+            with instrument.phase('login'), instrument.timed('Login'):
+                pass
+
+        self.assertEqual(recorder.summary()['login']['calls'], 1)
+
+    def test_path_set(self):
+        """``_path_set`` names the properties a PropertyCollector call reads"""
+        prop = MagicMock()
+        prop.type.__name__ = 'vim.VirtualMachine'
+        prop.pathSet = ['name', 'snapshot']
+        spec = MagicMock()
+        spec.propSet = [prop]
+
+        output = instrument._path_set(make_info('RetrievePropertiesEx'), [[spec]])
+
+        self.assertEqual(output, 'VirtualMachine:name,snapshot')
+
+
+if __name__ == '__main__':
+    unittest.main()
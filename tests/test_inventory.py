@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``inventory.py`` module"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_snapshot_api.lib.worker import inventory
+
+
+def make_page(names, token=None):
+    """Create a fake RetrieveResult"""
+    page = MagicMock()
+    page.token = token
+    page.objects = []
+    for name in names:
+        prop = MagicMock()
+        prop.name = 'name'
+        prop.val = name
+        obj_content = MagicMock()
+        obj_content.propSet = [prop]
+        page.objects.append(obj_content)
+    return page
+
+
+class TestFilterSpec(unittest.TestCase):
+    """A suite of test cases for building PropertyCollector specs"""
+    def test_vm_filter_spec(self):
+        """``vm_filter_spec`` only reads the requested VM properties"""
+        spec = inventory.vm_filter_spec(inventory.vim.Folder('group-v1'), ['name'])
+
+        self.assertEqual(spec.propSet[0].pathSet, ['name'])
+        self.assertEqual(spec.propSet[0].type, inventory.vim.VirtualMachine)
+
+    def test_vm_filter_spec_skip_root(self):
+        """``vm_filter_spec`` does not return the root folder"""
+        spec = inventory.vm_filter_spec(inventory.vim.Folder('group-v1'), ['name'])
+
+        self.assertTrue(spec.objectSet[0].skip)
+
+    def test_task_filter_spec(self):
+        """``task_filter_spec`` reads every supplied task"""
+        tasks = [inventory.vim.Task('task-1'), inventory.vim.Task('task-2')]
+
+        spec = inventory.task_filter_spec(tasks, ['info.state'])
+
+        self.assertEqual([x.obj for x in spec.objectSet], tasks)
+
+    def test_folder_traversal(self):
+        """``folder_traversal`` does not walk into sub-folders by default"""
+        spec = inventory.folder_traversal()
+
+        self.assertEqual(spec.selectSet, [])
+
+    def test_folder_traversal_recursive(self):
+        """``folder_traversal`` walks into sub-folders when ``recursive`` is True"""
+        spec = inventory.folder_traversal(recursive=True)
+
+        self.assertEqual(spec.selectSet[0].name, spec.name)
+
+
+class TestRetrieve(unittest.TestCase):
+    """A suite of test cases for the ``retrieve`` function"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.vcenter = MagicMock()
+        cls.collector = cls.vcenter.content.propertyCollector
+
+    def test_retrieve(self):
+        """``retrieve`` yields a dictionary of properties per object"""
+        self.collector.RetrievePropertiesEx.return_value = make_page(['vm1'])
+
+        found = list(inventory.retrieve(self.vcenter, MagicMock()))
+
+        self.assertEqual(found[0]['name'], 'vm1')
+        self.assertTrue('obj' in found[0])
+
+    def test_retrieve_nothing(self):
+        """``retrieve`` handles the server returning no results"""
+        self.collector.RetrievePropertiesEx.return_value = None
+
+        found = list(inventory.retrieve(self.vcenter, MagicMock()))
+
+        self.assertEqual(found, [])
+
+    def test_retrieve_pages(self):
+        """``retrieve`` follows the token until all pages are read"""
+        self.collector.RetrievePropertiesEx.return_value = make_page(['vm1'], token='abc')
+        self.collector.ContinueRetrievePropertiesEx.return_value = make_page(['vm2'])
+
+        found = [x['name'] for x in inventory.retrieve(self.vcenter, MagicMock(), page_size=1)]
+
+        self.assertEqual(found, ['vm1', 'vm2'])
+        self.collector.ContinueRetrievePropertiesEx.assert_called_with(token='abc')
+
+    def test_retrieve_cancel(self):
+        """``retrieve`` cancels the server-side result set when the caller stops early"""
+        self.collector.RetrievePropertiesEx.return_value = make_page(['vm1'], token='abc')
+
+        found = inventory.retrieve(self.vcenter, MagicMock(), page_size=1)
+        next(found)
+        found.close()
+
+        self.collector.CancelRetrievePropertiesEx.assert_called_with(token='abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metrics.py
+"""
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+from vlab_snapshot_api.lib.worker import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """A set of test cases for the metric objects"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        with patch.object(metrics, '_REGISTRY', []):
+            cls.counter = metrics.Counter('test_calls_total', 'Calls made', labels=('method',))
+            cls.gauge = metrics.Gauge('test_backlog', 'Things waiting')
+            cls.histogram = metrics.Histogram('test_seconds', 'Time taken', buckets=(1, 5))
+
+    def test_counter(self):
+        """``Counter.inc`` adds to the value of the labels given"""
+        before = self.counter.value('Foo')
+        self.counter.inc('Foo')
+        self.counter.inc('Foo', amount=2)
+
+        self.assertEqual(self.counter.value('Foo'), before + 3)
+
+    def test_counter_labels(self):
+        """``Counter.inc`` raises ValueError when the labels do not match"""
+        with self.assertRaises(ValueError):
+            self.counter.inc()
+
+    def test_gauge(self):
+        """``Gauge.set`` replaces the value"""
+        self.gauge.set(4)
+        self.gauge.set(2)
+
+        self.assertEqual(self.gauge.value(), 2)
+
+    def test_histogram_samples(self):
+        """``Histogram.samples`` reports cumulative buckets, the sum and the count"""
+        histogram = metrics.Histogram('test_latency', 'Latency', buckets=(1, 5))
+        metrics._REGISTRY.remove(histogram)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(9)
+
+        expected = ['# HELP test_latency Latency',
+                    '# TYPE test_latency histogram',
+                    'test_latency_bucket{le="1"} 1',
+                    'test_latency_bucket{le="5"} 2',
+                    'test_latency_bucket{le="+Inf"} 3',
+                    'test_latency_sum 12.5',
+                    'test_latency_count 3']
+
+        self.assertEqual(histogram.samples(), expected)
+
+    def test_counter_samples(self):
+        """``Counter.samples`` escapes the label values"""
+        counter = metrics.Counter('test_escaped_total', 'Escaped', labels=('path',))
+        metrics._REGISTRY.remove(counter)
+        counter.inc('a"b')
+
+        self.assertEqual(counter.samples()[-1], 'test_escaped_total{path="a\\"b"} 1')
+
+    def test_render(self):
+        """``render`` includes every metric that's defined"""
+        output = metrics.render()
+
+        self.assertTrue('# TYPE vlab_vcenter_calls_total counter' in output)
+
+
+class TestServe(unittest.TestCase):
+    """A set of test cases for the ``serve`` function"""
+    def test_serve_disabled(self):
+        """``serve`` does nothing when the port is 0"""
+        self.assertTrue(metrics.serve(port=0) is None)
+
+    def test_serve(self):
+        """``serve`` answers GET /metrics with the Prometheus text format"""
+        server = metrics._Server(('127.0.0.1', 0), metrics._Handler)
+        with patch.object(metrics, '_Server') as fake_server:
+            fake_server.return_value = server
+            metrics.serve(port=1, host='127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            body = resp.read().decode()
+            content_type = resp.headers['Content-Type']
+
+        self.assertTrue('vlab_vcenter_calls_total' in body)
+        self.assertEqual(content_type, metrics.CONTENT_TYPE)
+
+    def test_serve_not_found(self):
+        """``serve`` answers 404 for paths other than /metrics"""
+        server = metrics._Server(('127.0.0.1', 0), metrics._Handler)
+        with patch.object(metrics, '_Server') as fake_server:
+            fake_server.return_value = server
+            metrics.serve(port=1, host='127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/nope'.format(server.server_address[1])
+
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url, timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,21 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``reaper.py`` module"""
+import time
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 
-from vlab_snapshot_api.lib.worker import reaper
+from pyVmomi import vim
+
+from vlab_snapshot_api.lib.worker import reaper, records
+from .test_watcher import FakePropertyCollector, make_snapshot_tree
 
 
 class TestIsExpired(unittest.TestCase):
     """A suite of test cases for the ``is_expired`` function"""
     def test_is_expired(self):
         """``is_expired`` returns True when the current time is greater than the exp time of the snapshot"""
-        snap = 'aabbcc_1234_4321'
+        snap = records.SnapshotRecord('aabbcc', 1234, 4321, 'aabbcc_1234_4321')
 
         is_expired = reaper.is_expired(snap)
 
@@ -18,13 +23,222 @@ class TestIsExpired(unittest.TestCase):
 
     def test_is_not_expired(self):
         """``is_expired`` returns False when the snapshot is less than the exp time of the snapshot"""
-        snap = 'aabbcc_1234_9999999999999999999'
+        snap = records.SnapshotRecord('aabbcc', 1234, 9999999999999999999, 'aabbcc_1234_9999999999999999999')
 
         is_expired = reaper.is_expired(snap)
 
         self.assertFalse(is_expired)
 
 
+class TestScanInventory(unittest.TestCase):
+    """A suite of test cases for the ``scan_inventory`` function"""
+    @patch.object(reaper, 'get_resolver')
+    @patch.object(reaper, 'inventory')
+    def test_scan_inventory(self, fake_inventory, fake_get_resolver):
+        """``scan_inventory`` pages through the users folder with one traversal"""
+        vcenter = MagicMock()
+        fake_inventory.retrieve.return_value = iter([])
+
+        reaper.scan_inventory(vcenter)
+        _, the_kwargs = fake_inventory.retrieve.call_args
+
+        self.assertEqual(the_kwargs['page_size'], reaper.const.VLAB_REAPER_PAGE_SIZE)
+        self.assertEqual(fake_get_resolver.return_value.users_folder.call_count, 1)
+
+    @patch.object(reaper, 'inventory')
+    def test_scan_inventory_recursive(self, fake_inventory):
+        """``scan_inventory`` finds VMs in every user's folder"""
+        vcenter = MagicMock()
+
+        reaper.scan_inventory(vcenter)
+        _, the_kwargs = fake_inventory.vm_filter_spec.call_args
+
+        self.assertTrue(the_kwargs['recursive'])
+
+
+def make_vm(vm_id, host_id, datastore_ids):
+    """Create the VM properties that ``scan_inventory`` would yield"""
+    vm = {'name': vm_id, 'obj': MagicMock(), 'runtime.host': MagicMock(), 'datastore': []}
+    vm['obj']._moId = vm_id
+    vm['runtime.host']._moId = host_id
+    for ds_id in datastore_ids:
+        datastore = MagicMock()
+        datastore._moId = ds_id
+        vm['datastore'].append(datastore)
+    return vm
+
+
+class TestDeletionExecutor(unittest.TestCase):
+    """A suite of test cases for the ``DeletionExecutor`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.logger = MagicMock()
+        cls.running = 0
+        cls.max_running = 0
+        cls.lock = threading.Lock()
+
+    def slow_consume(self, the_task):
+        """Stand-in for ``consume_task`` that tracks how many deletions overlap"""
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+
+    @patch.object(reaper, 'consume_task')
+    def test_stats(self, fake_consume_task):
+        """``DeletionExecutor.wait`` reports the throughput of the pass"""
+        executor = reaper.DeletionExecutor(self.logger)
+        executor.submit(make_vm('vm-1', 'host-1', ['ds-1']), MagicMock())
+        executor.submit(make_vm('vm-2', 'host-1', ['ds-1']), MagicMock())
+
+        stats = executor.wait()
+        executor.shutdown()
+
+        self.assertEqual(stats['deleted'], 2)
+        self.assertEqual(stats['failed'], 0)
+
+    @patch.object(reaper, 'consume_task')
+    def test_failures(self, fake_consume_task):
+        """``DeletionExecutor`` counts, and logs, deletions that fail"""
+        fake_consume_task.side_effect = RuntimeError('testing')
+        executor = reaper.DeletionExecutor(self.logger)
+        executor.submit(make_vm('vm-1', 'host-1', ['ds-1']), MagicMock())
+
+        stats = executor.wait()
+        executor.shutdown()
+
+        self.assertEqual(stats['failed'], 1)
+        self.assertTrue(self.logger.error.called)
+
+    def test_per_datastore(self):
+        """``DeletionExecutor`` limits concurrent deletions on a single datastore"""
+        executor = reaper.DeletionExecutor(self.logger, max_workers=4, per_host=4, per_datastore=1)
+        with patch.object(reaper, 'consume_task', self.slow_consume):
+            for idx in range(3):
+                executor.submit(make_vm('vm-{}'.format(idx), 'host-{}'.format(idx), ['ds-1']), MagicMock())
+            executor.shutdown()
+
+        self.assertEqual(self.max_running, 1)
+
+    def test_per_host(self):
+        """``DeletionExecutor`` limits concurrent deletions on a single ESXi host"""
+        executor = reaper.DeletionExecutor(self.logger, max_workers=4, per_host=1, per_datastore=4)
+        with patch.object(reaper, 'consume_task', self.slow_consume):
+            for idx in range(3):
+                executor.submit(make_vm('vm-{}'.format(idx), 'host-1', ['ds-{}'.format(idx)]), MagicMock())
+            executor.shutdown()
+
+        self.assertEqual(self.max_running, 1)
+
+    def test_per_vm(self):
+        """``DeletionExecutor`` only deletes one snapshot at a time from a VM"""
+        executor = reaper.DeletionExecutor(self.logger, max_workers=4, per_host=4, per_datastore=4)
+        vm = make_vm('vm-1', 'host-1', ['ds-1'])
+        with patch.object(reaper, 'consume_task', self.slow_consume):
+            for _ in range(3):
+                executor.submit(vm, MagicMock())
+            executor.shutdown()
+
+        self.assertEqual(self.max_running, 1)
+
+    def test_parallel(self):
+        """``DeletionExecutor`` runs deletions on different datastores in parallel"""
+        executor = reaper.DeletionExecutor(self.logger, max_workers=4, per_host=4, per_datastore=1)
+        with patch.object(reaper, 'consume_task', self.slow_consume):
+            for idx in range(3):
+                executor.submit(make_vm('vm-{}'.format(idx), 'host-1', ['ds-{}'.format(idx)]), MagicMock())
+            executor.shutdown()
+
+        self.assertTrue(self.max_running > 1)
+
+
+class TestExpirySchedule(unittest.TestCase):
+    """A suite of test cases for the ``ExpirySchedule`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.schedule = reaper.ExpirySchedule()
+        cls.vm = make_vm('vm-1', 'host-1', ['ds-1'])
+
+    def make_snap(self, name):
+        """Create a fake snapshot"""
+        snap = MagicMock()
+        snap.name = name
+        return snap
+
+    def test_next_deadline(self):
+        """``ExpirySchedule.next_deadline`` is the soonest expiration time"""
+        self.schedule.add(300, self.vm, self.make_snap('b_1_300'))
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+
+        self.assertEqual(self.schedule.next_deadline(), 200)
+
+    def test_next_deadline_empty(self):
+        """``ExpirySchedule.next_deadline`` is None when nothing is scheduled"""
+        self.assertTrue(self.schedule.next_deadline() is None)
+
+    def test_due(self):
+        """``ExpirySchedule.due`` only returns the snapshots that have expired"""
+        snap1 = self.make_snap('a_1_200')
+        snap2 = self.make_snap('b_1_300')
+        self.schedule.add(200, self.vm, snap1)
+        self.schedule.add(300, self.vm, snap2)
+
+        due = self.schedule.due(250)
+
+        self.assertEqual(due, [(self.vm, snap1)])
+        self.assertEqual(len(self.schedule), 1)
+
+    def test_due_same_time(self):
+        """``ExpirySchedule`` handles snapshots that expire at the same time"""
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+        self.schedule.add(200, self.vm, self.make_snap('b_1_200'))
+
+        due = self.schedule.due(200)
+
+        self.assertEqual(len(due), 2)
+
+    def test_add_twice(self):
+        """``ExpirySchedule.add`` ignores snapshots that are already scheduled"""
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+
+        self.assertEqual(len(self.schedule), 1)
+        self.assertEqual(len(self.schedule.due(200)), 1)
+
+    def test_sync(self):
+        """``ExpirySchedule.sync`` drops snapshots that were deleted outside the reaper"""
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+        self.schedule.add(300, self.vm, self.make_snap('b_1_300'))
+
+        self.schedule.sync(self.vm, ['b_1_300'])
+        due = self.schedule.due(300)
+
+        self.assertEqual([snap.name for _, snap in due], ['b_1_300'])
+        self.assertEqual(len(self.schedule), 0)
+
+    def test_sleep_time(self):
+        """``ExpirySchedule.sleep_time`` sleeps until the next snapshot expires"""
+        self.schedule.add(200, self.vm, self.make_snap('a_1_200'))
+
+        self.assertEqual(self.schedule.sleep_time(now=150, next_scan=1000), 50)
+
+    def test_sleep_time_scan(self):
+        """``ExpirySchedule.sleep_time`` wakes up for the next full scan"""
+        self.schedule.add(2000, self.vm, self.make_snap('a_1_2000'))
+
+        self.assertEqual(self.schedule.sleep_time(now=150, next_scan=1000), 850)
+
+    def test_sleep_time_late(self):
+        """``ExpirySchedule.sleep_time`` never returns a negative number"""
+        self.schedule.add(100, self.vm, self.make_snap('a_1_100'))
+
+        self.assertEqual(self.schedule.sleep_time(now=150, next_scan=1000), 0)
+
+
 class TestReapSnapshots(unittest.TestCase):
     """A suite of tests cases for the ``reap_snapshots`` function"""
     @classmethod
@@ -32,17 +246,11 @@ class TestReapSnapshots(unittest.TestCase):
         """Runs before every test case"""
         cls.logger = MagicMock()
         cls.vcenter = MagicMock()
-        fake_vm = MagicMock()
-        fake_vms = MagicMock()
-        fake_vms.childEntity = [fake_vm]
-        fake_user = MagicMock()
-        fake_users_folder = MagicMock()
-        fake_users_folder.childEntity = [fake_user]
-        cls.vcenter.get_by_name.side_effect = [fake_users_folder, fake_vms]
-        cls.fake_snap = MagicMock()
-        cls.fake_snap.name = 'aabbcc_1234_4321'
-        cls.fake_snaps = MagicMock()
+        cls.fake_snap = records.SnapshotRecord('aabbcc', 1234, 4321, 'aabbcc_1234_4321', snapshot=MagicMock())
         cls.fake_snaps = [cls.fake_snap]
+        cls.fake_vm = make_vm('vm-1', 'host-1', ['ds-1'])
+        cls.fake_vm['parent'] = MagicMock()
+        cls.fake_vm['snapshot.rootSnapshotList'] = MagicMock()
 
     @classmethod
     def tearDown(cls):
@@ -50,25 +258,184 @@ class TestReapSnapshots(unittest.TestCase):
         cls.vcenter = None
         cls.logger = None
 
+    @patch.object(reaper, 'scan_inventory')
     @patch.object(reaper, 'consume_task')
-    @patch.object(reaper, '_get_snapshots')
-    def test_delete_exp_snapshot(self, fake_get_snapshots, fake_consume_task):
+    @patch.object(reaper, '_iter_snapshots')
+    def test_delete_exp_snapshot(self, fake_iter_snapshots, fake_consume_task, fake_scan_inventory):
         """``reap_snapshots`` deletes expired snapshots"""
-        fake_get_snapshots.return_value = self.fake_snaps
+        fake_iter_snapshots.return_value = self.fake_snaps
+        fake_scan_inventory.return_value = [self.fake_vm]
         reaper.reap_snapshots(vcenter=self.vcenter, logger=self.logger)
 
         self.assertTrue(fake_consume_task.called)
 
+    @patch.object(reaper, 'scan_inventory')
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper, '_iter_snapshots')
+    def test_returns_stats(self, fake_iter_snapshots, fake_consume_task, fake_scan_inventory):
+        """``reap_snapshots`` returns the deletion stats for the pass"""
+        fake_iter_snapshots.return_value = self.fake_snaps
+        fake_scan_inventory.return_value = [self.fake_vm]
+        stats = reaper.reap_snapshots(vcenter=self.vcenter, logger=self.logger)
+
+        self.assertEqual(stats['deleted'], 1)
+
+    @patch.object(reaper, 'scan_inventory')
     @patch.object(reaper, 'consume_task')
-    @patch.object(reaper, '_get_snapshots')
-    def test_no_delete(self, fake_get_snapshots, fake_consume_task):
+    @patch.object(reaper, '_iter_snapshots')
+    def test_no_delete(self, fake_iter_snapshots, fake_consume_task, fake_scan_inventory):
         """``reap_snapshots`` does not delete snapshots that are still valid"""
-        self.fake_snap.name = 'aabbcc_1234_999999999999999999'
-        fake_get_snapshots.return_value = self.fake_snaps
+        self.fake_snap.expires = 999999999999999999
+        fake_iter_snapshots.return_value = self.fake_snaps
+        fake_scan_inventory.return_value = [self.fake_vm]
         reaper.reap_snapshots(vcenter=self.vcenter, logger=self.logger)
 
         self.assertFalse(fake_consume_task.called)
 
+    @patch.object(reaper, 'scan_inventory')
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper, '_iter_snapshots')
+    def test_schedules(self, fake_iter_snapshots, fake_consume_task, fake_scan_inventory):
+        """``reap_snapshots`` schedules the snapshots that have not expired"""
+        self.fake_snap.expires = 999999999999999999
+        fake_iter_snapshots.return_value = self.fake_snaps
+        fake_scan_inventory.return_value = [self.fake_vm]
+        schedule = reaper.ExpirySchedule()
+        reaper.reap_snapshots(vcenter=self.vcenter, logger=self.logger, schedule=schedule)
+
+        self.assertEqual(schedule.next_deadline(), 999999999999999999)
+
+    @patch.object(reaper, 'scan_inventory')
+    @patch.object(reaper, 'consume_task')
+    def test_no_snapshots(self, fake_consume_task, fake_scan_inventory):
+        """``reap_snapshots`` handles VMs that have no snapshots"""
+        fake_scan_inventory.return_value = [make_vm('vm-1', 'host-1', ['ds-1'])]
+        reaper.reap_snapshots(vcenter=self.vcenter, logger=self.logger)
+
+        self.assertFalse(fake_consume_task.called)
+
+
+class TestReapDue(unittest.TestCase):
+    """A suite of test cases for the ``reap_due`` function"""
+    @patch.object(reaper, 'rebind')
+    @patch.object(reaper, 'consume_task')
+    def test_reap_due(self, fake_consume_task, fake_rebind):
+        """``reap_due`` deletes the scheduled snapshots that have expired"""
+        logger = MagicMock()
+        executor = reaper.DeletionExecutor(logger)
+        schedule = reaper.ExpirySchedule()
+        vm = make_vm('vm-1', 'host-1', ['ds-1'])
+        expired = MagicMock()
+        expired.name = 'aaa_1_1'
+        not_expired = MagicMock()
+        not_expired.name = 'bbb_1_999999999999999999'
+        schedule.add(1, vm, expired)
+        schedule.add(999999999999999999, vm, not_expired)
+
+        stats = reaper.reap_due(MagicMock(), logger, executor, schedule)
+        executor.shutdown()
+
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(len(schedule), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """A suite of test cases for the metrics the reaper records"""
+    @patch.object(reaper, 'consume_task')
+    def test_deletions(self, fake_consume_task):
+        """``DeletionExecutor`` counts deletions, and times them"""
+        fake_consume_task.side_effect = [None, RuntimeError('testing')]
+        ok_before = reaper.DELETIONS.value('ok')
+        failed_before = reaper.DELETIONS.value('failed')
+        timed_before = reaper.DELETION_SECONDS.value()
+        executor = reaper.DeletionExecutor(MagicMock(), max_workers=1)
+        vm = make_vm('vm-1', 'host-1', ['ds-1'])
+
+        executor.submit(vm, MagicMock())
+        executor.submit(vm, MagicMock())
+        executor.shutdown()
+
+        self.assertEqual(reaper.DELETIONS.value('ok'), ok_before + 1)
+        self.assertEqual(reaper.DELETIONS.value('failed'), failed_before + 1)
+        self.assertEqual(reaper.DELETION_SECONDS.value(), timed_before + 2)
+        self.assertEqual(reaper.BACKLOG.value(), 0)
+
+    def test_examined(self):
+        """``_reap_vm`` counts the VMs and snapshots it checks"""
+        vms_before = reaper.VMS_EXAMINED.value()
+        snaps_before = reaper.SNAPSHOTS_EXAMINED.value()
+        vm = make_vm('vm-1', 'host-1', ['ds-1'])
+        vm['snapshot.rootSnapshotList'] = make_snapshot_tree('aaa_1_999999999999')
+
+        reaper._reap_vm(vm, MagicMock(), MagicMock(), reaper.ExpirySchedule())
+
+        self.assertEqual(reaper.VMS_EXAMINED.value(), vms_before + 1)
+        self.assertEqual(reaper.SNAPSHOTS_EXAMINED.value(), snaps_before + 1)
+
+    def test_record_pass(self):
+        """``record_pass`` updates the scan duration, deletions and schedule size"""
+        before = reaper.SCAN_SECONDS.value('due')
+        schedule = reaper.ExpirySchedule()
+
+        reaper.record_pass('due', 10, 15, {'deleted': 3}, schedule)
+
+        self.assertEqual(reaper.SCAN_SECONDS.value('due'), before + 1)
+        self.assertEqual(reaper.SCHEDULED.value(), 0)
+        self.assertEqual(reaper.LAST_PASS.value(), 15)
+
+
+class TestWatch(unittest.TestCase):
+    """A suite of test cases for the ``watch`` function"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.logger = MagicMock()
+        cls.collector = FakePropertyCollector()
+
+    def run_watch(self):
+        """Run ``watch`` against the fake PropertyCollector until it runs out of updates"""
+        with patch.object(reaper, 'vCenter') as fake_vCenter, patch.object(reaper, 'get_resolver') as fake_get_resolver:
+            vcenter = fake_vCenter.return_value.__enter__.return_value
+            vcenter.content.propertyCollector = self.collector
+            fake_get_resolver.return_value.users_folder.return_value = vim.Folder('group-v1')
+            reaper.watch(self.logger)
+
+    @patch.object(reaper, 'consume_task')
+    def test_watch_expired(self, fake_consume_task):
+        """``watch`` deletes expired snapshots reported by vCenter"""
+        self.collector.enter('vm-1', name='myVM', parent=vim.Folder('group-v2', stub=MagicMock()),
+                             **{'snapshot.rootSnapshotList': make_snapshot_tree('aaa_1_1')})
+        self.collector.emit()
+
+        self.run_watch()
+
+        self.assertEqual(fake_consume_task.call_count, 1)
+
+    @patch.object(reaper, 'consume_task')
+    def test_watch_new_snapshot(self, fake_consume_task):
+        """``watch`` schedules new snapshots without rescanning"""
+        self.collector.enter('vm-1', name='myVM', parent=vim.Folder('group-v2', stub=MagicMock()))
+        self.collector.emit()
+        self.collector.modify('vm-1', **{'snapshot.rootSnapshotList': make_snapshot_tree('aaa_1_999999999999')})
+        self.collector.emit()
+
+        with patch.object(reaper, 'ExpirySchedule') as fake_ExpirySchedule:
+            fake_ExpirySchedule.return_value.sleep_time.return_value = 0
+            fake_ExpirySchedule.return_value.due.return_value = []
+            self.run_watch()
+            the_args, _ = fake_ExpirySchedule.return_value.add.call_args
+
+        self.assertEqual(the_args[0], 999999999999)
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(reaper, 'consume_task')
+    def test_watch_stops(self, fake_consume_task):
+        """``watch`` destroys the PropertyCollector and logs the error when something breaks"""
+        self.run_watch()
+
+        self.assertTrue(self.collector.destroyed)
+        self.assertTrue(self.logger.exception.called)
+
 
 class TestMain(unittest.TestCase):
     """A suite of test cases for the ``main`` function"""
@@ -76,11 +443,14 @@ class TestMain(unittest.TestCase):
     def setUp(cls):
         """Runs before every test case"""
         cls.logger = MagicMock()
+        cls.serve_patcher = patch.object(reaper.metrics, 'serve')
+        cls.fake_serve = cls.serve_patcher.start()
 
     @classmethod
     def tearDown(cls):
         """Runs after every test case"""
         cls.logger = None
+        cls.serve_patcher.stop()
 
     @patch.object(reaper, 'reap_snapshots')
     @patch.object(reaper, 'vCenter')
@@ -89,11 +459,53 @@ class TestMain(unittest.TestCase):
         """``main`` sleeps in between loops"""
         # the RuntimeError is how we break out of the while loop of the serivce
         fake_time.time.side_effect = [1, 2, RuntimeError('break from loop')]
+        fake_reap_snapshots.return_value = {'deleted': 0, 'failed': 0, 'seconds': 0, 'per_second': 0}
 
         reaper.main(self.logger)
 
         self.assertEqual(fake_time.sleep.call_count, 1)
 
+    @patch.object(reaper, 'reap_due')
+    @patch.object(reaper, 'reap_snapshots')
+    @patch.object(reaper, 'vCenter')
+    @patch.object(reaper, 'time')
+    def test_main_between_scans(self, fake_time, fake_vCenter, fake_reap_snapshots, fake_reap_due):
+        """``main`` only deletes the scheduled snapshots in between full scans"""
+        fake_time.time.side_effect = [1, 2, 3, 4, RuntimeError('break from loop')]
+        stats = {'deleted': 0, 'failed': 0, 'seconds': 0, 'per_second': 0}
+        fake_reap_snapshots.return_value = stats
+        fake_reap_due.return_value = stats
+
+        reaper.main(self.logger)
+
+        self.assertEqual(fake_reap_snapshots.call_count, 1)
+        self.assertEqual(fake_reap_due.call_count, 1)
+
+    @patch.object(reaper, 'reap_snapshots')
+    @patch.object(reaper, 'vCenter')
+    @patch.object(reaper, 'time')
+    def test_main_metrics(self, fake_time, fake_vCenter, fake_reap_snapshots):
+        """``main`` serves the metrics, and records every pass"""
+        fake_time.time.side_effect = [1, 3, RuntimeError('break from loop')]
+        fake_reap_snapshots.return_value = {'deleted': 2, 'failed': 0, 'seconds': 0, 'per_second': 0}
+        before = reaper.SCAN_SECONDS.value('full')
+
+        reaper.main(self.logger)
+
+        self.assertTrue(self.fake_serve.called)
+        self.assertEqual(reaper.SCAN_SECONDS.value('full'), before + 1)
+        self.assertEqual(reaper.LAST_PASS.value(), 3)
+
+    @patch.object(reaper, 'watch')
+    @patch.object(reaper, 'const')
+    def test_main_watch(self, fake_const, fake_watch):
+        """``main`` runs in watch mode when VLAB_REAPER_WATCH is set"""
+        fake_const.VLAB_REAPER_WATCH = True
+
+        reaper.main(self.logger)
+
+        self.assertTrue(fake_watch.called)
+
     @patch.object(reaper, 'reap_snapshots')
     @patch.object(reaper, 'vCenter')
     @patch.object(reaper, 'time')
@@ -0,0 +1,62 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``records.py`` module"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_snapshot_api.lib.worker import records
+
+
+class TestCodec(unittest.TestCase):
+    """A suite of test cases for encoding, and decoding snapshot names"""
+    def test_round_trip(self):
+        """``decode_name`` parses what ``encode_name`` creates"""
+        name = records.encode_name('aabbcc', 1234, 4321)
+
+        self.assertEqual(records.decode_name(name), ('aabbcc', 1234, 4321))
+
+    def test_decode_foreign(self):
+        """``decode_name`` returns None for names vLab did not create"""
+        self.assertTrue(records.decode_name('before upgrade') is None)
+
+    def test_decode_not_numbers(self):
+        """``decode_name`` returns None when the timestamps are not numbers"""
+        self.assertTrue(records.decode_name('my_old_snap') is None)
+
+    def test_decode_none(self):
+        """``decode_name`` handles snapshots without a name"""
+        self.assertTrue(records.decode_name(None) is None)
+
+
+class TestFromTree(unittest.TestCase):
+    """A suite of test cases for the ``from_tree`` function"""
+    def test_from_tree(self):
+        """``from_tree`` keeps the parsed name, description, and managed object"""
+        snap = MagicMock()
+        snap.name = 'aabbcc_1234_4321'
+        snap.description = 'group=lab'
+
+        record = records.from_tree(snap)
+
+        self.assertEqual(record.id, 'aabbcc')
+        self.assertEqual(record.created, 1234)
+        self.assertEqual(record.expires, 4321)
+        self.assertEqual(record.description, 'group=lab')
+        self.assertTrue(record.snapshot is snap.snapshot)
+
+    def test_from_tree_foreign(self):
+        """``from_tree`` returns None for snapshots vLab did not take"""
+        snap = MagicMock()
+        snap.name = 'before upgrade'
+
+        self.assertTrue(records.from_tree(snap) is None)
+
+    def test_slots(self):
+        """``SnapshotRecord`` has no per-instance dictionary"""
+        record = records.SnapshotRecord('aabbcc', 1234, 4321, 'aabbcc_1234_4321')
+
+        with self.assertRaises(AttributeError):
+            record.other = True
+
+
+if __name__ == '__main__':
+    unittest.main()
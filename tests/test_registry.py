@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``registry.py`` module"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_snapshot_api.lib import registry
+
+
+class TestLocalRegistry(unittest.TestCase):
+    """A suite of test cases for the ``LocalRegistry`` object"""
+    def test_get(self):
+        """``LocalRegistry.get`` returns what was set"""
+        the_registry = registry.LocalRegistry()
+        the_registry.set('foo', 'bar', 10)
+
+        self.assertEqual(the_registry.get('foo'), 'bar')
+
+    def test_get_missing(self):
+        """``LocalRegistry.get`` returns None for keys that were never set"""
+        the_registry = registry.LocalRegistry()
+
+        self.assertTrue(the_registry.get('foo') is None)
+
+    @patch.object(registry.time, 'time')
+    def test_get_expired(self, fake_time):
+        """``LocalRegistry.get`` returns None once the TTL has passed"""
+        fake_time.return_value = 100
+        the_registry = registry.LocalRegistry()
+        the_registry.set('foo', 'bar', 10)
+        fake_time.return_value = 111
+
+        self.assertTrue(the_registry.get('foo') is None)
+
+    def test_counter(self):
+        """``LocalRegistry.incr`` adds one to the counter"""
+        the_registry = registry.LocalRegistry()
+        the_registry.incr('hits')
+        the_registry.incr('hits')
+
+        self.assertEqual(the_registry.counter('hits'), 2)
+        self.assertEqual(the_registry.counter('misses'), 0)
+
+
+@patch.object(registry, 'uwsgi')
+class TestUwsgiRegistry(unittest.TestCase):
+    """A suite of test cases for the ``UwsgiRegistry`` object"""
+    def test_get(self, fake_uwsgi):
+        """``UwsgiRegistry.get`` decodes the bytes stored in the cache"""
+        fake_uwsgi.cache_get.return_value = b'bar'
+        the_registry = registry.UwsgiRegistry('snapshot')
+
+        self.assertEqual(the_registry.get('foo'), 'bar')
+        fake_uwsgi.cache_get.assert_called_with('foo', 'snapshot')
+
+    def test_get_missing(self, fake_uwsgi):
+        """``UwsgiRegistry.get`` returns None when the key is not in the cache"""
+        fake_uwsgi.cache_get.return_value = None
+        the_registry = registry.UwsgiRegistry('snapshot')
+
+        self.assertTrue(the_registry.get('foo') is None)
+
+    def test_set(self, fake_uwsgi):
+        """``UwsgiRegistry.set`` stores bytes, with an expiration"""
+        the_registry = registry.UwsgiRegistry('snapshot')
+
+        the_registry.set('foo', 'bar', 10)
+
+        fake_uwsgi.cache_update.assert_called_with('foo', b'bar', 10, 'snapshot')
+
+
+class TestGetRegistry(unittest.TestCase):
+    """A suite of test cases for the ``get_registry`` function"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        registry._REGISTRY = None
+
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        registry._REGISTRY = None
+
+    @patch.object(registry, 'uwsgi', None)
+    def test_local(self):
+        """``get_registry`` uses a LocalRegistry when not running under uWSGI"""
+        self.assertTrue(isinstance(registry.get_registry(), registry.LocalRegistry))
+
+    @patch.object(registry, 'uwsgi', MagicMock())
+    def test_uwsgi(self):
+        """``get_registry`` uses the uWSGI cache when running under uWSGI"""
+        self.assertTrue(isinstance(registry.get_registry(), registry.UwsgiRegistry))
+
+
+if __name__ == '__main__':
+    unittest.main()
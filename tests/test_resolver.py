@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``resolver.py`` module"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from pyVmomi import vim, vmodl
+
+from vlab_snapshot_api.lib.worker import resolver
+
+
+class TestTTLCache(unittest.TestCase):
+    """A suite of test cases for the ``TTLCache`` object"""
+    def test_get(self):
+        """``TTLCache.get`` returns what was put"""
+        cache = resolver.TTLCache(ttl=60, max_entries=10)
+        cache.put('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_get_miss(self):
+        """``TTLCache.get`` returns None for unknown keys"""
+        cache = resolver.TTLCache(ttl=60, max_entries=10)
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.misses, 1)
+
+    @patch.object(resolver.time, 'time')
+    def test_expires(self, fake_time):
+        """``TTLCache.get`` does not return entries older than the TTL"""
+        fake_time.return_value = 100
+        cache = resolver.TTLCache(ttl=60, max_entries=10)
+        cache.put('a', 1)
+        fake_time.return_value = 161
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_evicts_lru(self):
+        """``TTLCache.put`` evicts the least recently used entry when full"""
+        cache = resolver.TTLCache(ttl=60, max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.evictions, 1)
+
+
+class TestResolver(unittest.TestCase):
+    """A suite of test cases for the ``Resolver`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.vcenter = MagicMock()
+        cls.search_index = cls.vcenter.content.searchIndex
+        datacenter = MagicMock()
+        datacenter.name = 'dc1'
+        cls.vcenter.content.rootFolder.childEntity = [datacenter]
+        cls.search_index.FindByInventoryPath.return_value = vim.Folder('group-v1')
+        cls.resolver = resolver.Resolver(ttl=60, max_entries=10)
+
+    def test_users_folder(self):
+        """``Resolver.users_folder`` finds the folder by inventory path"""
+        folder = self.resolver.users_folder(self.vcenter)
+
+        self.assertEqual(folder._moId, 'group-v1')
+        self.search_index.FindByInventoryPath.assert_called_with('dc1/vm/{}'.format(resolver.const.INF_VCENTER_USERS_DIR))
+
+    def test_users_folder_cached(self):
+        """``Resolver.users_folder`` only searches vCenter once"""
+        self.resolver.users_folder(self.vcenter)
+        self.resolver.users_folder(self.vcenter)
+
+        self.assertEqual(self.search_index.FindByInventoryPath.call_count, 1)
+
+    def test_users_folder_fallback(self):
+        """``Resolver.users_folder`` searches the whole inventory if the path does not exist"""
+        self.search_index.FindByInventoryPath.return_value = None
+        self.vcenter.get_by_name.return_value = vim.Folder('group-v9')
+
+        folder = self.resolver.users_folder(self.vcenter)
+
+        self.assertEqual(folder._moId, 'group-v9')
+
+    def test_user_folder(self):
+        """``Resolver.user_folder`` looks up the user's folder in the users folder"""
+        self.search_index.FindChild.return_value = vim.Folder('group-v2')
+
+        folder = self.resolver.user_folder(self.vcenter, 'alice')
+        _, the_kwargs = self.search_index.FindChild.call_args
+
+        self.assertEqual(folder._moId, 'group-v2')
+        self.assertEqual(the_kwargs['name'], 'alice')
+        self.assertEqual(the_kwargs['entity']._moId, 'group-v1')
+
+    def test_user_folder_missing(self):
+        """``Resolver.user_folder`` raises ValueError if the user has no folder"""
+        self.search_index.FindChild.return_value = None
+
+        with self.assertRaises(ValueError):
+            self.resolver.user_folder(self.vcenter, 'alice')
+
+    def test_user_folder_stale_parent(self):
+        """``Resolver.user_folder`` looks up the users folder again when its moid is stale"""
+        self.resolver.users_folder(self.vcenter)
+        self.search_index.FindChild.side_effect = [vmodl.fault.ManagedObjectNotFound(), vim.Folder('group-v2')]
+
+        folder = self.resolver.user_folder(self.vcenter, 'alice')
+
+        self.assertEqual(folder._moId, 'group-v2')
+        self.assertEqual(self.search_index.FindByInventoryPath.call_count, 2)
+
+    def test_with_user_folder(self):
+        """``Resolver.with_user_folder`` calls the function with the user's folder"""
+        self.search_index.FindChild.return_value = vim.Folder('group-v2')
+
+        found = self.resolver.with_user_folder(self.vcenter, 'alice', lambda folder: folder._moId)
+
+        self.assertEqual(found, 'group-v2')
+
+    def test_with_user_folder_stale(self):
+        """``Resolver.with_user_folder`` looks up the folder again, and retries, when the cached moid is stale"""
+        self.search_index.FindChild.side_effect = [vim.Folder('group-v2'), vim.Folder('group-v3')]
+        self.resolver.user_folder(self.vcenter, 'alice')
+        func = MagicMock(side_effect=[vmodl.fault.ManagedObjectNotFound(), 'worked'])
+
+        found = self.resolver.with_user_folder(self.vcenter, 'alice', func)
+        the_args, _ = func.call_args
+
+        self.assertEqual(found, 'worked')
+        self.assertEqual(the_args[0]._moId, 'group-v3')
+        self.assertEqual(self.resolver.stats()['invalidations'], 1)
+
+    @patch.object(resolver.Resolver, '_is_current')
+    def test_vm(self, fake_is_current):
+        """``Resolver.vm`` finds the VM, and remembers it"""
+        fake_is_current.return_value = True
+        self.search_index.FindChild.side_effect = [vim.Folder('group-v2'), vim.VirtualMachine('vm-1')]
+
+        first = self.resolver.vm(self.vcenter, 'alice', 'myVM')
+        second = self.resolver.vm(self.vcenter, 'alice', 'myVM')
+
+        self.assertEqual(first._moId, 'vm-1')
+        self.assertEqual(second._moId, 'vm-1')
+        self.assertEqual(self.search_index.FindChild.call_count, 2)
+
+    @patch.object(resolver.Resolver, '_is_current')
+    def test_vm_stale(self, fake_is_current):
+        """``Resolver.vm`` looks up the VM again when the cached moid is stale"""
+        fake_is_current.return_value = False
+        self.search_index.FindChild.side_effect = [vim.Folder('group-v2'),
+                                                   vim.VirtualMachine('vm-1'),
+                                                   vim.VirtualMachine('vm-2')]
+
+        self.resolver.vm(self.vcenter, 'alice', 'myVM')
+        the_vm = self.resolver.vm(self.vcenter, 'alice', 'myVM')
+
+        self.assertEqual(the_vm._moId, 'vm-2')
+        self.assertEqual(self.resolver.stats()['invalidations'], 1)
+
+    def test_vm_missing(self):
+        """``Resolver.vm`` returns None when the user has no such VM"""
+        self.search_index.FindChild.side_effect = [vim.Folder('group-v2'), None]
+
+        the_vm = self.resolver.vm(self.vcenter, 'alice', 'myVM')
+
+        self.assertTrue(the_vm is None)
+
+    def test_vm_not_a_vm(self):
+        """``Resolver.vm`` returns None when the name belongs to something other than a VM"""
+        self.search_index.FindChild.side_effect = [vim.Folder('group-v2'), vim.Folder('group-v3')]
+
+        the_vm = self.resolver.vm(self.vcenter, 'alice', 'myVM')
+
+        self.assertTrue(the_vm is None)
+
+    def test_is_current_deleted(self):
+        """``Resolver._is_current`` returns False for VMs that no longer exist"""
+        the_vm = MagicMock()
+        type(the_vm).name = property(MagicMock(side_effect=vmodl.fault.ManagedObjectNotFound()))
+
+        self.assertFalse(resolver.Resolver._is_current(the_vm, 'myVM'))
+
+
+class TestRebind(unittest.TestCase):
+    """A suite of test cases for the ``rebind`` function"""
+    def test_rebind(self):
+        """``rebind`` keeps the moid, but uses the new session"""
+        vcenter = MagicMock()
+
+        moref = resolver.rebind(vcenter, vim.VirtualMachine('vm-1'))
+
+        self.assertEqual(moref._moId, 'vm-1')
+        self.assertTrue(moref._stub is vcenter._conn._stub)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``session_pool.py`` module"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_snapshot_api.lib.worker import session_pool
+
+
+class TestSessionPool(unittest.TestCase):
+    """A suite of test cases for the ``SessionPool`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.factory = MagicMock()
+        cls.factory.side_effect = lambda: MagicMock()
+        cls.pool = session_pool.SessionPool(max_sessions=2, keep_alive=60, factory=cls.factory)
+
+    def test_borrow_reuses(self):
+        """``SessionPool.borrow`` reuses a returned session instead of logging in again"""
+        with self.pool.borrow() as vcenter1:
+            pass
+        with self.pool.borrow() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_borrow_counters(self):
+        """``SessionPool.borrow`` counts pool hits and misses"""
+        with self.pool.borrow():
+            pass
+        with self.pool.borrow():
+            pass
+
+        stats = self.pool.stats()
+
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_borrow_concurrent(self):
+        """``SessionPool.borrow`` opens a new session when all existing ones are in use"""
+        with self.pool.borrow() as vcenter1:
+            with self.pool.borrow() as vcenter2:
+                pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+
+    def test_borrow_cap(self):
+        """``SessionPool.borrow`` never opens more than ``max_sessions``"""
+        with self.pool.borrow():
+            with self.pool.borrow():
+                acquired = self.pool._slots.acquire(blocking=False)
+
+        self.assertFalse(acquired)
+
+    @patch.object(session_pool.time, 'time')
+    def test_relogin(self, fake_time):
+        """``SessionPool.borrow`` logs in again when an idle session has expired"""
+        fake_time.return_value = 100
+        with self.pool.borrow() as vcenter1:
+            vcenter1.content.sessionManager.currentSession = None
+        fake_time.return_value = 1000
+        with self.pool.borrow() as vcenter2:
+            pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertEqual(self.pool.stats()['relogins'], 1)
+        self.assertTrue(vcenter1.close.called)
+
+    def test_not_authenticated(self):
+        """``SessionPool.borrow`` throws away sessions that raise NotAuthenticated"""
+        with self.assertRaises(session_pool.vim.fault.NotAuthenticated):
+            with self.pool.borrow() as vcenter:
+                raise session_pool.vim.fault.NotAuthenticated()
+
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertTrue(vcenter.close.called)
+
+    def test_other_errors(self):
+        """``SessionPool.borrow`` returns the session to the pool for non-auth errors"""
+        with self.assertRaises(RuntimeError):
+            with self.pool.borrow():
+                raise RuntimeError('testing')
+
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_ping(self):
+        """``SessionPool.ping`` discards expired sessions"""
+        with self.pool.borrow() as vcenter1:
+            with self.pool.borrow() as vcenter2:
+                vcenter2.content.sessionManager.currentSession = None
+
+        self.pool.ping()
+
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        self.assertTrue(vcenter2.close.called)
+
+    def test_close(self):
+        """``SessionPool.close`` logs out of every idle session"""
+        with self.pool.borrow() as vcenter:
+            pass
+
+        self.pool.close()
+
+        self.assertTrue(vcenter.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+
+class TestGetPool(unittest.TestCase):
+    """A suite of test cases for the ``get_pool`` function"""
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        session_pool._POOL = None
+
+    @patch.object(session_pool.SessionPool, 'start_keep_alive')
+    def test_get_pool(self, fake_start_keep_alive):
+        """``get_pool`` returns the same pool on every call"""
+        pool1 = session_pool.get_pool()
+        pool2 = session_pool.get_pool()
+
+        self.assertTrue(pool1 is pool2)
+
+    @patch.object(session_pool.SessionPool, 'start_keep_alive')
+    def test_init_pool(self, fake_start_keep_alive):
+        """``init_pool`` replaces the pool inherited from a parent process"""
+        pool1 = session_pool.get_pool()
+        pool2 = session_pool.init_pool()
+
+        self.assertFalse(pool1 is pool2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,20 @@
 """
 A suite of tests for the snapshot object
 """
+import itertools
 import unittest
-from unittest.mock import patch, MagicMock
+import threading
+from datetime import datetime
+from unittest.mock import patch, MagicMock, PropertyMock
 
 import ujson
+from celery import Celery
 from flask import Flask
 from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 
+from vlab_snapshot_api.lib import registry
 from vlab_snapshot_api.lib.views import snapshot
 
 
@@ -30,9 +35,18 @@ class TestSnapshotView(unittest.TestCase):
         cls.app = app.test_client()
         # Mock Celery
         app.celery_app = MagicMock()
+        cls.fake_celery_app = app.celery_app
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        # a fresh registry, so tests don't reuse each other's snapshot.show tasks
+        cls.registry = registry.LocalRegistry()
+        patch.object(snapshot, 'get_registry', return_value=cls.registry).start()
+
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        patch.stopall()
 
     def test_get_task(self):
         """SnapshotView - GET on /api/1/inf/snapshot returns a task-id"""
@@ -54,6 +68,16 @@ class TestSnapshotView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_fingerprint(self):
+        """SnapshotView - GET on /api/1/inf/snapshot sends the fingerprint param to the worker"""
+        self.app.get('/api/1/inf/snapshot?fingerprint=aabbccdd',
+                     headers={'X-Auth': self.token})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+        sent_fingerprint = the_args[1][2]
+
+        self.assertEqual(sent_fingerprint, 'aabbccdd')
+
     def test_post_task(self):
         """SnapshotView - POST on /api/1/inf/snapshot returns a task-id"""
         resp = self.app.post('/api/1/inf/snapshot',
@@ -80,6 +104,196 @@ class TestSnapshotView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_queue(self):
+        """SnapshotView - GET on /api/1/inf/snapshot sends to the read queue"""
+        self.app.get('/api/1/inf/snapshot',
+                     headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_kwargs['queue'], snapshot.const.VLAB_QUEUE_READ)
+
+    def test_post_queue(self):
+        """SnapshotView - POST on /api/1/inf/snapshot sends to the write queue"""
+        self.app.post('/api/1/inf/snapshot',
+                      headers={'X-Auth': self.token},
+                      json={'name': 'vm1'})
+
+        _, the_kwargs = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_kwargs['queue'], snapshot.const.VLAB_QUEUE_WRITE)
+
+    def test_get_coalesce(self):
+        """SnapshotView - GET on /api/1/inf/snapshot reuses a recent snapshot.show task"""
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = False
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+        resp = self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_celery_app.send_task.call_count, 1)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+        self.assertEqual(self.registry.counter('show_hits'), 1)
+
+    def test_get_coalesce_fingerprint(self):
+        """SnapshotView - GET on /api/1/inf/snapshot does not share tasks across fingerprints"""
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = False
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+        self.app.get('/api/1/inf/snapshot?fingerprint=aabbccdd', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_celery_app.send_task.call_count, 2)
+
+    def test_get_coalesce_other_process(self):
+        """SnapshotView - GET on /api/1/inf/snapshot reuses a snapshot.show task sent by another API process"""
+        # what another process leaves in the shared registry
+        self.registry.set('show:bob:', 'other-task', 60)
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = False
+
+        resp = self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['content']['task-id'], 'other-task')
+        self.assertFalse(self.fake_celery_app.send_task.called)
+
+    @patch.object(snapshot.time, 'time')
+    def test_get_coalesce_fresh(self, fake_time):
+        """SnapshotView - GET on /api/1/inf/snapshot reuses a snapshot.show task that finished just now"""
+        fake_time.return_value = 100
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+        # a slow task; sent a while ago, but only just done
+        fake_time.return_value = 100 + snapshot.const.VLAB_SHOW_FRESH + 1
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = True
+        self.fake_celery_app.AsyncResult.return_value.date_done = datetime.utcfromtimestamp(fake_time.return_value - 1)
+
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_celery_app.send_task.call_count, 1)
+
+    @patch.object(snapshot.time, 'time')
+    def test_get_coalesce_fresh_iso(self, fake_time):
+        """SnapshotView - GET on /api/1/inf/snapshot reads the finish time of a snapshot.show task as a string"""
+        fake_time.return_value = 1000
+        self.registry.set('show:bob:', 'other-task', 60)
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = True
+        self.fake_celery_app.AsyncResult.return_value.date_done = datetime.utcfromtimestamp(999).isoformat()
+
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertFalse(self.fake_celery_app.send_task.called)
+
+    @patch.object(snapshot.time, 'time')
+    def test_get_coalesce_in_flight(self, fake_time):
+        """SnapshotView - GET on /api/1/inf/snapshot reuses a snapshot.show task that is still running"""
+        fake_time.return_value = 100
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+        fake_time.return_value = 100 + snapshot.const.VLAB_SHOW_FRESH + 1
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = False
+
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_celery_app.send_task.call_count, 1)
+
+    @patch.object(snapshot.time, 'time')
+    def test_get_coalesce_stale(self, fake_time):
+        """SnapshotView - GET on /api/1/inf/snapshot does not reuse a snapshot.show task that finished a while ago"""
+        fake_time.return_value = 100
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+        fake_time.return_value = 100 + snapshot.const.VLAB_SHOW_FRESH + 1
+        self.fake_celery_app.AsyncResult.return_value.ready.return_value = True
+        self.fake_celery_app.AsyncResult.return_value.date_done = datetime.utcfromtimestamp(100)
+
+        self.app.get('/api/1/inf/snapshot', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_celery_app.send_task.call_count, 2)
+        self.assertEqual(self.registry.counter('show_misses'), 2)
+
+    def test_post_many(self):
+        """SnapshotView - POST on /api/1/inf/snapshot with a list of names snapshots many VMs in one task"""
+        self.app.post('/api/1/inf/snapshot',
+                      headers={'X-Auth': self.token},
+                      json={'name': ['vm1', 'vm2']})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_args[0], 'snapshot.create_many')
+        self.assertEqual(the_args[1][1], ['vm1', 'vm2'])
+
+    def test_post_mode(self):
+        """SnapshotView - POST on /api/1/inf/snapshot passes the snapshot mode to the task"""
+        self.app.post('/api/1/inf/snapshot',
+                      headers={'X-Auth': self.token},
+                      json={'name': 'vm1', 'mode': 'crash'})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_args[1][-1], 'crash')
+
+    def test_post_mode_default(self):
+        """SnapshotView - POST on /api/1/inf/snapshot takes a memory snapshot by default"""
+        self.app.post('/api/1/inf/snapshot',
+                      headers={'X-Auth': self.token},
+                      json={'name': 'vm1'})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_args[1][-1], 'memory')
+
+    def test_post_mode_bad(self):
+        """SnapshotView - POST on /api/1/inf/snapshot rejects unknown snapshot modes"""
+        resp = self.app.post('/api/1/inf/snapshot',
+                             headers={'X-Auth': self.token},
+                             json={'name': 'vm1', 'mode': 'turbo'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_post_many_empty(self):
+        """SnapshotView - POST on /api/1/inf/snapshot requires at least one name"""
+        resp = self.app.post('/api/1/inf/snapshot',
+                             headers={'X-Auth': self.token},
+                             json={'name': []})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_delete_many(self):
+        """SnapshotView - DELETE on /api/1/inf/snapshot with 'snapshots' deletes many in one task"""
+        self.app.delete('/api/1/inf/snapshot',
+                        headers={'X-Auth': self.token},
+                        json={'snapshots': [{'name' : 'SomeVM', 'id': '1234ad'},
+                                            {'name' : 'OtherVM', 'id': 'ad1234'}]})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(the_args[0], 'snapshot.delete_many')
+        self.assertEqual(len(the_args[1][1]), 2)
+
+    def test_delete_bad_body(self):
+        """SnapshotView - DELETE on /api/1/inf/snapshot requires 'name' and 'id', or 'snapshots'"""
+        resp = self.app.delete('/api/1/inf/snapshot',
+                               headers={'X-Auth': self.token},
+                               json={'name' : 'SomeVM'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_checkpoint(self):
+        """SnapshotView - POST on /api/1/inf/snapshot/lab checkpoints the whole lab"""
+        resp = self.app.post('/api/1/inf/snapshot/lab',
+                             headers={'X-Auth': self.token},
+                             json={})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args[0], 'snapshot.checkpoint')
+
+    def test_revert(self):
+        """SnapshotView - PUT on /api/1/inf/snapshot/lab reverts the whole lab"""
+        resp = self.app.put('/api/1/inf/snapshot/lab',
+                            headers={'X-Auth': self.token},
+                            json={'id': 'aaa'})
+
+        the_args, _ = self.fake_celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args[0], 'snapshot.revert')
+        self.assertEqual(the_args[1][1], 'aaa')
+
     def test_delete_task(self):
         """SnapshotView - DELETE on /api/1/inf/snapshot returns a task-id"""
         resp = self.app.delete('/api/1/inf/snapshot',
@@ -125,6 +339,129 @@ class TestSnapshotView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(snapshot.time, 'sleep')
+    def test_task_wait(self, fake_sleep):
+        """SnapshotView - GET on /api/1/inf/snapshot/task supports waiting for the task to finish"""
+        result = self.fake_celery_app.AsyncResult.return_value
+        result.ready.side_effect = [False, False, True]
+        result.status = 'SUCCESS'
+        result.result = {'error': None, 'content': {}, 'params': {}}
+
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf?wait=5',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(fake_sleep.call_count, 2)
+
+    @patch.object(snapshot.time, 'sleep')
+    @patch.object(snapshot.time, 'time')
+    def test_task_wait_timeout(self, fake_time, fake_sleep):
+        """SnapshotView - GET on /api/1/inf/snapshot/task stops waiting once the timeout passes"""
+        fake_time.side_effect = itertools.count(100, 2)
+        result = self.fake_celery_app.AsyncResult.return_value
+        result.ready.return_value = False
+        result.status = 'PENDING'
+
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf?wait=5',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(fake_sleep.called)
+
+    @patch.object(snapshot.time, 'sleep')
+    def test_task_no_wait(self, fake_sleep):
+        """SnapshotView - GET on /api/1/inf/snapshot/task does not wait by default"""
+        result = self.fake_celery_app.AsyncResult.return_value
+        result.ready.return_value = False
+        result.status = 'PENDING'
+
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertFalse(fake_sleep.called)
+
+    @patch.object(snapshot.time, 'sleep')
+    def test_stream_task(self, fake_sleep):
+        """SnapshotView - GET on /api/1/inf/snapshot/task/<id>/stream relays progress, then the result"""
+        result = self.fake_celery_app.AsyncResult.return_value
+        result.ready.side_effect = [False, False, True]
+        type(result).status = PropertyMock(side_effect=['PROGRESS', 'PROGRESS', 'SUCCESS', 'SUCCESS'])
+        type(result).info = PropertyMock(side_effect=[{'progress': 10}, {'progress': 10}, {'progress': 50}, {'progress': 50}])
+        result.result = {'error': None, 'content': {}, 'params': {}}
+
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf/stream',
+                            headers={'X-Auth': self.token})
+        events = [x for x in resp.get_data(as_text=True).split('\n\n') if x]
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(len(events), 3)
+        self.assertTrue(events[0].startswith('event: PROGRESS'))
+        self.assertTrue(events[-1].startswith('event: SUCCESS'))
+
+    @patch.object(snapshot.time, 'sleep')
+    def test_stream_task_failure(self, fake_sleep):
+        """SnapshotView - GET on /api/1/inf/snapshot/task/<id>/stream sends the error of a failed task"""
+        result = self.fake_celery_app.AsyncResult.return_value
+        result.ready.return_value = True
+        result.status = 'FAILURE'
+        result.result = RuntimeError('doh')
+
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf/stream',
+                            headers={'X-Auth': self.token})
+        body = resp.get_data(as_text=True)
+
+        self.assertTrue(body.startswith('event: FAILURE'))
+        self.assertTrue('doh' in body)
+
+    def test_task_wait_bad(self):
+        """SnapshotView - GET on /api/1/inf/snapshot/task returns 400 when wait is not a number"""
+        resp = self.app.get('/api/1/inf/snapshot/task/asdf-asdf-asdf?wait=lots',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestSharedResults(unittest.TestCase):
+    """Task results must be readable by any request, not only the one that sent the task"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.token = generate_v2_test_token(username='bob')
+
+    def setUp(self):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        snapshot.SnapshotView.register(app)
+        app.config['TESTING'] = True
+        # an in-memory stand in for the Redis result backend; both are shared by every thread
+        app.celery_app = Celery('snapshot', broker='memory://', backend='cache+memory://')
+        self.celery_app = app.celery_app
+        self.app = app
+
+    def _in_thread(self, func):
+        """Run a function in a new thread, and return what it returned"""
+        found = []
+        thread = threading.Thread(target=lambda: found.append(func()))
+        thread.start()
+        thread.join()
+        return found[0]
+
+    def test_result_other_thread(self):
+        """SnapshotView - a task sent by one thread has its result read by another"""
+        sent = self._in_thread(lambda: self.app.test_client().post('/api/1/inf/snapshot',
+                                                                   headers={'X-Auth': self.token},
+                                                                   json={'name': 'myVM'}))
+        task_id = sent.json['content']['task-id']
+        # what a worker does once the task is done
+        self.celery_app.backend.store_result(task_id, {'content': {'myVM': []}, 'error': None, 'params': {}}, 'SUCCESS')
+
+        resp = self._in_thread(lambda: self.app.test_client().get('/api/1/inf/snapshot/task/{}?wait=5'.format(task_id),
+                                                                  headers={'X-Auth': self.token}))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myVM': []})
+
 
 if __name__ == '__main__':
     unittest.main()
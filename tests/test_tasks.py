@@ -3,7 +3,9 @@
 A suite of tests for the functions in tasks.py
 """
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from celery.exceptions import Retry
 
 from vlab_snapshot_api.lib.worker import tasks
 
@@ -13,13 +15,23 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_show_ok(self, fake_vmware):
         """``show`` returns a dictionary when everything works as expected"""
-        fake_vmware.show_snapshot.return_value = {'worked': True}
+        fake_vmware.show_snapshot.return_value = ({'worked': True}, {'fingerprint': 'aabbccdd'})
 
         output = tasks.show(username='bob', txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'fingerprint': 'aabbccdd'}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_show_fingerprint(self, fake_vmware):
+        """``show`` passes the client's fingerprint to ``show_snapshot``"""
+        fake_vmware.show_snapshot.return_value = ({}, {'fingerprint': 'aabbccdd', 'modified': False})
+
+        tasks.show(username='bob', txn_id='myId', fingerprint='aabbccdd')
+        the_args, _ = fake_vmware.show_snapshot.call_args
+
+        self.assertEqual(the_args, ('bob', 'aabbccdd'))
+
     @patch.object(tasks, 'vmware')
     def test_show_value_error(self, fake_vmware):
         """``show`` sets the error in the dictionary to the ValueError message"""
@@ -33,7 +45,8 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_create_ok(self, fake_vmware):
         """``create`` returns a dictionary when everything works as expected"""
-        fake_vmware.create_snapshot.return_value = {'worked': True}
+        fake_vmware.run_pending.return_value = {'worked': True}
+        fake_vmware.start_create_snapshot.return_value.ticket = None
 
         output = tasks.create(username='bob',
                               machine_name='snapshotBox',
@@ -46,7 +59,7 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_create_value_error(self, fake_vmware):
         """``create`` sets the error in the dictionary to the ValueError message"""
-        fake_vmware.create_snapshot.side_effect = [ValueError("testing")]
+        fake_vmware.start_create_snapshot.side_effect = [ValueError("testing")]
 
         output = tasks.create(username='bob',
                               machine_name='snapshotBox',
@@ -56,10 +69,352 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'prune')
+    @patch.object(tasks, 'vmware')
+    def test_create_shift(self, fake_vmware, fake_prune):
+        """``create`` queues the deletion of old snapshots when shift is True"""
+        fake_vmware.run_pending.return_value = {'snapshotBox': [{'id': 'aabbcc', 'created': 1234}]}
+        fake_vmware.start_create_snapshot.return_value.ticket = None
+        fake_vmware.start_create_snapshot.return_value.full = True
+        fake_prune.apply_async.return_value.id = 'prune-id'
+
+        output = tasks.create(username='bob',
+                              machine_name='snapshotBox',
+                              shift=True,
+                              txn_id='myId')
+
+        self.assertEqual(output['params'], {'prune-task-id': 'prune-id'})
+        self.assertEqual(fake_prune.apply_async.call_args[1]['queue'], tasks.const.VLAB_QUEUE_PRUNE)
+        self.assertEqual(fake_prune.apply_async.call_args[1]['kwargs'], {'before': 1234})
+
+    @patch.object(tasks, 'prune')
+    @patch.object(tasks, 'vmware')
+    def test_create_no_shift(self, fake_vmware, fake_prune):
+        """``create`` does not queue the deletion of old snapshots when shift is False"""
+        fake_vmware.run_pending.return_value = {'worked': True}
+
+        tasks.create(username='bob',
+                     machine_name='snapshotBox',
+                     shift=False,
+                     txn_id='myId')
+
+        self.assertFalse(fake_prune.apply_async.called)
+
+    @patch.object(tasks, 'prune')
+    @patch.object(tasks, 'vmware')
+    def test_create_shift_not_full(self, fake_vmware, fake_prune):
+        """``create`` does not queue the deletion of old snapshots when the VM had room for the new one"""
+        fake_vmware.run_pending.return_value = {'worked': True}
+        fake_vmware.start_create_snapshot.return_value.ticket = None
+        fake_vmware.start_create_snapshot.return_value.full = False
+
+        output = tasks.create(username='bob',
+                              machine_name='snapshotBox',
+                              shift=True,
+                              txn_id='myId')
+
+        self.assertFalse(fake_prune.apply_async.called)
+        self.assertEqual(output['params'], {})
+
+    @patch.object(tasks, 'prune')
+    @patch.object(tasks, 'vmware')
+    def test_create_shift_queue_error(self, fake_vmware, fake_prune):
+        """``create`` still reports the new snapshot if the deletion cannot be queued"""
+        fake_vmware.run_pending.return_value = {'snapshotBox': [{'id': 'aabbcc', 'created': 1234}]}
+        fake_prune.apply_async.side_effect = RuntimeError('testing')
+
+        output = tasks.create(username='bob',
+                              machine_name='snapshotBox',
+                              shift=True,
+                              txn_id='myId')
+
+        self.assertEqual(output['content'], {'snapshotBox': [{'id': 'aabbcc', 'created': 1234}]})
+        self.assertEqual(output['error'], None)
+
+    @patch.object(tasks, 'vmware')
+    def test_prune(self, fake_vmware):
+        """``prune`` returns the IDs of the snapshots it deleted"""
+        fake_vmware.prune_snapshots.return_value = ['aabbcc']
+
+        output = tasks.prune(username='bob', machine_name='snapshotBox', txn_id='myId')
+        expected = {'content' : {'snapshotBox': ['aabbcc']}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_prune_value_error(self, fake_vmware):
+        """``prune`` does not retry when the VM does not exist"""
+        fake_vmware.prune_snapshots.side_effect = ValueError('testing')
+
+        output = tasks.prune(username='bob', machine_name='snapshotBox', txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks.prune, 'retry')
+    @patch.object(tasks, 'vmware')
+    def test_prune_retry(self, fake_vmware, fake_retry):
+        """``prune`` retries when deleting a snapshot fails"""
+        fake_vmware.prune_snapshots.side_effect = RuntimeError('testing')
+        fake_retry.return_value = Retry()
+
+        with self.assertRaises(Retry):
+            tasks.prune(username='bob', machine_name='snapshotBox', txn_id='myId')
+
+    @patch.object(tasks.tracker, 'get_tracker')
+    @patch.object(tasks, 'vmware')
+    def test_create_tracked(self, fake_vmware, fake_get_tracker):
+        """``create`` hands the vCenter task to the tracker, instead of waiting on it"""
+        with self.assertRaises(tasks.Ignore):
+            tasks.create(username='bob',
+                         machine_name='snapshotBox',
+                         shift=False,
+                         txn_id='myId')
+
+        self.assertTrue(fake_get_tracker.return_value.track.called)
+        self.assertFalse(fake_vmware.run_pending.called)
+
+    @patch.object(type(tasks.app), 'backend', new_callable=PropertyMock)
+    @patch.object(tasks.tracker, 'get_tracker')
+    @patch.object(tasks, 'vmware')
+    def test_create_tracked_done(self, fake_vmware, fake_get_tracker, fake_backend):
+        """``create`` stores the result once the tracker is done with the vCenter task"""
+        fake_vmware.start_create_snapshot.return_value.content = {'worked': True}
+        fake_vmware.start_create_snapshot.return_value.ticket = None
+        with self.assertRaises(tasks.Ignore):
+            tasks.create(username='bob',
+                         machine_name='snapshotBox',
+                         shift=False,
+                         txn_id='myId')
+        _, on_done = fake_get_tracker.return_value.track.call_args[0]
+
+        on_done(None)
+        the_args, _ = fake_backend.return_value.store_result.call_args
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+
+        self.assertEqual(the_args[1], expected)
+        self.assertEqual(the_args[2], tasks.states.SUCCESS)
+
+    @patch.object(type(tasks.app), 'backend', new_callable=PropertyMock)
+    @patch.object(tasks.tracker, 'get_tracker')
+    @patch.object(tasks, 'vmware')
+    def test_create_tracked_release(self, fake_vmware, fake_get_tracker, fake_backend):
+        """``create`` frees the admission slots once the tracker is done with the vCenter task"""
+        with self.assertRaises(tasks.Ignore):
+            tasks.create(username='bob',
+                         machine_name='snapshotBox',
+                         shift=False,
+                         txn_id='myId')
+        _, on_done = fake_get_tracker.return_value.track.call_args[0]
+
+        on_done('testing')
+        the_args, _ = fake_vmware.release_pending.call_args
+
+        self.assertEqual(the_args[0], fake_vmware.start_create_snapshot.return_value)
+
+    @patch.object(type(tasks.app), 'backend', new_callable=PropertyMock)
+    @patch.object(tasks.tracker, 'get_tracker')
+    @patch.object(tasks, 'vmware')
+    def test_create_tracked_progress(self, fake_vmware, fake_get_tracker, fake_backend):
+        """``create`` publishes the progress of the vCenter task as a custom Celery state"""
+        with self.assertRaises(tasks.Ignore):
+            tasks.create(username='bob',
+                         machine_name='snapshotBox',
+                         shift=False,
+                         txn_id='myId')
+        on_progress = fake_get_tracker.return_value.track.call_args[1]['on_progress']
+
+        on_progress({'progress': 42})
+        the_args, _ = fake_backend.return_value.store_result.call_args
+
+        self.assertEqual(the_args[1], {'progress': 42})
+        self.assertEqual(the_args[2], tasks.PROGRESS)
+
+    @patch.object(type(tasks.app), 'backend', new_callable=PropertyMock)
+    @patch.object(tasks.tracker, 'get_tracker')
+    @patch.object(tasks, 'vmware')
+    def test_delete_tracked_error(self, fake_vmware, fake_get_tracker, fake_backend):
+        """``delete`` stores the error when the vCenter task fails"""
+        with self.assertRaises(tasks.Ignore):
+            tasks.delete(username='bob', snap_id='1234ad', machine_name='snapshotBox', txn_id='myId')
+        _, on_done = fake_get_tracker.return_value.track.call_args[0]
+
+        on_done('doh')
+        the_args, _ = fake_backend.return_value.store_result.call_args
+
+        self.assertEqual(the_args[1]['error'], 'doh')
+
+    def test_routes(self):
+        """``snapshot.show`` is routed to a different queue than tasks which change VMs"""
+        router = tasks.app.amqp.router
+
+        read_queue = router.route({}, 'snapshot.show')['queue'].name
+        write_queue = router.route({}, 'snapshot.create')['queue'].name
+
+        self.assertEqual(read_queue, tasks.const.VLAB_QUEUE_READ)
+        self.assertEqual(write_queue, tasks.const.VLAB_QUEUE_WRITE)
+
+    def test_routes_prune(self):
+        """``snapshot.prune`` is routed to its own queue"""
+        queue = tasks.app.amqp.router.route({}, 'snapshot.prune')['queue'].name
+
+        self.assertEqual(queue, tasks.const.VLAB_QUEUE_PRUNE)
+
+    def test_acks_late(self):
+        """Only ``snapshot.show`` is acknowledged after it runs"""
+        self.assertTrue(tasks.show.acks_late)
+        self.assertFalse(tasks.create.acks_late)
+
+    @patch.object(tasks, 'const')
+    def test_worker_queues(self, fake_const):
+        """``_worker_queues`` supports consuming a single queue"""
+        fake_const.VLAB_WORKER_QUEUES = ' snapshot_read, '
+
+        self.assertEqual(tasks._worker_queues(), ['snapshot_read'])
+
+    @patch.object(tasks, 'const')
+    def test_worker_queues_default(self, fake_const):
+        """``_worker_queues`` consumes every queue by default"""
+        fake_const.VLAB_WORKER_QUEUES = ''
+        fake_const.VLAB_QUEUE_READ = 'r'
+        fake_const.VLAB_QUEUE_WRITE = 'w'
+        fake_const.VLAB_QUEUE_PRUNE = 'p'
+
+        self.assertEqual(tasks._worker_queues(), ['r', 'w', 'p'])
+
+    @patch.object(tasks, 'vmware')
+    def test_create_many_ok(self, fake_vmware):
+        """``create_many`` returns a dictionary when everything works as expected"""
+        fake_vmware.create_snapshots.return_value = ({'worked': True}, [], 0)
+
+        output = tasks.create_many(username='bob',
+                                   machine_names=['vm1', 'vm2'],
+                                   shift=False,
+                                   txn_id='myId')
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'admission_wait': 0}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_create_many_errors(self, fake_vmware):
+        """``create_many`` reports the VMs that failed, along with the ones that worked"""
+        fake_vmware.create_snapshots.return_value = ({'vm1': []}, ['vm2 broke', 'vm3 broke'], 0)
+
+        output = tasks.create_many(username='bob',
+                                   machine_names=['vm1', 'vm2', 'vm3'],
+                                   shift=False,
+                                   txn_id='myId')
+        expected = {'content' : {'vm1': []}, 'error': 'vm2 broke; vm3 broke', 'params': {'admission_wait': 0}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_many_ok(self, fake_vmware):
+        """``delete_many`` returns a dictionary when everything works as expected"""
+        fake_vmware.delete_snapshots.return_value = ({'vm1': ['aabbcc']}, [])
+
+        output = tasks.delete_many(username='bob',
+                                   snapshots=[{'name': 'vm1', 'id': 'aabbcc'}],
+                                   txn_id='myId')
+        expected = {'content' : {'vm1': ['aabbcc']}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_many_errors(self, fake_vmware):
+        """``delete_many`` reports the snapshots that could not be deleted"""
+        fake_vmware.delete_snapshots.return_value = ({}, ['vm1 broke'])
+
+        output = tasks.delete_many(username='bob',
+                                   snapshots=[{'name': 'vm1', 'id': 'aabbcc'}],
+                                   txn_id='myId')
+        expected = {'content' : {}, 'error': 'vm1 broke', 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_checkpoint(self, fake_vmware):
+        """``checkpoint`` returns a dictionary when everything works as expected"""
+        fake_vmware.checkpoint_lab.return_value = ({'worked': True}, 2.5)
+
+        output = tasks.checkpoint(username='bob', shift=False, txn_id='myId')
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'admission_wait': 2.5}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_checkpoint_value_error(self, fake_vmware):
+        """``checkpoint`` sets the error in the response when ValueError is raised"""
+        fake_vmware.checkpoint_lab.side_effect = [ValueError('testing')]
+
+        output = tasks.checkpoint(username='bob', shift=False, txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_revert(self, fake_vmware):
+        """``revert`` returns the VMs that were reverted, and any that were not"""
+        fake_vmware.revert_lab.return_value = (['vm1'], ['vm2 broke'], 0)
+
+        output = tasks.revert(username='bob', snap_id='aaa', txn_id='myId')
+        expected = {'content' : {'machines': ['vm1']}, 'error': 'vm2 broke', 'params': {'admission_wait': 0}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_revert_value_error(self, fake_vmware):
+        """``revert`` sets the error in the response when ValueError is raised"""
+        fake_vmware.revert_lab.side_effect = [ValueError('testing')]
+
+        output = tasks.revert(username='bob', snap_id='aaa', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_create_admission_wait(self, fake_vmware):
+        """``create`` reports how long it waited for a less busy datastore and host"""
+        fake_vmware.run_pending.return_value = {'worked': True}
+        fake_vmware.start_create_snapshot.return_value.ticket.waited = 4.5
+
+        output = tasks.create(username='bob',
+                              machine_name='snapshotBox',
+                              shift=False,
+                              txn_id='myId')
+
+        self.assertEqual(output['params'], {'admission_wait': 4.5})
+
+    @patch.object(tasks, 'vmware')
+    def test_show_vcenter_summary(self, fake_vmware):
+        """``show`` reports the round-trips it made to vCenter, per phase"""
+        def show_snapshot(username, fingerprint):
+            tasks.instrument.current().record('resolve', 'FindChild', '', 0.5)
+            return {}, {}
+        fake_vmware.show_snapshot.side_effect = show_snapshot
+
+        output = tasks.show(username='bob', txn_id='myId')
+        expected = {'resolve': {'calls': 1, 'seconds': 0.5}}
+
+        self.assertEqual(output['params']['vcenter'], expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_show_txn_id(self, fake_vmware):
+        """The round-trips of a task are tagged with the txn_id, even when it's passed by position"""
+        found = []
+        def show_snapshot(username, fingerprint):
+            found.append(tasks.instrument.current().txn_id)
+            return {}, {}
+        fake_vmware.show_snapshot.side_effect = show_snapshot
+
+        tasks.show('bob', 'myId')
+
+        self.assertEqual(found, ['myId'])
+
     @patch.object(tasks, 'vmware')
     def test_delete_ok(self, fake_vmware):
         """``delete`` returns a dictionary when everything works as expected"""
-        fake_vmware.delete_snapshot.return_value = {'worked': True}
+        fake_vmware.run_pending.return_value = None
+        fake_vmware.start_delete_snapshot.return_value.ticket = None
 
         output = tasks.delete(username='bob', snap_id='1234ad', machine_name='snapshotBox', txn_id='myId')
         expected = {'content' : {}, 'error': None, 'params': {}}
@@ -69,7 +424,7 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_delete_value_error(self, fake_vmware):
         """``delete`` sets the error in the dictionary to the ValueError message"""
-        fake_vmware.delete_snapshot.side_effect = [ValueError("testing")]
+        fake_vmware.start_delete_snapshot.side_effect = [ValueError("testing")]
 
         output = tasks.delete(username='bob', snap_id='1234ad', machine_name='snapshotBox', txn_id='myId')
         expected = {'content' : {}, 'error': 'testing', 'params': {}}
@@ -79,7 +434,8 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_apply_ok(self, fake_vmware):
         """``apply`` returns a dictionary when everything works as expected"""
-        fake_vmware.apply_snapshot.return_value = {'worked': True}
+        fake_vmware.run_pending.return_value = None
+        fake_vmware.start_apply_snapshot.return_value.ticket = None
 
         output = tasks.apply(username='bob', snap_id='1234ad', machine_name='snapshotBox', txn_id='myId')
         expected = {'content' : {}, 'error': None, 'params': {}}
@@ -89,7 +445,7 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_apply_value_error(self, fake_vmware):
         """``apply`` sets the error in the dictionary to the ValueError message"""
-        fake_vmware.apply_snapshot.side_effect = [ValueError("testing")]
+        fake_vmware.start_apply_snapshot.side_effect = [ValueError("testing")]
 
         output = tasks.apply(username='bob', snap_id='1234ad', machine_name='snapshotBox', txn_id='myId')
         expected = {'content' : {}, 'error': 'testing', 'params': {}}
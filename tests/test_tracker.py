@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``tracker.py`` module"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from pyVmomi import vim, vmodl
+
+from vlab_snapshot_api.lib.worker import tracker
+from vlab_snapshot_api.lib.worker.vmware import Pending
+
+
+@patch.object(tracker, 'rebind', lambda vcenter, moref: moref)
+@patch.object(tracker, 'inventory')
+class TestTaskTracker(unittest.TestCase):
+    """A suite of test cases for the ``TaskTracker`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.tracker = tracker.TaskTracker(interval=1, timeout=60)
+        cls.on_done = MagicMock()
+        cls.task = vim.Task('task-1')
+        cls.tracker.track(Pending(cls.task, None), cls.on_done)
+
+    def test_success(self, fake_inventory):
+        """``TaskTracker.poll`` runs the callback once the vCenter task works"""
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'success'}]
+
+        done = self.tracker.poll(MagicMock())
+
+        self.assertEqual(done, 1)
+        self.on_done.assert_called_with(None)
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_error(self, fake_inventory):
+        """``TaskTracker.poll`` supplies the error to the callback when the vCenter task fails"""
+        error = MagicMock()
+        error.msg = 'doh'
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'error', 'info.error': error}]
+
+        self.tracker.poll(MagicMock())
+
+        self.on_done.assert_called_with('doh')
+
+    def test_running(self, fake_inventory):
+        """``TaskTracker.poll`` keeps tracking vCenter tasks that are not done"""
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'running'}]
+
+        done = self.tracker.poll(MagicMock())
+
+        self.assertEqual(done, 0)
+        self.assertFalse(self.on_done.called)
+        self.assertEqual(len(self.tracker), 1)
+
+    @patch.object(tracker.time, 'time')
+    def test_timeout(self, fake_time, fake_inventory):
+        """``TaskTracker.poll`` gives up on vCenter tasks that take too long"""
+        fake_time.return_value = 9999999999999
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'running'}]
+
+        self.tracker.poll(MagicMock())
+        error = self.on_done.call_args[0][0]
+
+        self.assertTrue(error.startswith('Timeout'))
+
+    def test_batched(self, fake_inventory):
+        """``TaskTracker.poll`` reads every vCenter task in one call"""
+        other_task = vim.Task('task-2')
+        self.tracker.track(Pending(other_task, None), MagicMock())
+        fake_inventory.retrieve.return_value = []
+
+        self.tracker.poll(MagicMock())
+        tasks = fake_inventory.task_filter_spec.call_args[0][0]
+
+        self.assertEqual(fake_inventory.retrieve.call_count, 1)
+        self.assertEqual(len(tasks), 2)
+
+    def test_nothing_tracked(self, fake_inventory):
+        """``TaskTracker.poll`` does not call vCenter when there is nothing to check"""
+        the_tracker = tracker.TaskTracker()
+
+        the_tracker.poll(MagicMock())
+
+        self.assertFalse(fake_inventory.retrieve.called)
+
+    def test_progress(self, fake_inventory):
+        """``TaskTracker.poll`` reports the progress of vCenter tasks that are running"""
+        on_progress = MagicMock()
+        the_tracker = tracker.TaskTracker()
+        the_tracker.track(Pending(self.task, None), MagicMock(), on_progress)
+        fake_inventory.retrieve.return_value = [{'obj': self.task,
+                                                 'info.state': 'running',
+                                                 'info.progress': 42,
+                                                 'info.descriptionId': 'VirtualMachine.createSnapshot'}]
+
+        the_tracker.poll(MagicMock())
+        expected = {'operation': 'VirtualMachine.createSnapshot', 'state': 'running', 'progress': 42}
+
+        on_progress.assert_called_with(expected)
+
+    def test_progress_unchanged(self, fake_inventory):
+        """``TaskTracker.poll`` only reports progress when it changes"""
+        on_progress = MagicMock()
+        the_tracker = tracker.TaskTracker()
+        the_tracker.track(Pending(self.task, None), MagicMock(), on_progress)
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'running', 'info.progress': 42}]
+
+        the_tracker.poll(MagicMock())
+        the_tracker.poll(MagicMock())
+
+        self.assertEqual(on_progress.call_count, 1)
+
+    def test_gone(self, fake_inventory):
+        """``TaskTracker.poll`` drops vCenter tasks that no longer exist"""
+        fake_inventory.retrieve.side_effect = vmodl.fault.ManagedObjectNotFound(obj=self.task)
+
+        self.tracker.poll(MagicMock())
+        error = self.on_done.call_args[0][0]
+
+        self.assertTrue('no longer exists' in error)
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_callback_error(self, fake_inventory):
+        """``TaskTracker.poll`` keeps going when a callback fails"""
+        self.on_done.side_effect = RuntimeError('testing')
+        fake_inventory.retrieve.return_value = [{'obj': self.task, 'info.state': 'success'}]
+
+        self.tracker.poll(MagicMock())
+
+        self.assertEqual(self.tracker.stats()['finished'], 1)
+
+
+class TestModule(unittest.TestCase):
+    """A suite of test cases for the module level functions"""
+    @patch.object(tracker.TaskTracker, 'start')
+    def test_init_tracker(self, fake_start):
+        """``init_tracker`` creates and starts a tracker for the process"""
+        the_tracker = tracker.init_tracker()
+
+        self.assertTrue(tracker.get_tracker() is the_tracker)
+        self.assertTrue(fake_start.called)
+        tracker.stop_tracker()
+
+    def test_stop_tracker(self):
+        """``stop_tracker`` leaves the process without a tracker"""
+        with patch.object(tracker.TaskTracker, 'start'):
+            tracker.init_tracker()
+
+        tracker.stop_tracker()
+
+        self.assertTrue(tracker.get_tracker() is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
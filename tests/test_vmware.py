@@ -8,159 +8,395 @@ from unittest.mock import patch, MagicMock
 from vlab_snapshot_api.lib.worker import vmware
 
 class FakeSnapshot:
-    def __init__(self, snap_id, snap_created, snap_expires):
+    def __init__(self, snap_id, snap_created, snap_expires, description=''):
         self.name = '{}_{}_{}'.format(snap_id, snap_created, snap_expires)
+        self.id = snap_id
+        self.created = snap_created
+        self.expires = snap_expires
         self.snapshot = MagicMock()
+        self.childSnapshotList = []
+        self.description = description
+
+class FakeResolver:
+    """Finds VMs in a list, instead of in vCenter"""
+    def __init__(self, vms):
+        self.vms = vms
+
+    def user_folder(self, vcenter, username):
+        return MagicMock()
+
+    def with_user_folder(self, vcenter, username, func):
+        return func(self.user_folder(vcenter, username))
+
+    def vm(self, vcenter, username, machine_name):
+        for the_vm in self.vms:
+            if the_vm.name == machine_name:
+                return the_vm
+        return None
+
 
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
+    def setUp(self):
+        """Runs before every test case"""
+        patcher = patch.object(vmware, 'get_resolver')
+        self.fake_get_resolver = patcher.start()
+        self.fake_get_resolver.return_value = FakeResolver([])
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(vmware.admission, 'get_controller')
+        self.fake_controller = patcher.start().return_value
+        self.fake_controller.acquire.return_value = vmware.admission.Ticket('ticket', 0)
+        self.addCleanup(patcher.stop)
 
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_show_snapshot(self, fake_vCenter, fake_get_snapshots):
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot(self, fake_get_pool, fake_iter_snapshots, fake_inventory):
         """``snapshot`` returns a dictionary when everything works as expected"""
-        fake_get_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
-        fake_vm = MagicMock()
-        fake_vm.name = 'SomeVM'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_iter_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(),
+                                                 'name': 'SomeVM',
+                                                 'snapshot.rootSnapshotList': [MagicMock()]}]
 
-        output = vmware.show_snapshot(username='alice')
+        output, _ = vmware.show_snapshot(username='alice')
         expected = {'SomeVM': [{'id': 'asdf', 'created': 1234, 'expires': 4321}]}
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, '_get_snapshots')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_none(self, fake_get_pool, fake_inventory):
+        """``snapshot`` returns an empty list for VMs without any snapshots"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'SomeVM'}]
+
+        output, _ = vmware.show_snapshot(username='alice')
+        expected = {'SomeVM': []}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_fingerprint(self, fake_get_pool, fake_inventory):
+        """``snapshot`` returns a fingerprint of the lab"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'SomeVM', 'config.changeVersion': '1'}]
+
+        _, params = vmware.show_snapshot(username='alice')
+
+        self.assertTrue(isinstance(params['fingerprint'], str))
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_not_modified(self, fake_get_pool, fake_inventory):
+        """``snapshot`` returns no VMs when the lab matches the supplied fingerprint"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'SomeVM', 'config.changeVersion': '1'}]
+        _, params = vmware.show_snapshot(username='alice')
+
+        output, params = vmware.show_snapshot(username='alice', fingerprint=params['fingerprint'])
+
+        self.assertEqual(output, {})
+        self.assertFalse(params['modified'])
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_delta(self, fake_get_pool, fake_inventory):
+        """``snapshot`` only returns the VMs that changed since the supplied fingerprint"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'SomeVM', 'config.changeVersion': '1'},
+                                                {'obj': MagicMock(), 'name': 'OtherVM', 'config.changeVersion': '1'}]
+        _, params = vmware.show_snapshot(username='alice')
+        fake_inventory.retrieve.return_value[1]['config.changeVersion'] = '2'
+
+        output, params = vmware.show_snapshot(username='alice', fingerprint=params['fingerprint'])
+
+        self.assertEqual(output, {'OtherVM': []})
+        self.assertTrue(params['modified'])
+        self.assertEqual(params['machines'], ['OtherVM', 'SomeVM'])
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_checkpoint(self, fake_get_pool, fake_inventory):
+        """``snapshot`` reports a lab checkpoint once, instead of on every VM"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('aaa', 1, 2, 'group=lab')]},
+                                                {'obj': MagicMock(), 'name': 'vm2',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('aaa', 1, 2, 'group=lab')]}]
+
+        output, params = vmware.show_snapshot(username='alice')
+        expected = [{'id': 'aaa', 'created': 1, 'expires': 2, 'machines': ['vm1', 'vm2']}]
+
+        self.assertEqual(output, {'vm1': [], 'vm2': []})
+        self.assertEqual(params['checkpoints'], expected)
+
+    def test_parse_description(self):
+        """``_parse_description`` ignores descriptions not set by vLab"""
+        output = vmware._parse_description('group=lab some text')
+
+        self.assertEqual(output, {'group': 'lab'})
+
+    def test_make_description(self):
+        """``_make_description`` produces something ``_parse_description`` can read"""
+        description = vmware._make_description(group='lab')
+
+        self.assertEqual(vmware._parse_description(description), {'group': 'lab'})
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_checkpoint_lab(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``checkpoint_lab`` snapshots every VM in parallel, with the same snapshot name"""
+        fake_consume_tasks.return_value = [None, None]
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1'}, {'obj': vm2, 'name': 'vm2'}]
+
+        output, _ = vmware.checkpoint_lab('sam', False, MagicMock())
+        name1 = vm1.CreateSnapshot.call_args[0][0]
+        name2 = vm2.CreateSnapshot.call_args[0][0]
+
+        self.assertEqual(name1, name2)
+        self.assertEqual(output['machines'], ['vm1', 'vm2'])
+        self.assertEqual(fake_consume_tasks.call_count, 1)
+
+    @patch.object(vmware, '_remove_snapshots')
+    @patch.object(vmware, '_find_snapshot')
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_checkpoint_lab_rollback(self, fake_get_pool, fake_inventory, fake_consume_tasks,
+                                     fake_find_snapshot, fake_remove_snapshots):
+        """``checkpoint_lab`` removes the snapshots that worked when any VM fails"""
+        fake_consume_tasks.return_value = [None, 'doh']
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1'},
+                                                {'obj': MagicMock(), 'name': 'vm2'}]
+
+        with self.assertRaises(ValueError):
+            vmware.checkpoint_lab('sam', False, MagicMock())
+        the_args, _ = fake_remove_snapshots.call_args
+
+        self.assertEqual(the_args[1], [('vm1', [fake_find_snapshot.return_value])])
+
+    @patch.object(vmware, '_remove_snapshots')
+    @patch.object(vmware, '_find_snapshot')
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_checkpoint_lab_start_fault(self, fake_get_pool, fake_inventory, fake_consume_tasks,
+                                        fake_find_snapshot, fake_remove_snapshots):
+        """``checkpoint_lab`` removes the snapshots that worked when vCenter refuses to snapshot a VM"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        vm1, vm2 = MagicMock(), MagicMock()
+        vm2.CreateSnapshot.side_effect = vmware.vim.fault.InvalidState(msg='busy')
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1'}, {'obj': vm2, 'name': 'vm2'}]
+
+        with self.assertRaises(ValueError) as caught:
+            vmware.checkpoint_lab('sam', False, MagicMock())
+        the_args, _ = fake_remove_snapshots.call_args
+
+        self.assertTrue('vm2: busy' in str(caught.exception))
+        self.assertEqual(the_args[1], [('vm1', [fake_find_snapshot.return_value])])
+
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_checkpoint_lab_max(self, fake_get_pool, fake_inventory, fake_consume_tasks, fake_iter_tree):
+        """``checkpoint_lab`` raises ValueError when a VM has too many snapshots, and shift is False"""
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        vm1 = MagicMock()
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1'}]
+
+        with self.assertRaises(ValueError):
+            vmware.checkpoint_lab('sam', False, MagicMock())
+
+        self.assertFalse(vm1.CreateSnapshot.called)
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_checkpoint_lab_empty(self, fake_get_pool, fake_inventory):
+        """``checkpoint_lab`` raises ValueError when the lab has no VMs"""
+        fake_inventory.retrieve.return_value = []
+
+        with self.assertRaises(ValueError):
+            vmware.checkpoint_lab('sam', False, MagicMock())
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_revert_lab(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``revert_lab`` reverts every VM at once, and reports VMs without the checkpoint"""
+        fake_consume_tasks.return_value = [None]
+        snap = FakeSnapshot('aaa', 1, 2, 'group=lab')
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1',
+                                                 'snapshot.rootSnapshotList': [snap]},
+                                                {'obj': MagicMock(), 'name': 'vm2'}]
+
+        reverted, errors, _ = vmware.revert_lab('sam', 'aaa', MagicMock())
+
+        self.assertEqual(reverted, ['vm1'])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(snap.snapshot.RevertToSnapshot_Task.called)
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_revert_lab_start_fault(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``revert_lab`` reports a VM that vCenter refuses to revert, and still reverts the others"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        snap1 = FakeSnapshot('aaa', 1, 2, 'group=lab')
+        snap2 = FakeSnapshot('aaa', 1, 2, 'group=lab')
+        snap1.snapshot.RevertToSnapshot_Task.side_effect = vmware.vim.fault.InvalidPowerState(msg='off')
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1',
+                                                 'snapshot.rootSnapshotList': [snap1]},
+                                                {'obj': MagicMock(), 'name': 'vm2',
+                                                 'snapshot.rootSnapshotList': [snap2]}]
+
+        reverted, errors, _ = vmware.revert_lab('sam', 'aaa', MagicMock())
+
+        self.assertEqual(reverted, ['vm2'])
+        self.assertEqual(errors, ['Unable to revert vm1: off'])
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_revert_lab_not_found(self, fake_get_pool, fake_inventory):
+        """``revert_lab`` raises ValueError when no VM has the checkpoint"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1'}]
+
+        with self.assertRaises(ValueError):
+            vmware.revert_lab('sam', 'aaa', MagicMock())
+
+    @patch.object(vmware, '_iter_snapshots')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_snapshot(self, fake_vCenter, fake_consume_task, fake_get_snapshots):
+    @patch.object(vmware, 'get_pool')
+    def test_delete_snapshot(self, fake_get_pool, fake_consume_task, fake_iter_snapshots):
         """``delete_snapshot`` returns None when everything works as expected"""
-        fake_get_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
+        fake_iter_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         output = vmware.delete_snapshot(username='bob', machine_name='SomeVM', snap_id='asdf', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, '_get_snapshots')
+    @patch.object(vmware, '_iter_snapshots')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_snapshot_value_error(self, fake_vCenter, fake_consume_task, fake_get_snapshots):
+    @patch.object(vmware, 'get_pool')
+    def test_delete_snapshot_value_error(self, fake_get_pool, fake_consume_task, fake_iter_snapshots):
         """``delete_snapshot`` raises ValueError when unable to find requested vm for snapshot deletion"""
-        fake_get_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
+        fake_iter_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.delete_snapshot(username='bob', machine_name='SomeOtherVM', snap_id='asdf', logger=fake_logger)
 
-    @patch.object(vmware, '_get_snapshots')
+    @patch.object(vmware, '_iter_snapshots')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_snapshot_no_exists(self, fake_vCenter, fake_consume_task, fake_get_snapshots):
+    @patch.object(vmware, 'get_pool')
+    def test_delete_snapshot_no_exists(self, fake_get_pool, fake_consume_task, fake_iter_snapshots):
         """``delete_snapshot`` raises ValueError when the requested snapshot does not exists"""
-        fake_get_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
+        fake_iter_snapshots.return_value = [FakeSnapshot('asdf', 1234, 4321)]
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.delete_snapshot(username='bob', machine_name='SomeVM', snap_id='qwerty', logger=fake_logger)
 
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` Returns snapshot details after successfully taking the snapshot"""
-        fake_get_snapshots.return_value = []
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_snapshots.return_value = []
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         snap_info = vmware.create_snapshot(username='sam',
                                            machine_name='SomeVM',
                                            shift=False,
                                            logger=fake_logger)
-        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345}]}
+        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345, 'mode': 'memory'}]}
 
         self.assertEqual(snap_info, expected)
 
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot_attr_error(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot_attr_error(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` handles the AttributeError that occurs when a VM has no snapshots"""
-        fake_get_snapshots.side_effect = [AttributeError('fuck pyvmomi')]
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_snapshots.side_effect = [AttributeError('fuck pyvmomi')]
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         snap_info = vmware.create_snapshot(username='sam',
                                            machine_name='SomeVM',
                                            shift=False,
                                            logger=fake_logger)
-        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345}]}
+        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345, 'mode': 'memory'}]}
 
         self.assertEqual(snap_info, expected)
 
-    @patch.object(vmware, '_deleted_old_snaps')
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot_shift(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot, fake_deleted_old_snaps):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot_shift(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` param 'shift' works"""
-        fake_get_snapshots.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_snapshots.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         snap_info = vmware.create_snapshot(username='sam',
                                            machine_name='SomeVM',
                                            shift=True,
                                            logger=fake_logger)
-        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345}]}
+        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345, 'mode': 'memory'}]}
 
         self.assertEqual(snap_info, expected)
+        # only the new snapshot is waited on; see prune_snapshots
+        self.assertEqual(fake_consume_task.call_count, 1)
 
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot_no_shift(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot_no_shift(self, fake_get_pool, fake_iter_tree, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` Raises ValueError when VM has already exceed max snaps allowed and param 'shift' not supplied"""
-        fake_get_snapshots.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.create_snapshot(username='sam',
@@ -168,19 +404,20 @@ class TestVMware(unittest.TestCase):
                                    shift=False,
                                    logger=fake_logger)
 
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot_no_vm(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot_no_vm(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` Raises ValueError if the VM requested to be snapshoted does not exist"""
-        fake_get_snapshots.return_value = []
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_snapshots.return_value = []
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.create_snapshot(username='sam',
@@ -188,13 +425,14 @@ class TestVMware(unittest.TestCase):
                                    shift=False,
                                    logger=fake_logger)
 
-    @patch.object(vmware, '_take_snapshot')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_create_snapshot_not_first_vm(self, fake_vCenter, fake_get_snapshots, fake_take_snapshot):
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshot_not_first_vm(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot, fake_consume_task):
         """``create_snapshot`` Does not raise ValueError if the first VM found is not the correct one"""
-        fake_get_snapshots.return_value = []
-        fake_take_snapshot.return_value = ('aabbcc', 1234, 2345)
+        fake_iter_snapshots.return_value = []
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
@@ -202,61 +440,247 @@ class TestVMware(unittest.TestCase):
         fake_vm2.name = 'SomeOtherVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm2, fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         snap_info = vmware.create_snapshot(username='sam',
                                            machine_name='SomeVM',
                                            shift=False,
                                            logger=fake_logger)
-        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345}]}
+        expected = {'SomeVM': [{'id': 'aabbcc', 'created': 1234, 'expires': 2345, 'mode': 'memory'}]}
 
         self.assertEqual(snap_info, expected)
 
     @patch.object(vmware.uuid, 'uuid4')
     @patch.object(vmware.time, 'time')
-    @patch.object(vmware, 'consume_task')
-    def test_take_snapshot(self, fake_consume_task, fake_time, fake_uuid4):
-        """``_take_snapshot`` Returns new snapshot metadata as a tuple"""
+    def test_start_snapshot(self, fake_time, fake_uuid4):
+        """``_start_snapshot`` Returns the vCenter task, and new snapshot metadata as a tuple"""
         fake_vm = MagicMock()
         fake_create_time = 1234
         fake_expire_time = fake_create_time + vmware.const.VLAB_SNAPSHOT_EXPIRES_AFTER
         fake_time.return_value = 1234
         fake_uuid4.return_value = 'aabbccddeeff'
 
-        meta_data = vmware._take_snapshot(fake_vm)
-        expected_meta_data = ('aabbcc', fake_create_time, fake_expire_time)
+        meta_data = vmware._start_snapshot(fake_vm)
+        expected_meta_data = (fake_vm.CreateSnapshot.return_value, 'aabbcc', fake_create_time, fake_expire_time)
 
         self.assertEqual(meta_data, expected_meta_data)
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, '_get_snapshots')
-    def test_delete_old_snaps(self, fake_get_snapshots, fake_consume_task):
-        """``_delete_old_snaps`` Returns how many snapshots were deleted"""
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_prune_snapshots(self, fake_get_pool, fake_iter_snapshots, fake_consume_task):
+        """``prune_snapshots`` deletes the oldest snapshots over the limit, and reports progress"""
+        old_snap = FakeSnapshot('aabbcc', 1, 4321)
+        newer = [FakeSnapshot('snap{}'.format(x), 10 + x, 4321) for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_iter_snapshots.return_value = newer + [old_snap]
         fake_vm = MagicMock()
-        fake_logger = MagicMock()
-        total_snaps = 5
-        fake_snap = MagicMock()
-        fake_snap.name = 'aabbcc_1234_4321'
-        fake_get_snapshots.return_value = [fake_snap for x in range(total_snaps)]
+        fake_vm.name = 'SomeVM'
+        fake_vm.snapshot.rootSnapshotList = newer + [old_snap]
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+        progress = MagicMock()
+
+        deleted = vmware.prune_snapshots('sam', 'SomeVM', MagicMock(), progress=progress)
+
+        self.assertEqual(deleted, ['aabbcc'])
+        self.assertTrue(old_snap.snapshot.RemoveSnapshot_Task.called)
+        progress.assert_called_with(1, 1)
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_prune_snapshots_nothing(self, fake_get_pool, fake_iter_snapshots, fake_consume_task):
+        """``prune_snapshots`` does nothing when the VM is within the limit"""
+        fake_iter_snapshots.return_value = [FakeSnapshot('aabbcc', 1, 4321)]
+        fake_vm = MagicMock()
+        fake_vm.name = 'SomeVM'
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+
+        deleted = vmware.prune_snapshots('sam', 'SomeVM', MagicMock())
+
+        self.assertEqual(deleted, [])
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(vmware, 'get_pool')
+    def test_prune_snapshots_no_vm(self, fake_get_pool):
+        """``prune_snapshots`` raises ValueError when the VM does not exist"""
+        self.fake_get_resolver.return_value = FakeResolver([])
+
+        with self.assertRaises(ValueError):
+            vmware.prune_snapshots('sam', 'SomeVM', MagicMock())
+
+    @patch.object(vmware, 'consume_task')
+    def test_run_pending(self, fake_consume_task):
+        """``run_pending`` waits on the vCenter task, and returns its content"""
+        output = vmware.run_pending(vmware.Pending(MagicMock(), {'worked': True}))
+
+        self.assertEqual(output, {'worked': True})
+        self.assertEqual(fake_consume_task.call_count, 1)
+
+    @patch.object(vmware, 'consume_task')
+    def test_run_pending_release(self, fake_consume_task):
+        """``run_pending`` frees the admission slots, even when the vCenter task fails"""
+        fake_consume_task.side_effect = [RuntimeError('testing')]
+        ticket = vmware.admission.Ticket('ticket', 0)
+
+        with self.assertRaises(RuntimeError):
+            vmware.run_pending(vmware.Pending(MagicMock(), None, ticket))
+
+        self.fake_controller.release.assert_called_with(ticket)
+
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_start_create_snapshot_admission(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot):
+        """``start_create_snapshot`` waits for a free slot before taking the snapshot"""
+        fake_iter_snapshots.return_value = []
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
+        fake_vm = MagicMock()
+        fake_vm.name = 'SomeVM'
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+
+        pending = vmware.start_create_snapshot(username='sam', machine_name='SomeVM', shift=False, logger=MagicMock())
+
+        self.assertEqual(pending.ticket, self.fake_controller.acquire.return_value)
+        self.assertFalse(self.fake_controller.release.called)
+
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_start_create_snapshot_admission_error(self, fake_get_pool, fake_iter_snapshots, fake_start_snapshot):
+        """``start_create_snapshot`` frees the slot if the snapshot cannot be started"""
+        fake_iter_snapshots.return_value = []
+        fake_start_snapshot.side_effect = [RuntimeError('testing')]
+        fake_vm = MagicMock()
+        fake_vm.name = 'SomeVM'
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+
+        with self.assertRaises(RuntimeError):
+            vmware.start_create_snapshot(username='sam', machine_name='SomeVM', shift=False, logger=MagicMock())
+
+        self.fake_controller.release.assert_called_with(self.fake_controller.acquire.return_value)
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_run_admitted(self, fake_consume_tasks):
+        """``_run_admitted`` admits every VM on its own, and frees every slot once the tasks are done"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        self.fake_controller.acquire.return_value = vmware.admission.Ticket('ticket', 1.5)
 
-        deleted_snap_count = vmware._deleted_old_snaps(fake_vm, fake_logger)
-        expected_count = total_snaps - vmware.const.VLAB_MAX_SNAPSHOTS
+        errors, waited = vmware._run_admitted(MagicMock(), ['vm1', 'vm2'], lambda x: MagicMock(),
+                                              lambda x: {'datastore:{}'.format(x): 1}, MagicMock())
+        needs = [x[0][0] for x in self.fake_controller.acquire.call_args_list]
 
-        self.assertEqual(deleted_snap_count, expected_count)
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(waited, 3)
+        self.assertEqual(needs, [{'datastore:vm1': 1}, {'datastore:vm2': 1}])
+        self.assertEqual(self.fake_controller.release.call_count, 2)
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_run_admitted_start_fault(self, fake_consume_tasks):
+        """``_run_admitted`` frees the slot of a VM whose task fails to start"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+
+        def start(item):
+            if item == 'vm1':
+                raise vmware.vim.fault.TaskInProgress(msg='busy')
+            return MagicMock()
+
+        errors, _ = vmware._run_admitted(MagicMock(), ['vm1', 'vm2'], start, lambda x: {}, MagicMock())
+
+        self.assertEqual(errors, ['busy', None])
+        self.assertEqual(self.fake_controller.release.call_count, 2)
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_run_admitted_start_error(self, fake_consume_tasks):
+        """``_run_admitted`` frees every slot it holds when starting a task fails with something besides a fault"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        start = MagicMock(side_effect=[MagicMock(), RuntimeError('testing')])
+
+        with self.assertRaises(RuntimeError):
+            vmware._run_admitted(MagicMock(), ['vm1', 'vm2'], start, lambda x: {}, MagicMock())
+
+        self.assertEqual(self.fake_controller.release.call_count, 2)
+        self.assertFalse(fake_consume_tasks.called)
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_run_admitted_timeout(self, fake_consume_tasks):
+        """``_run_admitted`` stops waiting for slots once one request times out"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        self.fake_controller.acquire.side_effect = ValueError('Timed out')
+        start = MagicMock()
+
+        errors, _ = vmware._run_admitted(MagicMock(), ['vm1', 'vm2'], start, lambda x: {}, MagicMock())
+
+        self.assertEqual(errors, ['Timed out', 'Timed out'])
+        self.assertEqual(self.fake_controller.acquire.call_count, 1)
+        self.assertFalse(start.called)
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, '_poll_tasks')
+    def test_run_admitted_frees_done(self, fake_poll_tasks, fake_consume_tasks):
+        """``_run_admitted`` starts more VMs than the limit, as its own tasks finish"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        fake_poll_tasks.side_effect = lambda vcenter, tasks: {x._moId: None for x in tasks}
+        controller = vmware.admission.AdmissionController(vmware.admission.LocalStore(), per_datastore=1,
+                                                          interval=0, timeout=5)
+        tasks = []
+
+        def start(item):
+            tasks.append(MagicMock())
+            tasks[-1]._moId = 'task-{}'.format(item)
+            return tasks[-1]
+
+        with patch.object(vmware.admission, 'get_controller', return_value=controller):
+            errors, _ = vmware._run_admitted(MagicMock(), ['vm1', 'vm2', 'vm3'], start,
+                                             lambda x: {'datastore:ds1': 1}, MagicMock())
+
+        self.assertEqual(errors, [None, None, None])
+        self.assertEqual(len(tasks), 3)
+        self.assertEqual(controller.usage()['held'], 0)
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_apply_snapshot(self, fake_vCenter, fake_get_snapshots, fake_consume_task):
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, 'get_pool')
+    def test_start_create_snapshot_shift(self, fake_get_pool, fake_iter_tree, fake_start_snapshot, fake_consume_task):
+        """``start_create_snapshot`` does not wait on deleting old snapshots when shift is True"""
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
+        fake_vm = MagicMock()
+        fake_vm.name = 'SomeVM'
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+
+        pending = vmware.start_create_snapshot(username='sam', machine_name='SomeVM', shift=True, logger=MagicMock())
+
+        self.assertTrue(pending.full)
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(vmware, '_start_snapshot')
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, 'get_pool')
+    def test_start_create_snapshot_not_full(self, fake_get_pool, fake_iter_tree, fake_start_snapshot):
+        """``start_create_snapshot`` reports when the VM had room for another snapshot"""
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS - 1)]
+        fake_start_snapshot.return_value = (MagicMock(), 'aabbcc', 1234, 2345)
+        fake_vm = MagicMock()
+        fake_vm.name = 'SomeVM'
+        self.fake_get_resolver.return_value = FakeResolver([fake_vm])
+
+        pending = vmware.start_create_snapshot(username='sam', machine_name='SomeVM', shift=True, logger=MagicMock())
+
+        self.assertFalse(pending.full)
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_apply_snapshot(self, fake_get_pool, fake_iter_snapshots, fake_consume_task):
         """``apply_snapshot`` Returns None when successful"""
-        fake_snap = MagicMock()
-        fake_snap.name = 'asdf_1234_4321'
-        fake_get_snapshots.return_value = [fake_snap]
+        fake_snap = FakeSnapshot('asdf', 1234, 4321)
+        fake_iter_snapshots.return_value = [fake_snap]
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         output = vmware.apply_snapshot(username='alice',
                                        snap_id='asdf',
@@ -268,18 +692,18 @@ class TestVMware(unittest.TestCase):
         self.assertTrue(fake_snap.snapshot.RevertToSnapshot_Task.called)
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_apply_snapshot_no_snap(self, fake_vCenter, fake_get_snapshots, fake_consume_task):
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_apply_snapshot_no_snap(self, fake_get_pool, fake_iter_snapshots, fake_consume_task):
         """``apply_snapshot`` Raises ValueError if the VM does not have a snap by the supplied ID"""
         fake_snap = MagicMock()
         fake_snap.name = 'asdf_1234_4321'
-        fake_get_snapshots.return_value = [fake_snap]
+        fake_iter_snapshots.return_value = [fake_snap]
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.apply_snapshot(username='alice',
@@ -288,18 +712,18 @@ class TestVMware(unittest.TestCase):
                                   logger=MagicMock())
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, '_get_snapshots')
-    @patch.object(vmware, 'vCenter')
-    def test_apply_snapshot_no_vm(self, fake_vCenter, fake_get_snapshots, fake_consume_task):
+    @patch.object(vmware, '_iter_snapshots')
+    @patch.object(vmware, 'get_pool')
+    def test_apply_snapshot_no_vm(self, fake_get_pool, fake_iter_snapshots, fake_consume_task):
         """``apply_snapshot`` Raises ValueError if the VM does not exist"""
         fake_snap = MagicMock()
         fake_snap.name = 'asdf_1234_4321'
-        fake_get_snapshots.return_value = [fake_snap]
+        fake_iter_snapshots.return_value = [fake_snap]
         fake_vm = MagicMock()
         fake_vm.name = 'SomeVM'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        self.fake_get_resolver.return_value = FakeResolver(fake_folder.childEntity)
 
         with self.assertRaises(ValueError):
             vmware.apply_snapshot(username='alice',
@@ -307,24 +731,311 @@ class TestVMware(unittest.TestCase):
                                   machine_name='SomeOtherVM',
                                   logger=MagicMock())
 
-    def test_get_snapshots(self):
-        """``_get_snapshots`` Returns a list of all snapshots"""
-        fake_snap2 = MagicMock()
-        fake_snap2.name = 'fake2'
-        snap_child = MagicMock()
-        snap_child.name = 'child'
-        snap_child.__iter__.return_value = [fake_snap2]
-        fake_snap1 = MagicMock()
-        fake_snap1.name = 'fake1'
-        fake_snap1.childSnapshotList.__iter__.return_value = snap_child
-        snap_root = MagicMock()
-        snap_root.name = 'root'
-        snap_root.__iter__.return_value = [fake_snap1]
-
-        snaps = vmware._get_snapshots(snap_root)
-        expected = [fake_snap1, fake_snap2]
-
-        self.assertEqual(snaps, expected)
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``create_snapshots`` starts every snapshot before waiting on any of them"""
+        fake_consume_tasks.return_value = [None, None]
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1'}, {'obj': vm2, 'name': 'vm2'}]
+
+        output, errors, _ = vmware.create_snapshots('sam', ['vm1', 'vm2'], False, MagicMock())
+        the_args, _ = fake_consume_tasks.call_args
+
+        self.assertEqual(sorted(output.keys()), ['vm1', 'vm2'])
+        self.assertEqual(errors, [])
+        self.assertEqual(fake_consume_tasks.call_count, 1)
+        self.assertEqual(the_args[1], [vm1.CreateSnapshot.return_value, vm2.CreateSnapshot.return_value])
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots_mode(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``create_snapshots`` only dumps memory of VMs that are powered on"""
+        fake_consume_tasks.return_value = [None, None]
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1', 'runtime.powerState': 'poweredOn'},
+                                                {'obj': vm2, 'name': 'vm2', 'runtime.powerState': 'poweredOff'}]
+
+        output, _, _ = vmware.create_snapshots('sam', ['vm1', 'vm2'], False, MagicMock(), mode='memory')
+        vm1_args, _ = vm1.CreateSnapshot.call_args
+        vm2_args, _ = vm2.CreateSnapshot.call_args
+
+        self.assertEqual(output['vm1'][0]['mode'], 'memory')
+        self.assertEqual(output['vm2'][0]['mode'], 'crash')
+        self.assertEqual(vm1_args[1:], ('mode=memory', True, False))
+        self.assertEqual(vm2_args[1:], ('mode=crash', False, False))
+
+    def test_snapshot_flags(self):
+        """``_snapshot_flags`` maps every mode to the CreateSnapshot args"""
+        self.assertEqual(vmware._snapshot_flags('memory', 'poweredOn'), (True, False, 'memory'))
+        self.assertEqual(vmware._snapshot_flags('quiesced', 'poweredOn'), (False, True, 'quiesced'))
+        self.assertEqual(vmware._snapshot_flags('crash', 'poweredOn'), (False, False, 'crash'))
+
+    def test_snapshot_flags_powered_off(self):
+        """``_snapshot_flags`` never dumps memory, or quiesces, a powered off VM"""
+        self.assertEqual(vmware._snapshot_flags('quiesced', 'poweredOff'), (False, False, 'crash'))
+
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_show_snapshot_mode(self, fake_get_pool, fake_inventory):
+        """``show_snapshot`` reports the mode a snapshot was taken with"""
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(),
+                                                 'name': 'SomeVM',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('aaa', 1, 2, 'mode=crash')]}]
+
+        output, _ = vmware.show_snapshot(username='alice')
+
+        self.assertEqual(output['SomeVM'][0]['mode'], 'crash')
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots_errors(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``create_snapshots`` reports VMs that do not exist, or failed to snapshot"""
+        fake_consume_tasks.return_value = ['doh']
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1'}]
+
+        output, errors, _ = vmware.create_snapshots('sam', ['vm1', 'vm2'], False, MagicMock())
+
+        self.assertEqual(output, {})
+        self.assertEqual(len(errors), 2)
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots_start_fault(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``create_snapshots`` reports a VM that vCenter refuses to snapshot, and still snapshots the others"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks, timeout: [None for _ in tasks]
+        vm1, vm2 = MagicMock(), MagicMock()
+        vm1.CreateSnapshot.side_effect = vmware.vim.fault.TaskInProgress(msg='busy')
+        fake_inventory.retrieve.return_value = [{'obj': vm1, 'name': 'vm1'}, {'obj': vm2, 'name': 'vm2'}]
+
+        output, errors, _ = vmware.create_snapshots('sam', ['vm1', 'vm2'], False, MagicMock())
+        the_args, _ = fake_consume_tasks.call_args
+
+        self.assertEqual(list(output.keys()), ['vm2'])
+        self.assertEqual(errors, ['Unable to create snapshot of vm1: busy'])
+        self.assertEqual(the_args[1], [vm2.CreateSnapshot.return_value])
+
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots_max(self, fake_get_pool, fake_inventory, fake_consume_tasks, fake_iter_tree):
+        """``create_snapshots`` does not snapshot VMs with too many snapshots, unless shift is True"""
+        fake_consume_tasks.return_value = []
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1'}]
+
+        output, errors, _ = vmware.create_snapshots('sam', ['vm1'], False, MagicMock())
+
+        self.assertEqual(output, {})
+        self.assertEqual(len(errors), 1)
+
+    @patch.object(vmware, '_remove_snapshots')
+    @patch.object(vmware, '_old_snaps')
+    @patch.object(vmware, '_iter_tree')
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_create_snapshots_shift(self, fake_get_pool, fake_inventory, fake_consume_tasks,
+                                    fake_iter_tree, fake_old_snaps, fake_remove_snapshots):
+        """``create_snapshots`` deletes the oldest snapshots when shift is True"""
+        fake_consume_tasks.return_value = [None]
+        fake_iter_tree.return_value = [x for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_remove_snapshots.return_value = ({}, [])
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1'}]
+
+        output, errors, _ = vmware.create_snapshots('sam', ['vm1'], True, MagicMock())
+        the_args, _ = fake_remove_snapshots.call_args
+
+        self.assertTrue('vm1' in output)
+        self.assertEqual(the_args[1], [('vm1', fake_old_snaps.return_value)])
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_delete_snapshots(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``delete_snapshots`` returns the IDs of the deleted snapshots, per VM"""
+        fake_consume_tasks.return_value = [None, None]
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('aaa', 1, 2)]},
+                                                {'obj': MagicMock(), 'name': 'vm2',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('bbb', 1, 2)]}]
+
+        output, errors = vmware.delete_snapshots('sam', [{'name': 'vm1', 'id': 'aaa'},
+                                                         {'name': 'vm2', 'id': 'bbb'}], MagicMock())
+
+        self.assertEqual(output, {'vm1': ['aaa'], 'vm2': ['bbb']})
+        self.assertEqual(errors, [])
+
+    @patch.object(vmware, '_consume_tasks')
+    @patch.object(vmware, 'inventory')
+    @patch.object(vmware, 'get_pool')
+    def test_delete_snapshots_errors(self, fake_get_pool, fake_inventory, fake_consume_tasks):
+        """``delete_snapshots`` reports VMs and snapshots that do not exist"""
+        fake_consume_tasks.return_value = []
+        fake_inventory.retrieve.return_value = [{'obj': MagicMock(), 'name': 'vm1',
+                                                 'snapshot.rootSnapshotList': [FakeSnapshot('aaa', 1, 2)]}]
+
+        output, errors = vmware.delete_snapshots('sam', [{'name': 'vm1', 'id': 'bbb'},
+                                                         {'name': 'vm2', 'id': 'bbb'}], MagicMock())
+
+        self.assertEqual(output, {})
+        self.assertEqual(len(errors), 2)
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_remove_snapshots_rounds(self, fake_consume_tasks):
+        """``_remove_snapshots`` never runs two deletions on the same VM at once"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks: [None for _ in tasks]
+        snaps = [('vm1', [FakeSnapshot('aaa', 1, 2), FakeSnapshot('bbb', 1, 2)]),
+                 ('vm2', [FakeSnapshot('ccc', 1, 2)])]
+
+        deleted, errors = vmware._remove_snapshots(MagicMock(), snaps, MagicMock())
+        batch_sizes = [len(the_args[1]) for the_args, _ in fake_consume_tasks.call_args_list]
+
+        self.assertEqual(batch_sizes, [2, 1])
+        self.assertEqual(deleted, {'vm1': ['aaa', 'bbb'], 'vm2': ['ccc']})
+
+    @patch.object(vmware, '_consume_tasks')
+    def test_remove_snapshots_start_fault(self, fake_consume_tasks):
+        """``_remove_snapshots`` reports a deletion vCenter refuses to start, and still deletes the others"""
+        fake_consume_tasks.side_effect = lambda vcenter, tasks: [None for _ in tasks]
+        busy = FakeSnapshot('aaa', 1, 2)
+        busy.snapshot.RemoveSnapshot_Task.side_effect = vmware.vim.fault.TaskInProgress(msg='busy')
+        snaps = [('vm1', [busy]), ('vm2', [FakeSnapshot('ccc', 1, 2)])]
+
+        deleted, errors = vmware._remove_snapshots(MagicMock(), snaps, MagicMock())
+
+        self.assertEqual(deleted, {'vm2': ['ccc']})
+        self.assertEqual(errors, ['Unable to delete snapshot aaa_1_2 of vm1: busy'])
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware, 'inventory')
+    def test_consume_tasks(self, fake_inventory, fake_sleep):
+        """``_consume_tasks`` polls every task in one call until they are all done"""
+        task1, task2 = MagicMock(), MagicMock()
+        task1._moId, task2._moId = 'task-1', 'task-2'
+        error = MagicMock()
+        error.msg = 'doh'
+        fake_inventory.retrieve.side_effect = [[{'obj': task1, 'info.state': 'success'},
+                                                {'obj': task2, 'info.state': 'running'}],
+                                               [{'obj': task2, 'info.state': 'error', 'info.error': error}]]
+
+        errors = vmware._consume_tasks(MagicMock(), [task1, task2])
+
+        self.assertEqual(errors, [None, 'doh'])
+        self.assertEqual(fake_inventory.retrieve.call_count, 2)
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware, 'inventory')
+    def test_consume_tasks_timeout(self, fake_inventory, fake_sleep):
+        """``_consume_tasks`` gives up on tasks that take too long"""
+        task1 = MagicMock()
+        task1._moId = 'task-1'
+        fake_inventory.retrieve.return_value = [{'obj': task1, 'info.state': 'running'}]
+
+        errors = vmware._consume_tasks(MagicMock(), [task1], timeout=2)
+
+        self.assertTrue(errors[0].startswith('Timeout'))
+
+    def test_iter_snapshots(self):
+        """``_iter_snapshots`` yields every snapshot in the tree"""
+        fake_snap2 = FakeSnapshot('bbb', 2, 4321)
+        fake_snap1 = FakeSnapshot('aaa', 1, 4321)
+        fake_snap1.childSnapshotList = [fake_snap2]
+
+        snaps = list(vmware._iter_snapshots([fake_snap1]))
+        expected = ['aaa', 'bbb']
+
+        self.assertEqual([x.id for x in snaps], expected)
+        self.assertTrue(snaps[1].snapshot is fake_snap2.snapshot)
+
+    def test_iter_snapshots_foreign(self):
+        """``_iter_snapshots`` skips snapshots that vLab did not take, but not their children"""
+        fake_snap2 = FakeSnapshot('bbb', 2, 4321)
+        fake_snap1 = FakeSnapshot('aaa', 1, 4321)
+        fake_snap1.name = 'before upgrade'
+        fake_snap1.childSnapshotList = [fake_snap2]
+
+        snaps = list(vmware._iter_snapshots([fake_snap1]))
+
+        self.assertEqual([x.id for x in snaps], ['bbb'])
+
+    def test_find_by_id(self):
+        """``_find_by_id`` stops walking the tree once the snapshot is found"""
+        fake_snap2 = FakeSnapshot('bbb', 2, 4321)
+        fake_snap2.childSnapshotList = MagicMock()
+        fake_snap1 = FakeSnapshot('aaa', 1, 4321)
+        fake_snap1.childSnapshotList = [fake_snap2]
+
+        snap = vmware._find_by_id([fake_snap1], 'aaa')
+
+        self.assertEqual(snap.id, 'aaa')
+        self.assertFalse(fake_snap2.childSnapshotList.__iter__.called)
+
+    def test_find_by_id_missing(self):
+        """``_find_by_id`` returns None when the VM has no such snapshot"""
+        self.assertTrue(vmware._find_by_id([FakeSnapshot('aaa', 1, 4321)], 'bbb') is None)
+
+    def test_snapshot_index(self):
+        """``_snapshot_index`` maps snapshot IDs to their records"""
+        fake_snap2 = FakeSnapshot('bbb', 2, 4321)
+        fake_snap1 = FakeSnapshot('aaa', 1, 4321)
+        fake_snap1.childSnapshotList = [fake_snap2]
+
+        index = vmware._snapshot_index([fake_snap1])
+
+        self.assertEqual(sorted(index.keys()), ['aaa', 'bbb'])
+        self.assertEqual(index['bbb'].created, 2)
+
+    def test_count_snapshots(self):
+        """``_count_snapshots`` counts every snapshot in the tree"""
+        fake_snap2 = FakeSnapshot('bbb', 2, 4321)
+        fake_snap1 = FakeSnapshot('aaa', 1, 4321)
+        fake_snap1.childSnapshotList = [fake_snap2]
+
+        self.assertEqual(vmware._count_snapshots([fake_snap1, FakeSnapshot('ccc', 3, 4321)]), 3)
+
+    def test_old_snaps_manual(self):
+        """``_old_snaps`` counts manual snapshots toward the limit, but only returns vLab snapshots"""
+        manual = FakeSnapshot('zzz', 0, 4321)
+        manual.name = 'before upgrade'
+        vlab_snaps = [FakeSnapshot('{:03d}'.format(x), x + 1, 4321) for x in range(vmware.const.VLAB_MAX_SNAPSHOTS)]
+        fake_vm = MagicMock()
+        fake_vm.snapshot.rootSnapshotList = [manual] + vlab_snaps
+
+        old = vmware._old_snaps(fake_vm)
+
+        self.assertEqual([x.id for x in old], ['000'])
+
+    def test_old_snaps_all_manual(self):
+        """``_old_snaps`` never returns the snapshot that was just taken, even if every other one is manual"""
+        manual = []
+        for index in range(vmware.const.VLAB_MAX_SNAPSHOTS):
+            manual.append(FakeSnapshot('m{}'.format(index), index, 4321))
+            manual[-1].name = 'manual {}'.format(index)
+        fake_vm = MagicMock()
+        fake_vm.snapshot.rootSnapshotList = manual + [FakeSnapshot('abcdef', 2000, 9000)]
+
+        old = vmware._old_snaps(fake_vm, before=2000)
+
+        self.assertEqual(old, [])
+
+    def test_old_snaps_mostly_manual(self):
+        """``_old_snaps`` only returns vLab snapshots older than the one just taken"""
+        manual = FakeSnapshot('zzz', 0, 4321)
+        manual.name = 'before upgrade'
+        manual.childSnapshotList = [FakeSnapshot('{:03d}'.format(x), x + 1, 4321)
+                                    for x in range(vmware.const.VLAB_MAX_SNAPSHOTS - 1)]
+        fake_vm = MagicMock()
+        fake_vm.snapshot.rootSnapshotList = [manual, FakeSnapshot('abcdef', 2000, 9000), FakeSnapshot('other', 3000, 9000)]
+
+        old = vmware._old_snaps(fake_vm, before=2000)
+
+        self.assertEqual([x.id for x in old], ['000', '001'])
 
 
 if __name__ == '__main__':
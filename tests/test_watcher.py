@@ -0,0 +1,184 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``watcher.py`` module"""
+import unittest
+from unittest.mock import MagicMock
+
+from pyVmomi import vim, vmodl
+
+from vlab_snapshot_api.lib.worker import watcher
+
+
+PC = vmodl.query.PropertyCollector
+
+
+class FakePropertyCollector(object):
+    """A local stand-in for a vCenter PropertyCollector. Queue up changes with
+    ``enter``/``modify``/``leave`` and ``emit``, and they're returned by the next
+    call to ``WaitForUpdatesEx`` as a real UpdateSet. When there's nothing left
+    to return, ``WaitForUpdatesEx`` raises ``RuntimeError`` so that loops which
+    never end (like the reaper) can be tested.
+    """
+    def __init__(self):
+        self.filters = []
+        self.destroyed = False
+        self.versions = []
+        self._queued = []
+        self._pending = []
+
+    def CreatePropertyCollector(self):
+        return self
+
+    def DestroyPropertyCollector(self):
+        self.destroyed = True
+
+    def CreateFilter(self, spec, partialUpdates):
+        self.filters.append(spec)
+        return MagicMock()
+
+    def _update(self, kind, moid, **props):
+        changes = [PC.Change(name=name, op='assign', val=val) for name, val in props.items()]
+        self._pending.append(PC.ObjectUpdate(kind=kind, obj=vim.VirtualMachine(moid), changeSet=changes))
+
+    def enter(self, moid, **props):
+        """Queue up a VM being created"""
+        self._update('enter', moid, **props)
+
+    def modify(self, moid, **props):
+        """Queue up a change to a VM"""
+        self._update('modify', moid, **props)
+
+    def leave(self, moid):
+        """Queue up a VM being deleted"""
+        self._update('leave', moid)
+
+    def emit(self, truncated=False):
+        """Bundle every queued change into a single UpdateSet"""
+        filter_update = PC.FilterUpdate(objectSet=self._pending)
+        self._queued.append(PC.UpdateSet(version=str(len(self._queued) + 1),
+                                         filterSet=[filter_update],
+                                         truncated=truncated))
+        self._pending = []
+
+    def timeout(self):
+        """Queue up a call to WaitForUpdatesEx that finds no changes"""
+        self._queued.append(None)
+
+    def WaitForUpdatesEx(self, version, options):
+        self.versions.append(version)
+        if not self._queued:
+            raise RuntimeError('No more updates')
+        return self._queued.pop(0)
+
+
+def make_snapshot_tree(*names):
+    """Create a flat list of snapshots, like ``snapshot.rootSnapshotList``"""
+    # binding to a fake SOAP stub lets tests call methods like RemoveSnapshot_Task
+    stub = MagicMock()
+    return vim.vm.SnapshotTree.Array([vim.vm.SnapshotTree(name=name, snapshot=vim.vm.Snapshot('snapshot-{}'.format(name), stub=stub))
+                                      for name in names])
+
+
+class TestInventoryWatcher(unittest.TestCase):
+    """A suite of test cases for the ``InventoryWatcher`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.collector = FakePropertyCollector()
+        vcenter = MagicMock()
+        vcenter.content.propertyCollector = cls.collector
+        cls.watcher = watcher.InventoryWatcher(vcenter, ['name', 'snapshot.rootSnapshotList'])
+        cls.watcher.start(vim.Folder('group-v1'))
+
+    def test_start(self):
+        """``InventoryWatcher.start`` creates a filter over the requested VM properties"""
+        spec = self.collector.filters[0]
+
+        self.assertEqual(spec.propSet[0].pathSet, ['name', 'snapshot.rootSnapshotList'])
+
+    def test_enter(self):
+        """``InventoryWatcher.updates`` yields new VMs"""
+        self.collector.enter('vm-1', name='myVM')
+        self.collector.emit()
+
+        found = list(self.watcher.updates(10))
+
+        self.assertEqual(found[0]['name'], 'myVM')
+        self.assertTrue('vm-1' in self.watcher.vms)
+
+    def test_modify(self):
+        """``InventoryWatcher.updates`` merges changes into what it already knows"""
+        self.collector.enter('vm-1', name='myVM')
+        self.collector.emit()
+        self.collector.modify('vm-1', **{'snapshot.rootSnapshotList': make_snapshot_tree('a_1_2')})
+        self.collector.emit()
+
+        list(self.watcher.updates(10))
+        found = list(self.watcher.updates(10))
+
+        self.assertEqual(found[0]['name'], 'myVM')
+        self.assertEqual(found[0]['snapshot.rootSnapshotList'][0].name, 'a_1_2')
+
+    def test_modify_unset(self):
+        """``InventoryWatcher.updates`` drops properties that become unset"""
+        self.collector.enter('vm-1', name='myVM', **{'snapshot.rootSnapshotList': make_snapshot_tree('a_1_2')})
+        self.collector.emit()
+        self.collector.modify('vm-1', **{'snapshot.rootSnapshotList': None})
+        self.collector.emit()
+
+        list(self.watcher.updates(10))
+        found = list(self.watcher.updates(10))
+
+        self.assertFalse('snapshot.rootSnapshotList' in found[0])
+
+    def test_leave(self):
+        """``InventoryWatcher.updates`` forgets VMs that are deleted"""
+        self.collector.enter('vm-1', name='myVM')
+        self.collector.emit()
+        self.collector.leave('vm-1')
+        self.collector.emit()
+
+        list(self.watcher.updates(10))
+        found = list(self.watcher.updates(10))
+
+        self.assertEqual(list(found[0].keys()), ['obj'])
+        self.assertEqual(self.watcher.vms, {})
+
+    def test_timeout(self):
+        """``InventoryWatcher.updates`` yields nothing when there are no changes"""
+        self.collector.timeout()
+
+        found = list(self.watcher.updates(10))
+
+        self.assertEqual(found, [])
+
+    def test_version(self):
+        """``InventoryWatcher.updates`` only asks for changes since the last update"""
+        self.collector.enter('vm-1', name='myVM')
+        self.collector.emit()
+        self.collector.timeout()
+
+        list(self.watcher.updates(10))
+        list(self.watcher.updates(10))
+
+        self.assertEqual(self.collector.versions, ['', '1'])
+
+    def test_truncated(self):
+        """``InventoryWatcher.updates`` keeps reading while the server has more changes queued"""
+        self.collector.enter('vm-1', name='myVM')
+        self.collector.emit(truncated=True)
+        self.collector.enter('vm-2', name='myOtherVM')
+        self.collector.emit()
+
+        found = [x['name'] for x in self.watcher.updates(10)]
+
+        self.assertEqual(found, ['myVM', 'myOtherVM'])
+
+    def test_stop(self):
+        """``InventoryWatcher.stop`` destroys the PropertyCollector"""
+        self.watcher.stop()
+
+        self.assertTrue(self.collector.destroyed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,9 @@ from vlab_snapshot_api.lib import const
 from vlab_snapshot_api.lib.views import HealthView, SnapshotView
 
 app = Flask(__name__)
-app.celery_app = Celery('snapshot', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+# Not rpc://; it keeps the reply queue per thread (and so per greenlet), and a
+# request for a task's status must see results sent by any other request.
+app.celery_app = Celery('snapshot', backend=const.VLAB_RESULT_BACKEND, broker=const.VLAB_MESSAGE_BROKER)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
 
 HealthView.register(app)
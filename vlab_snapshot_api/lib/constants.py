@@ -19,13 +19,46 @@ DEFINED = OrderedDict([
             ('INF_VCENTER_USERS_DIR', environ.get('INF_VCENTER_USERS_DIR', 'vlab')),
             ('INF_VCENTER_VERIFY_CERT', environ.get('INF_VCENTER_VERIFY_CERT', False)),
             ('VLAB_MESSAGE_BROKER', environ.get('VLAB_MESSAGE_BROKER', 'snapshot-broker')),
+            ('VLAB_RESULT_BACKEND', environ.get('VLAB_RESULT_BACKEND', 'redis://snapshot-results:6379/0')),
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
             ('VLAB_MAX_SNAPSHOTS', 3),
             ('VLAB_SNAPSHOT_EXPIRES_AFTER', 259200), # seconds -> 72hrs
             ('VLAB_SNAP_ID', 0),
             ('VLAB_SNAP_CREATED', 1),
-            ('VLAB_SNAP_EXPIRES', 2)
+            ('VLAB_SNAP_EXPIRES', 2),
+            ('VLAB_QUEUE_READ', environ.get('VLAB_QUEUE_READ', 'snapshot_read')),
+            ('VLAB_QUEUE_WRITE', environ.get('VLAB_QUEUE_WRITE', 'snapshot_write')),
+            ('VLAB_QUEUE_PRUNE', environ.get('VLAB_QUEUE_PRUNE', 'snapshot_prune')),
+            ('VLAB_WORKER_QUEUES', environ.get('VLAB_WORKER_QUEUES', '')), # comma separated; empty means every queue
+            ('VLAB_WORKER_PREFETCH', int(environ.get('VLAB_WORKER_PREFETCH', 1))),
+            ('VLAB_REGISTRY_CACHE', environ.get('VLAB_REGISTRY_CACHE', 'snapshot')),
+            ('VLAB_SHOW_FRESH', int(environ.get('VLAB_SHOW_FRESH', 2))), # seconds
+            ('VLAB_SHOW_INFLIGHT_TTL', int(environ.get('VLAB_SHOW_INFLIGHT_TTL', 60))), # seconds
+            ('VLAB_TASK_MAX_WAIT', int(environ.get('VLAB_TASK_MAX_WAIT', 30))), # seconds
+            ('VLAB_TASK_WAIT_INTERVAL', float(environ.get('VLAB_TASK_WAIT_INTERVAL', 0.5))), # seconds
+            ('VLAB_TASK_STREAM_TIMEOUT', int(environ.get('VLAB_TASK_STREAM_TIMEOUT', 1800))), # seconds
+            ('VLAB_VCENTER_MAX_SESSIONS', int(environ.get('VLAB_VCENTER_MAX_SESSIONS', 4))),
+            ('VLAB_VCENTER_KEEP_ALIVE', int(environ.get('VLAB_VCENTER_KEEP_ALIVE', 600))), # seconds
+            ('VLAB_RESOLVER_TTL', int(environ.get('VLAB_RESOLVER_TTL', 300))), # seconds
+            ('VLAB_RESOLVER_MAX_ENTRIES', int(environ.get('VLAB_RESOLVER_MAX_ENTRIES', 4096))),
+            ('VLAB_TRACKER_INTERVAL', int(environ.get('VLAB_TRACKER_INTERVAL', 2))), # seconds
+            ('VLAB_TRACKER_TIMEOUT', int(environ.get('VLAB_TRACKER_TIMEOUT', 1800))), # seconds
+            ('VLAB_PRUNE_RETRIES', int(environ.get('VLAB_PRUNE_RETRIES', 5))),
+            ('VLAB_PRUNE_RETRY_DELAY', int(environ.get('VLAB_PRUNE_RETRY_DELAY', 60))), # seconds
+            ('VLAB_ADMISSION_STATE', environ.get('VLAB_ADMISSION_STATE', '')), # a file shared by every worker; empty means per process
+            ('VLAB_ADMISSION_PER_HOST', int(environ.get('VLAB_ADMISSION_PER_HOST', 4))),
+            ('VLAB_ADMISSION_PER_DATASTORE', int(environ.get('VLAB_ADMISSION_PER_DATASTORE', 2))),
+            ('VLAB_ADMISSION_INTERVAL', float(environ.get('VLAB_ADMISSION_INTERVAL', 1))), # seconds
+            ('VLAB_ADMISSION_TIMEOUT', int(environ.get('VLAB_ADMISSION_TIMEOUT', 900))), # seconds
+            ('VLAB_ADMISSION_LEASE', int(environ.get('VLAB_ADMISSION_LEASE', 3600))), # seconds
+            ('VLAB_REAPER_PAGE_SIZE', int(environ.get('VLAB_REAPER_PAGE_SIZE', 500))),
+            ('VLAB_REAPER_WATCH', environ.get('VLAB_REAPER_WATCH', 'false').lower() == 'true'),
+            ('VLAB_REAPER_RESCAN_INTERVAL', int(environ.get('VLAB_REAPER_RESCAN_INTERVAL', 3600))), # seconds
+            ('VLAB_REAPER_MAX_WORKERS', int(environ.get('VLAB_REAPER_MAX_WORKERS', 8))),
+            ('VLAB_REAPER_MAX_PER_HOST', int(environ.get('VLAB_REAPER_MAX_PER_HOST', 2))),
+            ('VLAB_REAPER_MAX_PER_DATASTORE', int(environ.get('VLAB_REAPER_MAX_PER_DATASTORE', 2))),
+            ('VLAB_REAPER_METRICS_PORT', int(environ.get('VLAB_REAPER_METRICS_PORT', 9102))), # 0 disables /metrics
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""
+A small key/value store shared by every process of the API.
+
+Under uWSGI this is a ``cache2`` cache (see ``app.ini``), so all the API
+processes see the same entries. Everywhere else (i.e. unit tests, or running
+``app.py`` directly) a process-local dictionary stands in for it.
+"""
+import time
+import threading
+
+try:
+    import uwsgi
+except ImportError:
+    # only importable when running under uWSGI
+    uwsgi = None
+
+from vlab_snapshot_api.lib import const
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+class LocalRegistry(object):
+    """A registry that only exists within a single process"""
+    def __init__(self):
+        self._data = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Lookup a value, or None when it does not exist (or has expired)
+
+        :Returns: String
+        """
+        with self._lock:
+            value, expires = self._data.get(key, (None, 0))
+            if value is not None and expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        """Store a value for ``ttl`` seconds
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+
+    def incr(self, key):
+        """Add one to a counter
+
+        :Returns: None
+        """
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def counter(self, key):
+        """Read a counter
+
+        :Returns: Integer
+        """
+        with self._lock:
+            return self._counters.get(key, 0)
+
+
+class UwsgiRegistry(object):
+    """A registry backed by a uWSGI ``cache2`` cache
+
+    :param cache_name: The name of the cache, as defined in ``app.ini``
+    :type cache_name: String
+    """
+    def __init__(self, cache_name):
+        self._cache = cache_name
+
+    def get(self, key):
+        """Lookup a value, or None when it does not exist (or has expired)
+
+        :Returns: String
+        """
+        value = uwsgi.cache_get(key, self._cache)
+        if value is None:
+            return None
+        return value.decode()
+
+    def set(self, key, value, ttl):
+        """Store a value for ``ttl`` seconds
+
+        :Returns: None
+        """
+        uwsgi.cache_update(key, value.encode(), ttl, self._cache)
+
+    def incr(self, key):
+        """Add one to a counter
+
+        :Returns: None
+        """
+        uwsgi.cache_inc(key, 1, 0, self._cache)
+
+    def counter(self, key):
+        """Read a counter
+
+        :Returns: Integer
+        """
+        return uwsgi.cache_num(key, self._cache) or 0
+
+
+def get_registry():
+    """The registry for this process
+
+    :Returns: LocalRegistry or UwsgiRegistry
+    """
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            if uwsgi is None:
+                _REGISTRY = LocalRegistry()
+            else:
+                _REGISTRY = UwsgiRegistry(const.VLAB_REGISTRY_CACHE)
+        return _REGISTRY
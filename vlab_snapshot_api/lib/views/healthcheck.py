@@ -2,14 +2,34 @@
 """
 Enables Health checks for the power API
 """
-from time import time
-import pkg_resources
-
 import ujson
 from flask_classy import FlaskView, Response
-from vlab_inf_common.vmware import vCenter
 
-from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.registry import get_registry
+
+
+def _get_version():
+    """The installed version of this package; looked up once, when the module
+    is imported, instead of on every health check.
+
+    :Returns: String
+    """
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution('vlab-snapshot-api').version
+        except pkg_resources.DistributionNotFound:
+            return 'unknown'
+    try:
+        return version('vlab-snapshot-api')
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+VERSION = _get_version()
 
 
 class HealthView(FlaskView):
@@ -23,8 +43,22 @@ class HealthView(FlaskView):
         """End point for health checks"""
         resp = {}
         status = 200
-        resp['version'] = pkg_resources.get_distribution('vlab-snapshot-api').version
+        resp['version'] = VERSION
+        resp['show_coalesce'] = _coalesce_stats()
         response = Response(ujson.dumps(resp))
         response.status_code = status
         response.headers['Content-Type'] = 'application/json'
         return response
+
+
+def _coalesce_stats():
+    """How often a GET on /api/1/inf/snapshot reused a running ``snapshot.show`` task
+
+    :Returns: Dictionary
+    """
+    registry = get_registry()
+    hits = registry.counter('show_hits')
+    misses = registry.counter('show_misses')
+    total = hits + misses
+    return {'hits': hits, 'misses': misses,
+            'hit_ratio': round(hits / total, 3) if total else 0}
@@ -2,15 +2,19 @@
 """
 Defines the RESTful API for working with snapshots in vLab
 """
+import time
+from datetime import timezone
+
 import ujson
 from flask import current_app
+from celery.utils.iso8601 import parse_iso8601
 from flask_classy import request, route, Response
 from vlab_inf_common.views import TaskView
-from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
 from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.registry import get_registry
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL)
@@ -24,19 +28,27 @@ class SnapshotView(TaskView):
                     "description": "Create a snapshot; Maximum per VM is {}".format(const.VLAB_MAX_SNAPSHOTS),
                     "properties": {
                         "name": {
-                            "description": "The virtual machine to take a snapshot of",
-                            "type": "string"
+                            "description": "The virtual machine to take a snapshot of, or a list of virtual machines",
+                            "type": ["string", "array"],
+                            "items": {"type": "string"},
+                            "minItems": 1
                         },
                         "shift": {
                             "description": "When a VM has the maximum number of snaps, delete the oldest and take a new snapshot",
                             "type": "boolean",
                             "default": "false"
+                        },
+                        "mode": {
+                            "description": "memory includes the VM's RAM, quiesced flushes the guest's buffers to disk first (requires VMware Tools), and crash only captures the disks, which is fastest. Powered off VMs always get a crash snapshot",
+                            "type": "string",
+                            "enum": ["memory", "quiesced", "crash"],
+                            "default": "memory"
                         }
                     },
                     "required": ["name"]
                   }
     DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
-                     "description": "Destroy a Snapshot",
+                     "description": "Destroy a Snapshot, or supply 'snapshots' to destroy many",
                      "type": "object",
                      "properties": {
                         "id": {
@@ -46,12 +58,39 @@ class SnapshotView(TaskView):
                         "name": {
                             "description": "The VM that owns the snapshot",
                             "type": "string"
+                        },
+                        "snapshots": {
+                            "description": "Many snapshots to destroy",
+                            "type": "array",
+                            "minItems": 1,
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "id": {
+                                        "description": "The Snapshot unique ID",
+                                        "type": "string"
+                                    },
+                                    "name": {
+                                        "description": "The VM that owns the snapshot",
+                                        "type": "string"
+                                    }
+                                },
+                                "required": ["name", "id"]
+                            }
                         }
                      },
-                     "required": ["name", "id"]
+                     "oneOf": [{"required": ["name", "id"]},
+                               {"required": ["snapshots"]}]
                     }
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
-                  "description": "Display the Snapshot instances you own"
+                  "description": "Display the Snapshot instances you own",
+                  "type": "object",
+                  "properties": {
+                     "fingerprint": {
+                        "description": "Query param; the fingerprint from a previous response. Only VMs that changed since then are returned",
+                        "type": "string"
+                     }
+                  }
                  }
     PUT_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "Apply a Snapshot to a VM",
@@ -69,6 +108,43 @@ class SnapshotView(TaskView):
                      "required": ["name", "id"]
                     }
 
+    CHECKPOINT_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                         "description": "Snapshot every VM in your lab, as a single checkpoint",
+                         "type": "object",
+                         "properties": {
+                            "shift": {
+                                "description": "When a VM has the maximum number of snaps, delete the oldest and take a new snapshot",
+                                "type": "boolean",
+                                "default": "false"
+                            }
+                         }
+                        }
+    REVERT_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "Revert every VM in your lab to a checkpoint",
+                     "type": "object",
+                     "properties": {
+                        "id": {
+                            "description": "The checkpoint unique ID",
+                            "type": "string"
+                        }
+                     },
+                     "required": ["id"]
+                    }
+    TASK_WAIT_ARGS = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "type": "object",
+                      "properties": {
+                         "task-id": {
+                             "description": "The Task Id. Optionally index the URL with the task id",
+                             "type": "string"
+                         },
+                         "wait": {
+                             "description": "Query param; hold the request until the task is done, or this many seconds pass. Maximum is {}".format(const.VLAB_TASK_MAX_WAIT),
+                             "type": "number"
+                         }
+                      },
+                      "required": ["task-id"]
+                     }
+
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA, put=PUT_SCHEMA)
     def get(self, *args, **kwargs):
@@ -76,11 +152,12 @@ class SnapshotView(TaskView):
         username = kwargs['token']['username']
         resp_data = {'user' : username}
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        task = current_app.celery_app.send_task('snapshot.show', [username, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        fingerprint = request.args.get('fingerprint', None)
+        task_id = _show_task(username, txn_id, fingerprint)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -93,7 +170,11 @@ class SnapshotView(TaskView):
         body = kwargs['body']
         machine_name = body['name']
         shift = body.get('shift', False)
-        task = current_app.celery_app.send_task('snapshot.create', [username, machine_name, shift, txn_id])
+        mode = body.get('mode', 'memory')
+        if isinstance(machine_name, list):
+            task = current_app.celery_app.send_task('snapshot.create_many', [username, machine_name, shift, txn_id, mode], queue=const.VLAB_QUEUE_WRITE)
+        else:
+            task = current_app.celery_app.send_task('snapshot.create', [username, machine_name, shift, txn_id, mode], queue=const.VLAB_QUEUE_WRITE)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -107,9 +188,13 @@ class SnapshotView(TaskView):
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        snap_id = kwargs['body'].get('id', -1)
-        machine_name = kwargs['body']['name']
-        task = current_app.celery_app.send_task('snapshot.delete', [username, snap_id, machine_name, txn_id])
+        if 'snapshots' in kwargs['body']:
+            snapshots = [{'name': x['name'], 'id': x['id']} for x in kwargs['body']['snapshots']]
+            task = current_app.celery_app.send_task('snapshot.delete_many', [username, snapshots, txn_id], queue=const.VLAB_QUEUE_WRITE)
+        else:
+            snap_id = kwargs['body'].get('id', -1)
+            machine_name = kwargs['body']['name']
+            task = current_app.celery_app.send_task('snapshot.delete', [username, snap_id, machine_name, txn_id], queue=const.VLAB_QUEUE_WRITE)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -125,9 +210,193 @@ class SnapshotView(TaskView):
         resp_data = {'user' : username}
         snap_id = kwargs['body']['id']
         machine_name = kwargs['body']['name']
-        task = current_app.celery_app.send_task('snapshot.apply', [username, snap_id, machine_name, txn_id])
+        task = current_app.celery_app.send_task('snapshot.apply', [username, snap_id, machine_name, txn_id], queue=const.VLAB_QUEUE_WRITE)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/lab', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=CHECKPOINT_SCHEMA)
+    @describe(post=CHECKPOINT_SCHEMA, put=REVERT_SCHEMA)
+    def checkpoint(self, *args, **kwargs):
+        """Snapshot every VM in a lab"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        shift = kwargs['body'].get('shift', False)
+        task = current_app.celery_app.send_task('snapshot.checkpoint', [username, shift, txn_id], queue=const.VLAB_QUEUE_WRITE)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/lab', methods=["PUT"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=REVERT_SCHEMA)
+    def revert(self, *args, **kwargs):
+        """Revert every VM in a lab to a checkpoint"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        snap_id = kwargs['body']['id']
+        task = current_app.celery_app.send_task('snapshot.revert', [username, snap_id, txn_id], queue=const.VLAB_QUEUE_WRITE)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=TASK_WAIT_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """End point for checking the status of Celery tasks
+
+        Supply ``wait`` to hold the request until the task is done, or that many
+        seconds pass. Under uWSGI this runs in a gevent greenlet, so a waiting
+        client does not hold a whole worker.
+        """
+        try:
+            wait = min(float(request.args.get('wait', 0)), const.VLAB_TASK_MAX_WAIT)
+        except ValueError:
+            resp = {'user': kwargs['token']['username'], 'content' : {}}
+            resp['error'] = 'wait must be a number of seconds'
+            return ujson.dumps(resp), 400
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if wait > 0 and task_id is not None:
+            _wait_for_task(task_id, wait)
+        return super().handle_task(*args, **kwargs)
+
+    @route('/task/<tid>/stream', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def stream_task(self, *args, **kwargs):
+        """Relay the progress of a Celery task as server-sent events"""
+        celery_app = current_app.celery_app
+        resp = Response(_task_events(celery_app, kwargs['tid']), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        # so nginx doesn't hold events back in its buffer
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
+
+def _show_task(username, txn_id, fingerprint):
+    """Obtain the ID of a ``snapshot.show`` task for the user. A task that is
+    still running, or finished within the last ``const.VLAB_SHOW_FRESH``
+    seconds, is reused instead of walking the user's lab again.
+
+    :Returns: String
+
+    :param username: The user who wants to see their snapshots
+    :type username: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param fingerprint: The lab fingerprint the client last saw
+    :type fingerprint: String
+    """
+    registry = get_registry()
+    # Results are in the shared result backend, so a task sent by any API
+    # process (or greenlet) can be reused by every other one.
+    key = 'show:{}:{}'.format(username, fingerprint or '')
+    task_id = registry.get(key)
+    if task_id is not None:
+        result = current_app.celery_app.AsyncResult(task_id)
+        if not result.ready() or _finished_within(result, const.VLAB_SHOW_FRESH):
+            registry.incr('show_hits')
+            return task_id
+    registry.incr('show_misses')
+    task = current_app.celery_app.send_task('snapshot.show', [username, txn_id, fingerprint], queue=const.VLAB_QUEUE_READ)
+    registry.set(key, task.id, const.VLAB_SHOW_INFLIGHT_TTL)
+    return task.id
+
+
+def _finished_within(result, seconds):
+    """Test if a Celery task that's done finished within the last ``seconds``.
+    A slow task is only as fresh as its result, not as when it was sent.
+
+    :Returns: Boolean
+
+    :param result: The Celery task that's done
+    :type result: celery.result.AsyncResult
+
+    :param seconds: How old the result can be
+    :type seconds: Integer
+    """
+    date_done = result.date_done
+    if isinstance(date_done, str):
+        # Celery 4 leaves the ISO 8601 string of some backends as is
+        date_done = parse_iso8601(date_done)
+    if date_done is None:
+        return False
+    if date_done.tzinfo is None:
+        # Celery records it in UTC
+        date_done = date_done.replace(tzinfo=timezone.utc)
+    return time.time() - date_done.timestamp() <= seconds
+
+
+def _wait_for_task(task_id, wait):
+    """Block until a Celery task is done, or ``wait`` seconds pass. With gevent
+    the sleep yields to other requests, instead of holding the uWSGI worker.
+
+    :Returns: None
+
+    :param task_id: The Celery task to wait on
+    :type task_id: String
+
+    :param wait: The most seconds to wait
+    :type wait: Float
+    """
+    deadline = time.time() + wait
+    result = current_app.celery_app.AsyncResult(task_id)
+    while not result.ready():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(const.VLAB_TASK_WAIT_INTERVAL, remaining))
+
+
+def _task_events(celery_app, task_id):
+    """Yield a server-sent event every time a Celery task changes state (or
+    progress), until it's done. The last event is the task's result.
+
+    :Returns: Generator
+
+    :param celery_app: The Celery app that sent the task
+    :type celery_app: celery.Celery
+
+    :param task_id: The Celery task to follow
+    :type task_id: String
+    """
+    deadline = time.time() + const.VLAB_TASK_STREAM_TIMEOUT
+    result = celery_app.AsyncResult(task_id)
+    last = None
+    while True:
+        if result.ready():
+            if result.status == 'SUCCESS':
+                data = result.result
+            else:
+                data = {'error': '{}'.format(result.result)}
+            yield _event(result.status, data)
+            return
+        current = (result.status, result.info if isinstance(result.info, dict) else None)
+        if current != last:
+            last = current
+            yield _event(current[0], current[1] or {})
+        if time.time() > deadline:
+            yield _event('TIMEOUT', {'error': 'Stopped streaming after {} seconds'.format(const.VLAB_TASK_STREAM_TIMEOUT)})
+            return
+        time.sleep(const.VLAB_TASK_WAIT_INTERVAL)
+
+
+def _event(name, data):
+    """Format a server-sent event
+
+    :Returns: String
+    """
+    return 'event: {}\ndata: {}\n\n'.format(name, ujson.dumps(data))
@@ -0,0 +1,240 @@
+# -*- coding: UTF-8 -*-
+"""
+Limits how many snapshots are taken (or reverted to) at once on the same
+datastore, or ESXi host.
+
+A memory snapshot writes the whole RAM of a VM to its datastore. When a class
+of users all click "snapshot" at once, those writes slow down every VM on the
+array. Before starting a CreateSnapshot or RevertToSnapshot_Task, a worker asks
+the ``AdmissionController`` for a slot on the VM's host and datastores, and
+waits until one is free. Waiters are admitted in the order they arrived; a
+request only waits behind earlier requests that need the same host or datastore.
+
+The slots are counted in a store shared by every worker process. The
+``FileStore`` is a JSON file guarded by ``flock``, so point
+``VLAB_ADMISSION_STATE`` at a path every worker can see. Without it, a
+``LocalStore`` stands in, which only limits the current process.
+"""
+import time
+import uuid
+import fcntl
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_snapshot_api.lib import const
+
+
+_CONTROLLER = None
+_CONTROLLER_LOCK = threading.Lock()
+
+# ``waited`` is how many seconds it took to be admitted
+Ticket = namedtuple('Ticket', 'id waited')
+
+
+class LocalStore(object):
+    """Admission state that only exists within a single process"""
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        """Exclusive access to the state; changes made to it are kept
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            yield self._state
+
+
+class FileStore(object):
+    """Admission state shared by every process that can read ``path``
+
+    :param path: The file to keep the state in; it's created if it does not exist
+    :type path: String
+    """
+    def __init__(self, path):
+        self._path = path
+
+    @contextmanager
+    def locked(self):
+        """Exclusive access to the state; changes made to it are written back
+
+        :Returns: Dictionary
+        """
+        with open(self._path, 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                handle.seek(0)
+                raw = handle.read()
+                state = ujson.loads(raw) if raw else {}
+                yield state
+                handle.seek(0)
+                handle.truncate()
+                handle.write(ujson.dumps(state))
+                handle.flush()
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+class AdmissionController(object):
+    """Hands out slots on ESXi hosts and datastores, first come, first served.
+
+    :param store: Where the slots are counted
+    :type store: LocalStore or FileStore
+
+    :param per_host: The most operations at once on a single ESXi host
+    :type per_host: Integer
+
+    :param per_datastore: The most operations at once on a single datastore
+    :type per_datastore: Integer
+
+    :param interval: How many seconds a waiter sleeps between checks
+    :type interval: Float
+
+    :param timeout: The most seconds to wait for a slot
+    :type timeout: Integer
+
+    :param lease: How many seconds a slot is held, if it's never released (i.e.
+                  the worker process died)
+    :type lease: Integer
+    """
+    def __init__(self, store, per_host=const.VLAB_ADMISSION_PER_HOST,
+                 per_datastore=const.VLAB_ADMISSION_PER_DATASTORE,
+                 interval=const.VLAB_ADMISSION_INTERVAL,
+                 timeout=const.VLAB_ADMISSION_TIMEOUT,
+                 lease=const.VLAB_ADMISSION_LEASE):
+        self._store = store
+        self._limits = {'host': per_host, 'datastore': per_datastore}
+        self.interval = interval
+        self.timeout = timeout
+        self.lease = lease
+        # a waiter that stops checking in (i.e. it died) loses its place in line
+        self.stale_after = max(interval * 10, 30)
+
+    def acquire(self, needs, waiting=None):
+        """Block until there are free slots for every host and datastore needed
+
+        :Returns: Ticket
+
+        :Raises: ValueError if there are no free slots within ``timeout`` seconds
+
+        :param needs: How many slots are needed per host and datastore; see ``needs_of``
+        :type needs: collections.Counter
+
+        :param waiting: Called before every sleep, i.e. to free the slots of
+                        tasks the caller started earlier, and that are done now
+        :type waiting: Function
+        """
+        started = time.time()
+        ticket_id = uuid.uuid4().hex
+        # a request bigger than a limit would never fit; it gets the whole resource instead
+        needs = {key: min(count, self._limit(key)) for key, count in needs.items()}
+        while True:
+            now = time.time()
+            with self._store.locked() as state:
+                admitted = self._try_admit(state, ticket_id, needs, now)
+                if not admitted and now - started >= self.timeout:
+                    state['queue'] = [x for x in state['queue'] if x[0] != ticket_id]
+            if admitted:
+                return Ticket(ticket_id, round(now - started, 2))
+            if now - started >= self.timeout:
+                raise ValueError('Timed out after {} seconds waiting for a less busy datastore and host'.format(self.timeout))
+            if waiting is not None:
+                waiting()
+            time.sleep(self.interval)
+
+    def release(self, ticket):
+        """Free the slots of a ticket
+
+        :Returns: None
+
+        :param ticket: The slots to free. None is ignored.
+        :type ticket: Ticket
+        """
+        if ticket is None:
+            return
+        with self._store.locked() as state:
+            state.get('held', {}).pop(ticket.id, None)
+
+    def usage(self):
+        """How many slots are in use, and how many requests are waiting
+
+        :Returns: Dictionary
+        """
+        now = time.time()
+        with self._store.locked() as state:
+            held = [x for x in state.get('held', {}).values() if x[0] > now]
+            return {'held': len(held), 'waiting': len(state.get('queue', []))}
+
+    def _limit(self, key):
+        """The number of slots a resource has"""
+        return self._limits[key.split(':', 1)[0]]
+
+    def _try_admit(self, state, ticket_id, needs, now):
+        """Take the slots for a ticket, if it's next in line and they're free.
+        Also drops expired slots, and waiters that stopped checking in.
+
+        :Returns: Boolean
+        """
+        held = {k: v for k, v in state.get('held', {}).items() if v[0] > now}
+        queue = [x for x in state.get('queue', []) if x[1] + self.stale_after > now or x[0] == ticket_id]
+        if not any(x[0] == ticket_id for x in queue):
+            queue.append([ticket_id, now, needs])
+        in_use = Counter()
+        for _, amounts in held.values():
+            in_use.update(amounts)
+        admitted = False
+        blocked = set()
+        for entry in queue:
+            if entry[0] == ticket_id:
+                entry[1] = now
+                if blocked.isdisjoint(needs):
+                    admitted = all(in_use[key] + count <= self._limit(key) for key, count in needs.items())
+                break
+            # only wait behind earlier requests that need the same resources
+            blocked.update(entry[2])
+        if admitted:
+            queue = [x for x in queue if x[0] != ticket_id]
+            held[ticket_id] = [now + self.lease, needs]
+        state['held'] = held
+        state['queue'] = queue
+        return admitted
+
+
+def needs_of(host, datastores):
+    """The slots snapshotting one VM needs
+
+    :Returns: collections.Counter
+
+    :param host: The ESXi host the VM runs on; can be None
+    :type host: vim.HostSystem
+
+    :param datastores: The datastores the VM uses
+    :type datastores: List
+    """
+    needs = Counter()
+    if host is not None:
+        needs['host:{}'.format(host._moId)] += 1
+    for datastore in datastores or []:
+        needs['datastore:{}'.format(datastore._moId)] += 1
+    return needs
+
+
+def get_controller():
+    """The AdmissionController for this process
+
+    :Returns: AdmissionController
+    """
+    global _CONTROLLER
+    with _CONTROLLER_LOCK:
+        if _CONTROLLER is None:
+            if const.VLAB_ADMISSION_STATE:
+                store = FileStore(const.VLAB_ADMISSION_STATE)
+            else:
+                store = LocalStore()
+            _CONTROLLER = AdmissionController(store)
+        return _CONTROLLER
@@ -0,0 +1,253 @@
+# -*- coding: UTF-8 -*-
+"""
+Counts and times every SOAP round-trip made to vCenter.
+
+pyVmomi sends every method call (i.e. ``CreateSnapshot_Task``) and every lazy
+property read (i.e. ``vm.name``) through the stub of the session the managed
+object came from. ``install`` wraps that stub, so the calls made by
+``vmware.py`` and ``reaper.py`` are measured without changing how they're
+written.
+
+A call is charged to the ``Recorder`` of the current thread, under the phase
+the code is in (``login``, ``resolve``, ``wait``, ...). Calls made while no
+recording is active (i.e. by the tracker) are not charged to any task. Every
+recorded call is logged at debug level, tagged with the ``txn_id`` and task id
+of the recording, and every call is counted in ``metrics.VCENTER_CALLS``.
+"""
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+from vlab_api_common import get_logger
+
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import metrics
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL)
+_LOCAL = threading.local()
+DEFAULT_PHASE = 'work'
+
+
+class Recorder(object):
+    """Collects the vCenter round-trips of a single task (or reaper pass)
+
+    :param txn_id: The transaction ID supplied by the client
+    :type txn_id: String
+
+    :param task_id: The ID of the Celery task
+    :type task_id: String
+    """
+    def __init__(self, txn_id='', task_id=''):
+        self.txn_id = txn_id
+        self.task_id = task_id
+        self._calls = {} # (phase, method, path) -> [count, seconds]
+        self._lock = threading.Lock()
+
+    def record(self, phase, method, path, seconds):
+        """Count one round-trip
+
+        :Returns: None
+
+        :param phase: What the task was doing, like ``resolve``
+        :type phase: String
+
+        :param method: The SOAP method, like ``CreateSnapshot_Task``
+        :type method: String
+
+        :param path: The property read, like ``VirtualMachine.name``; empty for method calls
+        :type path: String
+
+        :param seconds: How long the round-trip took
+        :type seconds: Float
+        """
+        logger.debug('txn_id={} task_id={} phase={} method={} path={} took {:.4f}s'.format(
+                     self.txn_id, self.task_id, phase, method, path, seconds))
+        key = (phase, method, path)
+        with self._lock:
+            stats = self._calls.setdefault(key, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def summary(self):
+        """The number of round-trips, and the seconds they took, per phase
+
+        :Returns: Dictionary
+        """
+        phases = {}
+        with self._lock:
+            for (phase, _, _), (count, seconds) in self._calls.items():
+                stats = phases.setdefault(phase, {'calls': 0, 'seconds': 0.0})
+                stats['calls'] += count
+                stats['seconds'] += seconds
+        for stats in phases.values():
+            stats['seconds'] = round(stats['seconds'], 3)
+        return phases
+
+    def calls(self):
+        """Every distinct round-trip, the slowest first
+
+        :Returns: List of (phase, method, path, count, seconds) tuples
+        """
+        with self._lock:
+            found = [key + tuple(stats) for key, stats in self._calls.items()]
+        return sorted(found, key=lambda x: x[4], reverse=True)
+
+
+def current():
+    """The Recorder of the current thread
+
+    :Returns: Recorder, or None when nothing is being recorded
+    """
+    return getattr(_LOCAL, 'recorder', None)
+
+
+def current_phase():
+    """What the current thread is doing
+
+    :Returns: String
+    """
+    return getattr(_LOCAL, 'phase', DEFAULT_PHASE)
+
+
+@contextmanager
+def bound(recorder, phase=DEFAULT_PHASE):
+    """Charge the round-trips of the current thread to ``recorder``. Lets a
+    thread pool add to the recording of the thread that handed it work.
+
+    :Returns: Recorder
+
+    :param recorder: Where to count the round-trips; None stops recording
+    :type recorder: Recorder
+
+    :param phase: What the thread is doing
+    :type phase: String
+    """
+    before = (current(), current_phase())
+    _LOCAL.recorder, _LOCAL.phase = recorder, phase
+    try:
+        yield recorder
+    finally:
+        _LOCAL.recorder, _LOCAL.phase = before
+
+
+def recording(txn_id='', task_id=''):
+    """Record the round-trips made by the current thread in a new Recorder
+
+    :Returns: contextlib.ContextManager
+
+    :param txn_id: The transaction ID supplied by the client
+    :type txn_id: String
+
+    :param task_id: The ID of the Celery task
+    :type task_id: String
+    """
+    return bound(Recorder(txn_id, task_id))
+
+
+@contextmanager
+def phase(name):
+    """Charge the round-trips made within the ``with`` block to a phase
+
+    :Returns: None
+
+    :param name: The phase, like ``resolve``
+    :type name: String
+    """
+    before = current_phase()
+    _LOCAL.phase = name
+    try:
+        yield
+    finally:
+        _LOCAL.phase = before
+
+
+def in_phase(name):
+    """Decorator; charge every round-trip made by a function to a phase
+
+    :Returns: Function
+
+    :param name: The phase, like ``resolve``
+    :type name: String
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed(method, path=''):
+    """Count the ``with`` block as one round-trip. For work that happens
+    before ``install`` can wrap the session, like logging in.
+
+    :Returns: None
+
+    :param method: What to call the round-trip, like ``Login``
+    :type method: String
+
+    :param path: The property read, if any
+    :type path: String
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        metrics.VCENTER_CALLS.inc(method)
+        recorder = current()
+        if recorder is not None:
+            recorder.record(current_phase(), method, path, time.time() - started)
+
+
+def install(vcenter):
+    """Measure every round-trip made with a vCenter session. Installing twice
+    does nothing.
+
+    :Returns: None
+
+    :param vcenter: The session to measure
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    stub = vcenter._conn._stub
+    if getattr(stub, '_vlab_instrumented', False):
+        return
+    invoke_method = stub.InvokeMethod
+    invoke_accessor = stub.InvokeAccessor
+
+    def InvokeMethod(mo, info, args, *more):
+        if getattr(_LOCAL, 'in_accessor', False):
+            # the RetrievePropertiesEx behind a property read; already counted
+            return invoke_method(mo, info, args, *more)
+        with timed(info.wsdlName, _path_set(info, args)):
+            return invoke_method(mo, info, args, *more)
+
+    def InvokeAccessor(mo, info):
+        _LOCAL.in_accessor = True
+        try:
+            with timed('RetrieveProperty', '{}.{}'.format(mo.__class__.__name__.split('.')[-1], info.name)):
+                return invoke_accessor(mo, info)
+        finally:
+            _LOCAL.in_accessor = False
+
+    stub.InvokeMethod = InvokeMethod
+    stub.InvokeAccessor = InvokeAccessor
+    stub._vlab_instrumented = True
+
+
+def _path_set(info, args):
+    """The properties a PropertyCollector call reads, like ``VirtualMachine:name,snapshot``
+
+    :Returns: String
+    """
+    if info.wsdlName not in ('RetrievePropertiesEx', 'RetrieveContents', 'CreateFilter'):
+        return ''
+    try:
+        specs = args[0] if isinstance(args[0], list) else [args[0]]
+        return ';'.join('{}:{}'.format(prop.type.__name__.split('.')[-1], ','.join(prop.pathSet))
+                        for spec in specs for prop in spec.propSet)
+    except Exception:
+        return ''
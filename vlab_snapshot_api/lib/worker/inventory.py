@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk reads of vCenter inventory via the PropertyCollector.
+
+Reading attributes off of pyVmomi objects (i.e. ``vm.name``) costs a SOAP
+round-trip per attribute. The functions here fetch a set of properties for every
+VM under a folder in a single ``RetrievePropertiesEx`` call instead.
+"""
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+
+PC = vmodl.query.PropertyCollector
+
+
+def folder_traversal(recursive=False):
+    """Create the TraversalSpec that walks from a Folder to its children.
+
+    :Returns: vmodl.query.PropertyCollector.TraversalSpec
+
+    :param recursive: Set to True to also walk into sub-folders.
+    :type recursive: Boolean
+    """
+    spec = PC.TraversalSpec(name='folderTraversal', type=vim.Folder,
+                            path='childEntity', skip=False)
+    if recursive:
+        spec.selectSet = [PC.SelectionSpec(name='folderTraversal')]
+    return spec
+
+
+def vm_filter_spec(root, path_set, recursive=False):
+    """Create the FilterSpec for reading properties of every VM in a folder.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param root: The folder that contains the VMs
+    :type root: vim.Folder
+
+    :param path_set: The VM properties to read, like ``['name', 'snapshot.rootSnapshotList']``
+    :type path_set: List
+
+    :param recursive: Set to True to also find VMs in sub-folders of ``root``.
+    :type recursive: Boolean
+    """
+    obj_spec = PC.ObjectSpec(obj=root, skip=True, selectSet=[folder_traversal(recursive)])
+    prop_spec = PC.PropertySpec(type=vim.VirtualMachine, pathSet=path_set, all=False)
+    return PC.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def task_filter_spec(tasks, path_set):
+    """Create the FilterSpec for reading properties of many vCenter tasks.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param tasks: The tasks to read
+    :type tasks: List
+
+    :param path_set: The Task properties to read, like ``['info.state']``
+    :type path_set: List
+    """
+    obj_specs = [PC.ObjectSpec(obj=task, skip=False) for task in tasks]
+    prop_spec = PC.PropertySpec(type=vim.Task, pathSet=path_set, all=False)
+    return PC.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+
+
+def retrieve(vcenter, filter_spec, page_size=None):
+    """Generator that yields the properties of every object matched by the
+    FilterSpec, as a dictionary of property path to value. The managed object
+    itself is under the ``obj`` key. Properties that are unset (like ``snapshot``
+    on a VM without snapshots) are left out of the dictionary.
+
+    :Returns: Generator
+
+    :param vcenter: The vCenter server to query
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param filter_spec: Defines what objects and properties to read
+    :type filter_spec: vmodl.query.PropertyCollector.FilterSpec
+
+    :param page_size: The max number of objects per SOAP call. Default None lets
+                      the vCenter server decide.
+    :type page_size: Integer
+    """
+    collector = vcenter.content.propertyCollector
+    options = PC.RetrieveOptions(maxObjects=page_size)
+    result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=options)
+    finished = False
+    try:
+        while result is not None:
+            for obj_content in result.objects:
+                yield _to_dict(obj_content)
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token=result.token)
+        finished = True
+    finally:
+        if not finished and result is not None and result.token:
+            # The caller stopped early; free the result set held by the server
+            collector.CancelRetrievePropertiesEx(token=result.token)
+
+
+def _to_dict(obj_content):
+    """Convert an ObjectContent into a dictionary of property path to value
+
+    :Returns: Dictionary
+
+    :param obj_content: The properties of a single object
+    :type obj_content: vmodl.query.PropertyCollector.ObjectContent
+    """
+    props = {prop.name: prop.val for prop in obj_content.propSet}
+    props['obj'] = obj_content.obj
+    return props
@@ -0,0 +1,245 @@
+# -*- coding: UTF-8 -*-
+"""
+Counters, gauges and histograms, served in the Prometheus text format.
+
+The reaper runs for days without any requests hitting it, so the only way to
+tell it's falling behind is to scrape it. ``serve`` starts a small HTTP server
+on a daemon thread that answers ``GET /metrics`` with every metric defined in
+this process. There's no dependency on ``prometheus_client``; the reaper only
+needs a handful of metrics, and this keeps the image small.
+"""
+import bisect
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from vlab_snapshot_api.lib import const
+
+
+_REGISTRY = []
+_REGISTRY_LOCK = threading.Lock()
+
+# seconds; from a fast deletion to a scan of a very large inventory
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Metric(object):
+    """The parts every type of metric shares
+
+    :param name: The name of the metric, like ``vlab_reaper_snapshots_deleted_total``
+    :type name: String
+
+    :param doc: What the metric measures
+    :type doc: String
+
+    :param labels: The names of the labels the metric has
+    :type labels: Tuple
+    """
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _REGISTRY_LOCK:
+            _REGISTRY.append(self)
+
+    def _key(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError('{} needs labels {}, got {}'.format(self.name, self.labels, label_values))
+        return tuple(str(x) for x in label_values)
+
+    def _label_str(self, key, extra=()):
+        """Format the labels of a sample, like ``{method="Foo"}``"""
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def value(self, *label_values):
+        """The current value of the metric, for the given labels
+
+        :Returns: Float
+        """
+        with self._lock:
+            return self._values.get(self._key(label_values), 0)
+
+    def samples(self):
+        """The lines of the Prometheus text format for this metric
+
+        :Returns: List
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.append('{}{} {}'.format(self.name, self._label_str(key), _number(self._values[key])))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, like the number of snapshots deleted"""
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        """Add to the counter
+
+        :Returns: None
+
+        :param label_values: The value of every label, in the order of ``labels``
+        :type label_values: String
+
+        :param amount: How much to add
+        :type amount: Integer
+        """
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, like the backlog of expired snapshots"""
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        """Set the gauge
+
+        :Returns: None
+
+        :param value: The new value
+        :type value: Float
+
+        :param label_values: The value of every label, in the order of ``labels``
+        :type label_values: String
+        """
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Counts observations into buckets, like how long each scan took
+
+    :param buckets: The upper bound of every bucket, smallest first
+    :type buckets: Tuple
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, amount, *label_values):
+        """Record an observation
+
+        :Returns: None
+
+        :param amount: The observed value, like a number of seconds
+        :type amount: Float
+
+        :param label_values: The value of every label, in the order of ``labels``
+        :type label_values: String
+        """
+        key = self._key(label_values)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, amount)] += 1
+            self._values[key] = (counts, total + amount)
+
+    def value(self, *label_values):
+        """How many observations there are, for the given labels
+
+        :Returns: Integer
+        """
+        with self._lock:
+            counts, _ = self._values.get(self._key(label_values), ([0], 0))
+            return sum(counts)
+
+    def samples(self):
+        """The lines of the Prometheus text format for this metric
+
+        :Returns: List
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            for key in sorted(self._values):
+                counts, total = self._values[key]
+                running = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    running += count
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('{}_bucket{} {}'.format(self.name, self._label_str(key, [('le', le)]), running))
+                lines.append('{}_sum{} {}'.format(self.name, self._label_str(key), _number(total)))
+                lines.append('{}_count{} {}'.format(self.name, self._label_str(key), running))
+        return lines
+
+
+def _number(value):
+    """Format a number without a needless ``.0``"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render():
+    """Every metric in this process, in the Prometheus text format
+
+    :Returns: String
+    """
+    with _REGISTRY_LOCK:
+        metrics = list(_REGISTRY)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    """An HTTP server that answers each request on its own thread; the same as
+    ``http.server.ThreadingHTTPServer``, which is new in Python 3.7"""
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers ``GET /metrics``"""
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown out the reaper's own logs
+        pass
+
+
+def serve(port=const.VLAB_REAPER_METRICS_PORT, host=''):
+    """Serve the metrics on a daemon thread
+
+    :Returns: _Server, or None if ``port`` is 0
+
+    :param port: The TCP port to listen on; 0 disables the server
+    :type port: Integer
+
+    :param host: The address to listen on; the default is every address
+    :type host: String
+    """
+    if not port:
+        return None
+    server = _Server((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
+
+
+# Calls made to vCenter, by SOAP method; counted by instrument.py
+VCENTER_CALLS = Counter('vlab_vcenter_calls_total', 'SOAP calls made to vCenter', labels=('method',))
@@ -1,15 +1,36 @@
 # -*- coding: UTF-8 -*-
 """This script iterates VM inventory, and deletes expired snapshots"""
 import time
+import heapq
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from vlab_api_common.std_logger import get_logger
-from vlab_inf_common.vmware import vCenter, vim, consume_task
+from vlab_inf_common.vmware import vCenter, consume_task
 
 from vlab_snapshot_api.lib import const
-from vlab_snapshot_api.lib.worker.vmware import _get_snapshots
+from vlab_snapshot_api.lib.worker import instrument, inventory, metrics
+from vlab_snapshot_api.lib.worker.resolver import get_resolver, rebind
+from vlab_snapshot_api.lib.worker.vmware import _iter_snapshots
+from vlab_snapshot_api.lib.worker.watcher import InventoryWatcher
 
 ONE_DAY = 30 * 60 * 24 # seconds in a day
-LOOP_INTERVAL = 300 # 5 minutes
+VM_PROPERTIES = ['name', 'parent', 'runtime.host', 'datastore', 'snapshot.rootSnapshotList']
+
+# Served on ``/metrics``; see metrics.py
+SCAN_SECONDS = metrics.Histogram('vlab_reaper_scan_seconds',
+                                 'Seconds per pass; "full" scans the inventory, "due" only deletes scheduled snapshots',
+                                 labels=('kind',))
+VMS_EXAMINED = metrics.Counter('vlab_reaper_vms_examined_total', 'VMs whose snapshots were checked')
+SNAPSHOTS_EXAMINED = metrics.Counter('vlab_reaper_snapshots_examined_total', 'Snapshots checked for expiry')
+DELETIONS = metrics.Counter('vlab_reaper_deletions_total', 'Snapshots deleted, by result', labels=('result',))
+PASS_DELETIONS = metrics.Histogram('vlab_reaper_pass_deletions', 'Snapshots deleted per pass',
+                                   buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000))
+DELETION_SECONDS = metrics.Histogram('vlab_reaper_deletion_seconds', 'Seconds to delete one snapshot')
+BACKLOG = metrics.Gauge('vlab_reaper_backlog', 'Expired snapshots that are queued for, or being, deleted')
+SCHEDULED = metrics.Gauge('vlab_reaper_scheduled', 'Snapshots waiting to expire')
+LAST_PASS = metrics.Gauge('vlab_reaper_last_pass_timestamp', 'EPOC timestamp when the last pass finished')
 
 
 def is_expired(snap):
@@ -17,63 +38,497 @@ def is_expired(snap):
 
     :Returns: Boolean
 
-    :param snap: The name of the snapshot
-    :type snap: String
+    :param snap: The snapshot
+    :type snap: vlab_snapshot_api.lib.worker.records.SnapshotRecord
+    """
+    return snap.expires < int(time.time())
+
+
+def scan_inventory(vcenter):
+    """Generator that yields the snapshot info of every VM owned by users in vLab.
+
+    The whole users folder is read with one paged PropertyCollector retrieve,
+    so memory use is bounded by ``const.VLAB_REAPER_PAGE_SIZE`` and a pass
+    costs one SOAP call per page instead of several per VM.
+
+    :Returns: Generator
+
+    :param vcenter: The vCenter server that hosts the user's Virtual Machines
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    all_users = get_resolver().users_folder(vcenter)
+    spec = inventory.vm_filter_spec(all_users, VM_PROPERTIES, recursive=True)
+    return inventory.retrieve(vcenter, spec, page_size=const.VLAB_REAPER_PAGE_SIZE)
+
+
+class DeletionExecutor(object):
+    """Deletes snapshots on a bounded pool of threads.
+
+    Removing a snapshot consolidates the VM's disks, which is IO heavy. To avoid
+    swamping a single array (or ESXi host), each deletion reserves a slot for
+    the VM's host and every datastore the VM uses, and only starts once all the
+    slots are free. A VM only ever has one deletion running, because vCenter
+    rejects concurrent tasks on the same VM.
+
+    :param logger: Handles logging messages while the reaper runs
+    :type logger: logging.Logger
+
+    :param max_workers: The most deletions that run at once
+    :type max_workers: Integer
+
+    :param per_host: The most deletions that run at once on a single ESXi host
+    :type per_host: Integer
+
+    :param per_datastore: The most deletions that run at once on a single datastore
+    :type per_datastore: Integer
+    """
+    def __init__(self, logger, max_workers=const.VLAB_REAPER_MAX_WORKERS,
+                 per_host=const.VLAB_REAPER_MAX_PER_HOST,
+                 per_datastore=const.VLAB_REAPER_MAX_PER_DATASTORE):
+        self._logger = logger
+        self._max_workers = max_workers
+        self._limits = {'vm': 1, 'host': per_host, 'datastore': per_datastore}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._cond = threading.Condition()
+        self._active = Counter()
+        self._pending = deque()
+        self._running = 0
+        self._reset_counters()
+
+    def _reset_counters(self):
+        """Start counting a new pass"""
+        self.deleted = 0
+        self.failed = 0
+        self._started = None
+
+    @staticmethod
+    def _keys(vm):
+        """The resources a snapshot deletion on the VM contends for
+
+        :Returns: List
+
+        :param vm: The properties of the VM, as yielded by ``scan_inventory``
+        :type vm: Dictionary
+        """
+        keys = [('vm', vm['obj']._moId)]
+        if vm.get('runtime.host') is not None:
+            keys.append(('host', vm['runtime.host']._moId))
+        for datastore in vm.get('datastore', []):
+            keys.append(('datastore', datastore._moId))
+        return keys
+
+    def submit(self, vm, snap):
+        """Queue a snapshot for deletion
+
+        :Returns: None
+
+        :param vm: The properties of the VM, as yielded by ``scan_inventory``
+        :type vm: Dictionary
+
+        :param snap: The snapshot to delete
+        :type snap: vlab_snapshot_api.lib.worker.records.SnapshotRecord
+        """
+        with self._cond:
+            if self._started is None:
+                self._started = time.time()
+            self._pending.append((vm, snap, self._keys(vm), instrument.current()))
+            self._dispatch()
+
+    def _dispatch(self):
+        """Start every queued deletion that fits within the limits.
+        The caller must hold ``self._cond``.
+
+        :Returns: None
+        """
+        waiting = deque()
+        while self._pending:
+            vm, snap, keys, recorder = self._pending.popleft()
+            fits = all(self._active[key] < self._limits[key[0]] for key in keys)
+            if fits and self._running < self._max_workers:
+                for key in keys:
+                    self._active[key] += 1
+                self._running += 1
+                self._pool.submit(self._delete, vm, snap, keys, recorder)
+            else:
+                waiting.append((vm, snap, keys, recorder))
+        self._pending = waiting
+        BACKLOG.set(len(self._pending) + self._running)
+
+    def _delete(self, vm, snap, keys, recorder=None):
+        """Runs on the thread pool; blocks until vCenter has removed the snapshot.
+        The round-trips are charged to the ``recorder`` of the pass that found the snapshot."""
+        started = time.time()
+        try:
+            with instrument.bound(recorder, phase='delete'):
+                consume_task(snap.snapshot.RemoveSnapshot_Task(removeChildren=False))
+        except Exception as doh:
+            self._logger.error('Failed to delete snap {} of VM {}: {}'.format(snap.name, vm['name'], doh))
+            deleted = False
+        else:
+            deleted = True
+        DELETION_SECONDS.observe(time.time() - started)
+        DELETIONS.inc('ok' if deleted else 'failed')
+        with self._cond:
+            for key in keys:
+                self._active[key] -= 1
+            self._running -= 1
+            if deleted:
+                self.deleted += 1
+            else:
+                self.failed += 1
+            self._dispatch()
+            self._cond.notify_all()
+
+    def wait(self):
+        """Block until every queued deletion is done, and report the throughput
+        of the pass.
+
+        :Returns: Dictionary
+        """
+        with self._cond:
+            while self._pending or self._running:
+                self._cond.wait()
+            if self._started is None:
+                ran_for = 0
+            else:
+                ran_for = time.time() - self._started
+            stats = {'deleted': self.deleted,
+                     'failed': self.failed,
+                     'seconds': round(ran_for, 2),
+                     'per_second': round(self.deleted / ran_for, 2) if ran_for else 0}
+            self._reset_counters()
+        return stats
+
+    def shutdown(self):
+        """Stop the thread pool, after the queued deletions are done
+
+        :Returns: None
+        """
+        self.wait()
+        self._pool.shutdown()
+
+
+class ExpirySchedule(object):
+    """A min-heap of snapshots that have not expired yet, ordered by when they
+    expire. Lets the reaper sleep until the next snapshot is due, instead of
+    rescanning the whole inventory on a fixed interval.
+
+    Snapshots that are deleted outside of the reaper are dropped via ``sync``.
+    Their heap entries are left in place, and skipped when they come due.
     """
-    exp_epoch = int(snap.split("_")[const.VLAB_SNAP_EXPIRES])
-    current_time = int(time.time())
-    return exp_epoch < current_time
+    def __init__(self):
+        self._heap = []
+        self._live = {} # VM moid -> names of the VM's scheduled snapshots
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, expires, vm, snap):
+        """Schedule a snapshot for deletion. Adding an already scheduled
+        snapshot does nothing.
+
+        :Returns: None
+
+        :param expires: The EPOC timestamp when the snapshot expires
+        :type expires: Integer
+
+        :param vm: The properties of the VM, as yielded by ``scan_inventory``
+        :type vm: Dictionary
+
+        :param snap: The snapshot to delete
+        :type snap: vlab_snapshot_api.lib.worker.records.SnapshotRecord
+        """
+        moid = vm['obj']._moId
+        scheduled = self._live.setdefault(moid, set())
+        if snap.name in scheduled:
+            return
+        scheduled.add(snap.name)
+        self._count += 1
+        # the VM and snapshot name make every entry unique, so heapq never
+        # has to compare the (unorderable) dictionaries and pyVmomi objects
+        heapq.heappush(self._heap, (expires, moid, snap.name, vm, snap))
+
+    def sync(self, vm, snap_names):
+        """Forget the scheduled snapshots of a VM that no longer exist
+
+        :Returns: None
+
+        :param vm: The properties of the VM
+        :type vm: Dictionary
+
+        :param snap_names: The names of every snapshot the VM currently has
+        :type snap_names: Iterable
+        """
+        moid = vm['obj']._moId
+        scheduled = self._live.get(moid)
+        if scheduled is None:
+            return
+        self._count -= len(scheduled)
+        scheduled.intersection_update(snap_names)
+        self._count += len(scheduled)
+        if not scheduled:
+            del self._live[moid]
+
+    def next_deadline(self):
+        """The EPOC timestamp of the next snapshot to expire, or None if there
+        are no snapshots scheduled.
 
+        :Returns: Integer
+        """
+        if self._heap:
+            return self._heap[0][0]
+        return None
 
-def reap_snapshots(vcenter, logger):
+    def due(self, now):
+        """Remove and return every snapshot that has expired by ``now``
+
+        :Returns: List of (vm, snap) tuples
+
+        :param now: The current EPOC timestamp
+        :type now: Float
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, moid, name, vm, snap = heapq.heappop(self._heap)
+            scheduled = self._live.get(moid, set())
+            if name not in scheduled:
+                # deleted outside of the reaper since it was scheduled
+                continue
+            scheduled.discard(name)
+            self._count -= 1
+            if not scheduled:
+                del self._live[moid]
+            expired.append((vm, snap))
+        return expired
+
+    def sleep_time(self, now, next_scan):
+        """How long the reaper can sleep before it has work to do
+
+        :Returns: Float
+
+        :param now: The current EPOC timestamp
+        :type now: Float
+
+        :param next_scan: The EPOC timestamp of the next full inventory scan
+        :type next_scan: Float
+        """
+        wake_at = next_scan
+        deadline = self.next_deadline()
+        if deadline is not None:
+            wake_at = min(deadline, next_scan)
+        return max(0, wake_at - now)
+
+
+def reap_snapshots(vcenter, logger, executor=None, schedule=None):
     """Walk the VMs owned by users in vLab, and delete all expired VM snapshots.
+    Snapshots that have not expired yet are added to the ``schedule``.
+
+    :Returns: Dictionary
+
+    :param vcenter: The vCenter server that hosts the user's Virtual Machines
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param logger: Handles logging messages while the reaper runs
+    :type logger: logging.Logger
+
+    :param executor: Runs the deletions. Defaults to a new DeletionExecutor
+                     that is shutdown before returning.
+    :type executor: DeletionExecutor
+
+    :param schedule: Collects the snapshots that expire in the future
+    :type schedule: ExpirySchedule
+    """
+    if executor is None:
+        the_executor = DeletionExecutor(logger)
+    else:
+        the_executor = executor
+    try:
+        for vm in scan_inventory(vcenter):
+            _reap_vm(vm, logger, the_executor, schedule)
+        return the_executor.wait()
+    finally:
+        if executor is None:
+            the_executor.shutdown()
+
+
+def _reap_vm(vm, logger, executor, schedule):
+    """Delete the expired snapshots of a VM, and schedule the rest
 
     :Returns: None
 
+    :param vm: The properties of the VM, as yielded by ``scan_inventory``
+    :type vm: Dictionary
+
+    :param logger: Handles logging messages while the reaper runs
+    :type logger: logging.Logger
+
+    :param executor: Runs the deletions
+    :type executor: DeletionExecutor
+
+    :param schedule: Collects the snapshots that expire in the future. Can be None.
+    :type schedule: ExpirySchedule
+    """
+    snap_names = []
+    VMS_EXAMINED.inc()
+    for snap in _iter_snapshots(vm.get('snapshot.rootSnapshotList', [])):
+        snap_names.append(snap.name)
+        SNAPSHOTS_EXAMINED.inc()
+        if is_expired(snap):
+            # only look up the owner when deleting; it's an extra round-trip
+            logger.info("deleteing snap {} of VM {} owned by {}".format(snap.name, vm['name'], vm['parent'].name))
+            executor.submit(vm, snap)
+        elif schedule is not None:
+            schedule.add(snap.expires, vm, snap)
+    if schedule is not None:
+        schedule.sync(vm, snap_names)
+
+
+def reap_due(vcenter, logger, executor, schedule):
+    """Delete the scheduled snapshots that have expired, without scanning the inventory.
+
+    :Returns: Dictionary
+
     :param vcenter: The vCenter server that hosts the user's Virtual Machines
     :type vcenter: vlab_inf_common.vmware.vCenter
 
     :param logger: Handles logging messages while the reaper runs
     :type logger: logging.Logger
+
+    :param executor: Runs the deletions
+    :type executor: DeletionExecutor
+
+    :param schedule: The snapshots waiting to expire
+    :type schedule: ExpirySchedule
     """
-    all_users = vcenter.get_by_name(name=const.INF_VCENTER_USERS_DIR, vimtype=vim.Folder)
-    for username in all_users.childEntity:
-        vms = vcenter.get_by_name(name=username.name, vimtype=vim.Folder)
-        for vm in vms.childEntity:
-            if vm.snapshot:
-                vm_snaps = _get_snapshots(vm.snapshot.rootSnapshotList)
-                for snap in vm_snaps:
-                    if is_expired(snap.name):
-                        logger.info("deleteing snap {} of VM {} owned by {}".format(snap, vm.name, username))
-                        consume_task(snap.snapshot.RemoveSnapshot_Task(removeChildren=False))
+    for vm, snap in schedule.due(time.time()):
+        logger.info("deleteing snap {} of VM {}".format(snap.name, vm['name']))
+        snap.snapshot = rebind(vcenter, snap.snapshot)
+        executor.submit(vm, snap)
+    return executor.wait()
+
+
+def record_pass(kind, started, finished, stats, schedule):
+    """Update the metrics after a pass of the reaper
+
+    :Returns: None
+
+    :param kind: "full" for a scan of the inventory, or "due" for only deleting
+                 scheduled snapshots
+    :type kind: String
+
+    :param started: The EPOC timestamp when the pass began
+    :type started: Float
+
+    :param finished: The EPOC timestamp when the pass ended
+    :type finished: Float
+
+    :param stats: What ``DeletionExecutor.wait`` returned
+    :type stats: Dictionary
+
+    :param schedule: The snapshots waiting to expire
+    :type schedule: ExpirySchedule
+    """
+    SCAN_SECONDS.observe(finished - started, kind)
+    PASS_DELETIONS.observe(stats['deleted'])
+    SCHEDULED.set(len(schedule))
+    LAST_PASS.set(int(finished))
+
+
+def watch(logger):
+    """Entry point logic for deleting expired snapshots, when ``const.VLAB_REAPER_WATCH``
+    is set. Instead of rescanning the inventory, a PropertyFilter on every VM
+    under the users folder keeps the schedule current; the first update from
+    vCenter contains every VM, and later updates only contain what changed.
+
+    :Returns: None
+
+    :param logger: Handles logging messages while the reaper runs
+    :type logger: logging.Logger
+    """
+    logger.info('Snapshot Reaper starting in watch mode')
+    executor = DeletionExecutor(logger)
+    schedule = ExpirySchedule()
+    logger.info("Connecting to vCenter {} as {}".format(const.INF_VCENTER_SERVER, const.INF_VCENTER_USER))
+    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+        instrument.install(vcenter)
+        watcher = InventoryWatcher(vcenter, VM_PROPERTIES, batch_size=const.VLAB_REAPER_PAGE_SIZE)
+        try:
+            watcher.start(get_resolver().users_folder(vcenter))
+            while True:
+                now = time.time()
+                timeout = schedule.sleep_time(now, now + const.VLAB_REAPER_RESCAN_INTERVAL)
+                with instrument.recording(task_id='watch') as recorder:
+                    for vm in watcher.updates(timeout):
+                        _reap_vm(vm, logger, executor, schedule)
+                    started = time.time()
+                    stats = reap_due(vcenter, logger, executor, schedule)
+                record_pass('due', started, time.time(), stats, schedule)
+                logger.debug('vCenter round-trips: {}'.format(recorder.summary()))
+                if stats['deleted'] or stats['failed']:
+                    logger.info('Deleted {deleted} snapshots ({failed} failed) in {seconds} seconds, {per_second}/sec'.format(**stats))
+        except Exception as doh:
+            logger.exception(doh)
+        finally:
+            executor.shutdown()
+            watcher.stop()
 
 
 def main(logger):
     """Entry point logic for deleting expired snapshots
 
+    A full scan of the inventory deletes the expired snapshots, and schedules
+    the rest. Between scans, the reaper sleeps until the next snapshot expires.
+    Full scans only run every ``const.VLAB_REAPER_RESCAN_INTERVAL`` seconds, to
+    pick up new snapshots and reconcile with changes made outside the reaper.
+
     :Returns: None
 
     :param logger: Handles logging messages while the reaper runs
     :type logger: logging.Logger
     """
+    if metrics.serve() is not None:
+        logger.info('Serving metrics on port {}'.format(const.VLAB_REAPER_METRICS_PORT))
+    if const.VLAB_REAPER_WATCH:
+        watch(logger)
+        return
     logger.info('Snapshot Reaper starting')
+    executor = DeletionExecutor(logger)
+    schedule = ExpirySchedule()
+    next_scan = 0
     keep_running = True
     while keep_running:
         logger.info("Connecting to vCenter {} as {}".format(const.INF_VCENTER_SERVER, const.INF_VCENTER_USER))
         with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
                      password=const.INF_VCENTER_PASSWORD) as vcenter:
+            instrument.install(vcenter)
             try:
                 start_loop = time.time()
-                reap_snapshots(vcenter, logger)
+                if start_loop >= next_scan:
+                    kind = 'full'
+                    schedule = ExpirySchedule()
+                    with instrument.recording(task_id=kind) as recorder:
+                        stats = reap_snapshots(vcenter, logger, executor, schedule)
+                    next_scan = start_loop + const.VLAB_REAPER_RESCAN_INTERVAL
+                else:
+                    kind = 'due'
+                    with instrument.recording(task_id=kind) as recorder:
+                        stats = reap_due(vcenter, logger, executor, schedule)
             except Exception as doh:
                 logger.exception(doh)
                 keep_running = False
             else:
-                ran_for = int(time.time() - start_loop)
+                now = time.time()
+                record_pass(kind, start_loop, now, stats, schedule)
+                logger.debug('vCenter round-trips: {}'.format(recorder.summary()))
+                ran_for = int(now - start_loop)
                 logger.debug('Took {} seconds to check all snapshots'.format(ran_for))
-                loop_delta = LOOP_INTERVAL - ran_for
-                sleep_for = max(0, loop_delta)
+                logger.info('Deleted {deleted} snapshots ({failed} failed) in {seconds} seconds, {per_second}/sec'.format(**stats))
+                sleep_for = schedule.sleep_time(now, next_scan)
+                logger.debug('{} snapshots scheduled, sleeping for {} seconds'.format(len(schedule), int(sleep_for)))
                 time.sleep(sleep_for)
+    executor.shutdown()
 
 
 if __name__ == '__main__':
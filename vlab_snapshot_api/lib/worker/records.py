@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+The one place that knows how vLab names snapshots.
+
+Every snapshot vLab takes is named ``<id>_<created>_<expires>``. A name is
+parsed once, into a ``SnapshotRecord``, and everything else (the API workers,
+and the reaper) reads the fields off the record. Snapshots whose names are not
+in that format (i.e. taken by hand in the vSphere client) are skipped, instead
+of raising an IndexError halfway through a lab, or the whole reaper pass.
+"""
+from vlab_snapshot_api.lib import const
+
+
+class SnapshotRecord(object):
+    """The parsed name of a vLab snapshot, and the objects needed to act on it.
+    Uses ``__slots__`` because the reaper holds one of these for every
+    snapshot in vCenter that has not expired yet.
+
+    :param snap_id: The unique ID vLab gave the snapshot
+    :type snap_id: String
+
+    :param created: The EPOC timestamp when the snapshot was taken
+    :type created: Integer
+
+    :param expires: The EPOC timestamp when the reaper deletes the snapshot
+    :type expires: Integer
+
+    :param name: The full name of the snapshot in vCenter
+    :type name: String
+
+    :param description: The description of the snapshot in vCenter
+    :type description: String
+
+    :param snapshot: The managed object, for deleting or reverting to the snapshot
+    :type snapshot: vim.vm.Snapshot
+    """
+    __slots__ = ('id', 'created', 'expires', 'name', 'description', 'snapshot')
+
+    def __init__(self, snap_id, created, expires, name, description='', snapshot=None):
+        self.id = snap_id
+        self.created = created
+        self.expires = expires
+        self.name = name
+        self.description = description
+        self.snapshot = snapshot
+
+    def __repr__(self):
+        return 'SnapshotRecord({})'.format(self.name)
+
+
+def encode_name(snap_id, created, expires):
+    """Create the name of a new snapshot
+
+    :Returns: String
+
+    :param snap_id: The unique ID of the snapshot
+    :type snap_id: String
+
+    :param created: The EPOC timestamp when the snapshot was taken
+    :type created: Integer
+
+    :param expires: The EPOC timestamp when the snapshot expires
+    :type expires: Integer
+    """
+    return '{}_{}_{}'.format(snap_id, created, expires)
+
+
+def decode_name(name):
+    """Parse the name of a snapshot
+
+    :Returns: Tuple (snap_id, created, expires), or None if vLab did not take the snapshot
+
+    :param name: The name of the snapshot
+    :type name: String
+    """
+    parts = (name or '').split('_')
+    if len(parts) != 3:
+        return None
+    try:
+        created = int(parts[const.VLAB_SNAP_CREATED])
+        expires = int(parts[const.VLAB_SNAP_EXPIRES])
+    except ValueError:
+        return None
+    return parts[const.VLAB_SNAP_ID], created, expires
+
+
+def from_tree(snap):
+    """Create a record from a node of a VM's snapshot tree
+
+    :Returns: SnapshotRecord, or None if vLab did not take the snapshot
+
+    :param snap: The snapshot
+    :type snap: vim.vm.SnapshotTree
+    """
+    parsed = decode_name(snap.name)
+    if parsed is None:
+        return None
+    snap_id, created, expires = parsed
+    return SnapshotRecord(snap_id, created, expires, snap.name,
+                          description=snap.description, snapshot=snap.snapshot)
@@ -0,0 +1,291 @@
+# -*- coding: UTF-8 -*-
+"""
+Finds the folders and VMs of a user without walking the whole inventory.
+
+``vCenter.get_by_name`` creates a ContainerView over every folder in vCenter,
+then reads the name of each one; finding a VM by scanning ``folder.childEntity``
+costs another round-trip per VM. Both get slower as the inventory grows.
+
+The ``Resolver`` looks objects up by inventory path and ``SearchIndex.FindChild``
+instead, and remembers the managed object ID (moid) of what it found. A moid
+is only a string, so a cached entry can be bound to whichever session is
+looking it up. When a cached moid turns out to be stale (the object was
+deleted, or renamed) the entry is dropped and the lookup is done again.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import instrument
+
+
+_RESOLVER = None
+_RESOLVER_LOCK = threading.Lock()
+
+
+def rebind(vcenter, moref):
+    """Point a managed object at a different vCenter session. Objects that
+    outlive the session they came from (i.e. cached, or held across a
+    reconnect) must be rebound before use.
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param moref: The object from another session
+    :type moref: pyVmomi.VmomiSupport.ManagedObject
+    """
+    return moref.__class__(moref._moId, stub=vcenter._conn._stub)
+
+
+class TTLCache(object):
+    """A least-recently-used cache where entries also expire after a while.
+
+    :param ttl: How many seconds an entry is valid for
+    :type ttl: Integer
+
+    :param max_entries: The most entries to keep; the least recently used entry
+                        is evicted to make room for a new one.
+    :type max_entries: Integer
+    """
+    def __init__(self, ttl, max_entries):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Lookup an entry, or None when it's not cached (or expired)
+
+        :Returns: Object
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Add (or replace) an entry
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data[key] = (time.time() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """Remove an entry, if it exists
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove every entry
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data.clear()
+
+
+class Resolver(object):
+    """Looks up, and caches, the folders and VMs of users in vLab.
+
+    :param ttl: How many seconds to trust a cached moid
+    :type ttl: Integer
+
+    :param max_entries: The most folders and VMs to remember
+    :type max_entries: Integer
+    """
+    def __init__(self, ttl=const.VLAB_RESOLVER_TTL, max_entries=const.VLAB_RESOLVER_MAX_ENTRIES):
+        self._cache = TTLCache(ttl, max_entries)
+        self.invalidations = 0
+
+    @instrument.in_phase('resolve')
+    def users_folder(self, vcenter):
+        """Find the folder that contains the folders of every user
+
+        :Returns: vim.Folder
+
+        :param vcenter: The session to use
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        key = ('folder', const.INF_VCENTER_USERS_DIR)
+        moid = self._cache.get(key)
+        if moid is None:
+            folder = self._find_by_path(vcenter, const.INF_VCENTER_USERS_DIR)
+            if folder is None:
+                # not at the top of a datacenter; fall back to the slow search
+                folder = vcenter.get_by_name(name=const.INF_VCENTER_USERS_DIR, vimtype=vim.Folder)
+            moid = folder._moId
+            self._cache.put(key, moid)
+        return vim.Folder(moid, stub=vcenter._conn._stub)
+
+    @instrument.in_phase('resolve')
+    def user_folder(self, vcenter, username):
+        """Find the folder that contains a user's VMs
+
+        :Returns: vim.Folder
+
+        :Raises: ValueError when the user has no folder
+
+        :param vcenter: The session to use
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The user who owns the folder
+        :type username: String
+        """
+        key = ('folder', username)
+        moid = self._cache.get(key)
+        if moid is None:
+            folder = self._find_child(vcenter, self.users_folder, ('folder', const.INF_VCENTER_USERS_DIR), username)
+            if folder is None:
+                raise ValueError('Unable to locate object named {}'.format(username))
+            moid = folder._moId
+            self._cache.put(key, moid)
+        return vim.Folder(moid, stub=vcenter._conn._stub)
+
+    def with_user_folder(self, vcenter, username, func):
+        """Call ``func`` with the folder of a user. A cached folder is not
+        checked before use, so if it no longer exists (i.e. it was deleted, or
+        recreated), it's looked up again and ``func`` is retried once.
+
+        :Returns: Whatever ``func`` returns
+
+        :Raises: ValueError when the user has no folder
+
+        :param vcenter: The session to use
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The user who owns the folder
+        :type username: String
+
+        :param func: Called with the vim.Folder; must read everything it needs
+                     from vCenter before returning (i.e. not return a generator)
+        :type func: Function
+        """
+        try:
+            return func(self.user_folder(vcenter, username))
+        except vmodl.fault.ManagedObjectNotFound:
+            self.invalidate(('folder', username))
+            return func(self.user_folder(vcenter, username))
+
+    @instrument.in_phase('resolve')
+    def vm(self, vcenter, username, machine_name):
+        """Find a VM in a user's folder
+
+        :Returns: vim.VirtualMachine, or None if the user has no such VM
+
+        :param vcenter: The session to use
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+        """
+        key = ('vm', username, machine_name)
+        moid = self._cache.get(key)
+        if moid is not None:
+            the_vm = vim.VirtualMachine(moid, stub=vcenter._conn._stub)
+            if self._is_current(the_vm, machine_name):
+                return the_vm
+            self.invalidate(key)
+        the_vm = self._find_child(vcenter, lambda x: self.user_folder(x, username), ('folder', username), machine_name)
+        if not isinstance(the_vm, vim.VirtualMachine):
+            return None
+        self._cache.put(key, the_vm._moId)
+        return the_vm
+
+    def invalidate(self, key):
+        """Forget a cached folder or VM
+
+        :Returns: None
+
+        :param key: The cache key, like ``('vm', username, machine_name)``
+        :type key: Tuple
+        """
+        self.invalidations += 1
+        self._cache.pop(key)
+
+    def stats(self):
+        """Report how well the cache is working
+
+        :Returns: Dictionary
+        """
+        return {'hits': self._cache.hits,
+                'misses': self._cache.misses,
+                'evictions': self._cache.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._cache)}
+
+    def _find_child(self, vcenter, get_parent, parent_key, name):
+        """Run ``SearchIndex.FindChild`` against a (possibly cached) parent folder.
+        If the parent's moid is stale, it's looked up again.
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject, or None
+        """
+        search_index = vcenter.content.searchIndex
+        try:
+            return search_index.FindChild(entity=get_parent(vcenter), name=name)
+        except vmodl.fault.ManagedObjectNotFound:
+            self.invalidate(parent_key)
+            return search_index.FindChild(entity=get_parent(vcenter), name=name)
+
+    @staticmethod
+    def _find_by_path(vcenter, path):
+        """Find a VM folder by its path from the top of a datacenter
+
+        :Returns: vim.Folder, or None
+        """
+        search_index = vcenter.content.searchIndex
+        for datacenter in vcenter.content.rootFolder.childEntity:
+            found = search_index.FindByInventoryPath('{}/vm/{}'.format(datacenter.name, path.strip('/')))
+            if found is not None:
+                return found
+        return None
+
+    @staticmethod
+    def _is_current(the_vm, machine_name):
+        """Determine if a cached VM still exists, and still has the same name
+
+        :Returns: Boolean
+        """
+        try:
+            return the_vm.name == machine_name
+        except vmodl.fault.ManagedObjectNotFound:
+            return False
+
+
+def get_resolver():
+    """The Resolver shared by everything in this process
+
+    :Returns: Resolver
+    """
+    global _RESOLVER
+    with _RESOLVER_LOCK:
+        if _RESOLVER is None:
+            _RESOLVER = Resolver()
+        return _RESOLVER
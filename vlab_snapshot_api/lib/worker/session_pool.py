@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process pool of logged in vCenter sessions.
+
+Logging into vCenter (and fetching the ServiceContent) is most of the work for
+a short task like ``snapshot.show``, so each Celery worker process keeps a few
+sessions open and lends them out to the tasks it runs.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vCenter, vim
+
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import instrument
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL)
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _login():
+    """Create a new session with the vCenter server
+
+    :Returns: vlab_inf_common.vmware.vCenter
+    """
+    return vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                   password=const.INF_VCENTER_PASSWORD)
+
+
+def _is_alive(vcenter):
+    """Determine if a vCenter session is still logged in. Asking for the current
+    session also resets the idle timer of the session on the vCenter server.
+
+    :Returns: Boolean
+
+    :param vcenter: The session to check
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except Exception:
+        # Expired sessions raise vim.fault.NotAuthenticated, and dropped
+        # connections raise all sorts of socket errors; both mean "dead"
+        return False
+
+
+def _logout(vcenter):
+    """Terminate a session, ignoring errors from sessions that are already dead
+
+    :Returns: None
+
+    :param vcenter: The session to close
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        vcenter.close()
+    except Exception as doh:
+        logger.debug('Ignoring error while closing vCenter session: {}'.format(doh))
+
+
+class SessionPool(object):
+    """Lends out logged in vCenter sessions, and keeps them alive between tasks.
+
+    :param max_sessions: The most sessions this pool will open at once. Callers
+                         block in ``borrow`` until a session is returned.
+    :type max_sessions: Integer
+
+    :param keep_alive: How many seconds a session can sit idle before it's
+                       checked (and refreshed) on the vCenter server. Set to zero
+                       to disable the background keep-alive thread.
+    :type keep_alive: Integer
+
+    :param factory: Called to create a new session. Defaults to logging into the
+                    vCenter server defined in ``const``.
+    :type factory: Function
+    """
+    def __init__(self, max_sessions=const.VLAB_VCENTER_MAX_SESSIONS,
+                 keep_alive=const.VLAB_VCENTER_KEEP_ALIVE, factory=_login):
+        self.max_sessions = max_sessions
+        self.keep_alive = keep_alive
+        self.hits = 0
+        self.misses = 0
+        self.relogins = 0
+        self._factory = factory
+        self._idle = [] # (session, last_used) pairs; most recently used is last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._stop = threading.Event()
+        self._pinger = None
+
+    @contextmanager
+    def borrow(self):
+        """Obtain a session for the duration of a ``with`` block.
+
+        A session that fails with ``vim.fault.NotAuthenticated`` is thrown away
+        instead of being returned to the pool.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        self._slots.acquire()
+        vcenter = None
+        try:
+            vcenter = self._checkout()
+            yield vcenter
+        except vim.fault.NotAuthenticated:
+            _logout(vcenter)
+            vcenter = None
+            raise
+        finally:
+            if vcenter is not None:
+                self._checkin(vcenter)
+            self._slots.release()
+
+    def _checkout(self):
+        """Pop an idle session, or login if there are none.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            if self._idle:
+                vcenter, last_used = self._idle.pop()
+            else:
+                vcenter, last_used = None, None
+        if vcenter is None:
+            self.misses += 1
+            return self._new_session()
+        if self.keep_alive and time.time() - last_used > self.keep_alive:
+            if not _is_alive(vcenter):
+                logger.info('vCenter session expired, logging in again')
+                _logout(vcenter)
+                self.relogins += 1
+                self.misses += 1
+                return self._new_session()
+        self.hits += 1
+        return vcenter
+
+    def _new_session(self):
+        """Create a new session, and measure its round-trips; see ``instrument.py``
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        with instrument.phase('login'), instrument.timed('Login'):
+            vcenter = self._factory()
+        instrument.install(vcenter)
+        return vcenter
+
+    def _checkin(self, vcenter):
+        """Return a session to the pool
+
+        :Returns: None
+
+        :param vcenter: The session being returned
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            self._idle.append((vcenter, time.time()))
+
+    def ping(self):
+        """Refresh every idle session, and discard the ones that have expired.
+
+        :Returns: None
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        alive = []
+        for vcenter, last_used in idle:
+            if _is_alive(vcenter):
+                alive.append((vcenter, time.time()))
+            else:
+                _logout(vcenter)
+        with self._lock:
+            # sessions returned while we were pinging are more recently used
+            self._idle = alive + self._idle
+
+    def start_keep_alive(self):
+        """Start a daemon thread that periodically calls ``ping``
+
+        :Returns: None
+        """
+        if not self.keep_alive or self._pinger is not None:
+            return
+        self._pinger = threading.Thread(target=self._keep_alive_loop, daemon=True)
+        self._pinger.start()
+
+    def _keep_alive_loop(self):
+        """Runs in the keep-alive thread until ``close`` is called"""
+        while not self._stop.wait(self.keep_alive):
+            try:
+                self.ping()
+            except Exception as doh:
+                logger.exception(doh)
+
+    def close(self):
+        """Stop the keep-alive thread, and logout every idle session
+
+        :Returns: None
+        """
+        self._stop.set()
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for vcenter, _ in idle:
+            _logout(vcenter)
+
+    def stats(self):
+        """Counters for how well the pool is working
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            idle = len(self._idle)
+        return {'hits': self.hits, 'misses': self.misses, 'relogins': self.relogins,
+                'idle': idle, 'max_sessions': self.max_sessions}
+
+
+def init_pool(factory=_login):
+    """Create a fresh pool for this process. Celery calls this via the
+    ``worker_process_init`` signal, after the worker process has forked.
+
+    :Returns: SessionPool
+
+    :param factory: Called to create a new session. Benchmarks pass a fake vCenter here.
+    :type factory: Function
+    """
+    global _POOL
+    with _POOL_LOCK:
+        # Deliberately not closing any pool inherited from the parent process;
+        # those sockets belong to the parent, and logging out would kill its sessions.
+        _POOL = SessionPool(factory=factory)
+        _POOL.start_keep_alive()
+        return _POOL
+
+
+def get_pool():
+    """Obtain the session pool for this process, creating it if needed.
+
+    :Returns: SessionPool
+    """
+    if _POOL is None:
+        return init_pool()
+    return _POOL
+
+
+def close_pool():
+    """Logout every session in this process' pool.
+
+    :Returns: None
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            logger.info('Closing vCenter session pool: {}'.format(_POOL.stats()))
+            _POOL.close()
+            _POOL = None
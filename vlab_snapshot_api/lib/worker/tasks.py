@@ -2,17 +2,166 @@
 """
 Entry point logic for available backend worker tasks
 """
-from celery import Celery
+import inspect
+import functools
+
+from celery import Celery, states
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init, worker_process_shutdown
+from kombu import Queue
 from vlab_api_common import get_task_logger
 
 from vlab_snapshot_api.lib import const
-from vlab_snapshot_api.lib.worker import vmware
+from vlab_snapshot_api.lib.worker import vmware, session_pool, tracker, instrument
+
+
+# The custom Celery state of a task that's waiting on vCenter
+PROGRESS = 'PROGRESS'
+
+
+def _worker_queues():
+    """The names of the queues this worker consumes
+
+    :Returns: List
+    """
+    queues = [x.strip() for x in const.VLAB_WORKER_QUEUES.split(',') if x.strip()]
+    if not queues:
+        queues = [const.VLAB_QUEUE_READ, const.VLAB_QUEUE_WRITE, const.VLAB_QUEUE_PRUNE]
+    return queues
+
+
+app = Celery('snapshot', backend=const.VLAB_RESULT_BACKEND, broker=const.VLAB_MESSAGE_BROKER)
+# Reads are quick, and mutations can take minutes; separate queues keep a burst
+# of mutations from starving snapshot.show. Deleting the surplus snapshots of a
+# shift is background work, so it waits in its own queue instead of in front of
+# what users are waiting on. Exact names win over patterns.
+app.conf.task_routes = {'snapshot.show': {'queue': const.VLAB_QUEUE_READ},
+                        'snapshot.prune': {'queue': const.VLAB_QUEUE_PRUNE},
+                        'snapshot.*': {'queue': const.VLAB_QUEUE_WRITE}}
+# Which queues this worker consumes; run dedicated pools by setting
+# VLAB_WORKER_QUEUES to one queue per worker container.
+app.conf.task_queues = [Queue(name) for name in _worker_queues()]
+app.conf.worker_prefetch_multiplier = const.VLAB_WORKER_PREFETCH
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Give every (forked) worker process its own pool of vCenter sessions,
+    and a tracker for long running vCenter tasks"""
+    session_pool.init_pool()
+    tracker.init_tracker()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Logout of vCenter before the worker process exits"""
+    tracker.stop_tracker()
+    session_pool.close_pool()
+
+
+def _recorded(func):
+    """Decorator; measure the vCenter round-trips a task makes, and add a summary
+    of them to the ``params`` of its response. See ``instrument.py``.
+
+    :Returns: Function
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        txn_id = signature.bind_partial(self, *args, **kwargs).arguments.get('txn_id', '')
+        with instrument.recording(txn_id, self.request.id) as recorder:
+            resp = func(self, *args, **kwargs)
+        _add_summary(resp, recorder)
+        return resp
+    return wrapper
+
+
+def _add_summary(resp, recorder):
+    """Note the round-trips to vCenter, per phase, in the ``params`` of a response
+
+    :Returns: None
+
+    :param resp: The response of a task
+    :type resp: Dictionary
+
+    :param recorder: The round-trips the task made
+    :type recorder: vlab_snapshot_api.lib.worker.instrument.Recorder
+    """
+    summary = recorder.summary() if recorder is not None else None
+    if summary:
+        resp['params']['vcenter'] = summary
+
+
+def _finish(task, pending, resp, logger, after=None):
+    """Complete a Celery task once its vCenter task is done.
+
+    When this process has a tracker, the vCenter task is handed off to it, and
+    ``celery.exceptions.Ignore`` is raised to free up the worker; the tracker
+    stores the Celery result later, and publishes the progress of the vCenter
+    task as the custom ``PROGRESS`` state in the meantime. Otherwise, this
+    blocks until vCenter is done.
+
+    :Returns: Dictionary
+
+    :Raises: celery.exceptions.Ignore
+
+    :param task: The Celery task that started the vCenter task
+    :type task: celery.app.task.Task
+
+    :param pending: The vCenter task
+    :type pending: vlab_snapshot_api.lib.worker.vmware.Pending
+
+    :param resp: The response to store once the vCenter task is done
+    :type resp: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param after: Called with the response once the vCenter task worked, and
+                  before the response is stored.
+    :type after: Function
+    """
+    if pending.ticket is not None:
+        resp['params']['admission_wait'] = pending.ticket.waited
+    the_tracker = tracker.get_tracker()
+    if the_tracker is None:
+        resp['content'] = vmware.run_pending(pending) or {}
+        if after is not None:
+            after(resp)
+        logger.info('Task complete')
+        return resp
+    # the tracker stores the result from another thread, after this task returns
+    request = task.request
+    recorder = instrument.current()
+
+    def on_done(error):
+        vmware.release_pending(pending)
+        if error:
+            logger.error('Task failed: {}'.format(error))
+            resp['error'] = error
+        else:
+            resp['content'] = pending.content or {}
+            if after is not None:
+                after(resp)
+            logger.info('Task complete')
+        _add_summary(resp, recorder)
+        task.backend.store_result(request.id, resp, states.SUCCESS, request=request)
+
+    def on_progress(progress):
+        task.backend.store_result(request.id, progress, PROGRESS, request=request)
 
-app = Celery('snapshot', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+    the_tracker.track(pending, on_done, on_progress=on_progress)
+    logger.info('Tracking vCenter task {}'.format(pending.task._moId))
+    raise Ignore()
 
 
-@app.task(name='snapshot.show', bind=True)
-def show(self, username, txn_id):
+# Showing is safe to run twice, so only ack once done; a worker that dies
+# mid-task hands it to another. Mutations are acked on receipt, because running
+# one twice (i.e. taking two snapshots) is worse than losing it.
+@app.task(name='snapshot.show', bind=True, acks_late=True, reject_on_worker_lost=True)
+@_recorded
+def show(self, username, txn_id, fingerprint=None):
     """Obtain all the snapshots on the machines a user owns
 
     :Returns: Dictionary
@@ -22,23 +171,29 @@ def show(self, username, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param fingerprint: The lab fingerprint the client last saw. When supplied,
+                        only the VMs that changed since then are returned.
+    :type fingerprint: String
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_snapshot(username)
+        info, params = vmware.show_snapshot(username, fingerprint)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
         resp['content'] = info
+        resp['params'] = params
     return resp
 
 
 @app.task(name='snapshot.create', bind=True)
-def create(self, username, machine_name, shift, txn_id):
+@_recorded
+def create(self, username, machine_name, shift, txn_id, mode=vmware.DEFAULT_MODE):
     """Create a new snapshot on a user's virtual machine
 
     :Returns: Dictionary
@@ -55,20 +210,129 @@ def create(self, username, machine_name, shift, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param mode: How consistent the snapshot is; see ``vmware.SNAPSHOT_MODES``
+    :type mode: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        pending = vmware.start_create_snapshot(username, machine_name, shift, logger, mode)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+        logger.info('Task complete')
+        return resp
+    after = None
+    if shift and pending.full:
+        after = lambda resp: _schedule_prune(resp, username, machine_name, txn_id, logger)
+    return _finish(self, pending, resp, logger, after=after)
+
+
+def _schedule_prune(resp, username, machine_name, txn_id, logger):
+    """Queue the deletion of a VM's surplus snapshots, and note the Celery task
+    in the response, so the client can follow it.
+
+    :Returns: None
+    """
+    # so the prune never picks the snapshot that was just taken
+    created = resp['content'][machine_name][0]['created']
+    try:
+        task = prune.apply_async(args=[username, machine_name, txn_id], kwargs={'before': created},
+                                 queue=const.VLAB_QUEUE_PRUNE)
+    except Exception as doh:
+        # the snapshot was still taken; the reaper deletes the surplus once it expires
+        logger.error('Unable to queue deletion of old snapshots: {}'.format(doh))
+    else:
+        resp['params']['prune-task-id'] = task.id
+
+
+@app.task(name='snapshot.prune', bind=True, max_retries=const.VLAB_PRUNE_RETRIES,
+          default_retry_delay=const.VLAB_PRUNE_RETRY_DELAY)
+@_recorded
+def prune(self, username, machine_name, txn_id, before=None):
+    """Delete the oldest snapshots of a VM that has more than the maximum. Queued
+    by ``create`` when ``shift`` is set and the VM was full, so the client only
+    waits on the new snapshot. Failures are retried; progress is published as the ``PROGRESS`` state.
+
+    :Returns: Dictionary
+
+    :param username: The user who owns the VM
+    :type username: String
+
+    :param machine_name: The name of the virtual machine with too many snapshots
+    :type machine_name: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param before: The ``created`` timestamp of the snapshot ``create`` took;
+                   only older snapshots are deleted
+    :type before: Integer
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+
+    def progress(deleted, total):
+        self.update_state(state=PROGRESS, meta={'deleted': deleted, 'total': total})
+
     try:
-        resp['content'] = vmware.create_snapshot(username, machine_name, shift, logger)
+        deleted = vmware.prune_snapshots(username, machine_name, logger, progress=progress, before=before)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    except RuntimeError as doh:
+        if self.request.retries >= self.max_retries:
+            logger.error('Task failed: {}'.format(doh))
+            resp['error'] = '{}'.format(doh)
+        else:
+            logger.warning('Retrying after error: {}'.format(doh))
+            raise self.retry(exc=doh)
+    else:
+        resp['content'] = {machine_name: deleted}
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='snapshot.create_many', bind=True)
+@_recorded
+def create_many(self, username, machine_names, shift, txn_id, mode=vmware.DEFAULT_MODE):
+    """Create a new snapshot on many of a user's virtual machines at once
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create the snapshots
+    :type username: String
+
+    :param machine_names: The names of the virtual machines to snapshot
+    :type machine_names: List
+
+    :param shift: When a VM already has the maximum number of snapshots, automatically
+                  delete the oldest snapshot and take a new snapshot.
+    :type shift: Boolean
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param mode: How consistent the snapshot is; see ``vmware.SNAPSHOT_MODES``
+    :type mode: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'], errors, resp['params']['admission_wait'] = vmware.create_snapshots(username, machine_names,
+                                                                                         shift, logger, mode)
+    if errors:
+        logger.error('Task failed: {}'.format(errors))
+        resp['error'] = '; '.join(errors)
     logger.info('Task complete')
     return resp
 
 
 @app.task(name='snapshot.delete', bind=True)
+@_recorded
 def delete(self, username, snap_id, machine_name, txn_id):
     """Destroy a Snapshot
 
@@ -90,16 +354,107 @@ def delete(self, username, snap_id, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.delete_snapshot(username, snap_id, machine_name, logger)
+        pending = vmware.start_delete_snapshot(username, snap_id, machine_name, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+        return resp
+    return _finish(self, pending, resp, logger)
+
+
+@app.task(name='snapshot.delete_many', bind=True)
+@_recorded
+def delete_many(self, username, snapshots, txn_id):
+    """Destroy many Snapshots at once
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete the snapshots
+    :type username: String
+
+    :param snapshots: The snapshots to destroy, as dictionaries with the VM
+                      ``name`` and the snapshot ``id``
+    :type snapshots: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'], errors = vmware.delete_snapshots(username, snapshots, logger)
+    if errors:
+        logger.error('Task failed: {}'.format(errors))
+        resp['error'] = '; '.join(errors)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='snapshot.checkpoint', bind=True)
+@_recorded
+def checkpoint(self, username, shift, txn_id):
+    """Snapshot every virtual machine in a user's lab, as a single checkpoint
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to checkpoint their lab
+    :type username: String
+
+    :param shift: When a VM already has the maximum number of snapshots, automatically
+                  delete the oldest snapshot and take a new snapshot.
+    :type shift: Boolean
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'], resp['params']['admission_wait'] = vmware.checkpoint_lab(username, shift, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='snapshot.revert', bind=True)
+@_recorded
+def revert(self, username, snap_id, txn_id):
+    """Revert every virtual machine in a user's lab to a checkpoint
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to revert their lab
+    :type username: String
+
+    :param snap_id: The lab checkpoint to revert to
+    :type snap_id: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        reverted, errors, resp['params']['admission_wait'] = vmware.revert_lab(username, snap_id, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
+        resp['content'] = {'machines': reverted}
+        if errors:
+            logger.error('Task failed: {}'.format(errors))
+            resp['error'] = '; '.join(errors)
         logger.info('Task complete')
     return resp
 
 
 @app.task(name='snapshot.apply', bind=True)
+@_recorded
 def apply(self, username, snap_id, machine_name, txn_id):
     """Apply a snapshot to a virtual machine
 
@@ -121,10 +476,9 @@ def apply(self, username, snap_id, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.apply_snapshot(username, snap_id, machine_name, logger)
+        pending = vmware.start_apply_snapshot(username, snap_id, machine_name, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
-    else:
-        logger.info('Task complete')
-    return resp
+        return resp
+    return _finish(self, pending, resp, logger)
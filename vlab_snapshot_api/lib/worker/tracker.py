@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+"""
+Waits on vCenter tasks in the background, so Celery tasks don't have to.
+
+A memory snapshot of a large VM can take many minutes. Blocking on it would pin
+a worker process that has nothing to do but poll. Instead, the Celery task
+starts the vCenter task, hands it to the ``TaskTracker`` and returns. The
+tracker reads the state of every vCenter task it's waiting on with a single
+PropertyCollector call, and runs a callback (that stores the Celery result)
+once each one is done. Changes to the progress of a vCenter task are passed
+to an optional second callback as they're seen.
+"""
+import time
+import threading
+from collections import namedtuple
+
+from pyVmomi import vmodl
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vim
+
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import inventory
+from vlab_snapshot_api.lib.worker.resolver import rebind
+from vlab_snapshot_api.lib.worker.session_pool import get_pool
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_SNAPSHOT_LOG_LEVEL)
+_TRACKER = None
+_TRACKER_LOCK = threading.Lock()
+
+Tracked = namedtuple('Tracked', 'pending on_done deadline on_progress progress')
+
+
+class TaskTracker(object):
+    """Polls many in-flight vCenter tasks from one background thread.
+
+    :param interval: How many seconds to wait between polls
+    :type interval: Integer
+
+    :param timeout: How many seconds a single vCenter task can run before it's
+                    considered failed
+    :type timeout: Integer
+    """
+    def __init__(self, interval=const.VLAB_TRACKER_INTERVAL, timeout=const.VLAB_TRACKER_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.finished = 0
+        self._tracked = {} # vim.Task moid -> Tracked
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def track(self, pending, on_done, on_progress=None):
+        """Wait on a vCenter task in the background. Once the task is done
+        ``on_done`` is called with None, or an error message. Callbacks run on
+        the tracker's thread.
+
+        :Returns: None
+
+        :param pending: The vCenter task to wait on
+        :type pending: vlab_snapshot_api.lib.worker.vmware.Pending
+
+        :param on_done: Called once the work is done
+        :type on_done: Function
+
+        :param on_progress: Called with a dictionary of the vCenter task's
+                            operation, state, and percent complete whenever
+                            one of them changes.
+        :type on_progress: Function
+        """
+        with self._lock:
+            self._tracked[pending.task._moId] = Tracked(pending, on_done, time.time() + self.timeout, on_progress, None)
+
+    def poll(self, vcenter):
+        """Check on every tracked vCenter task, and finish the ones that are done.
+
+        :Returns: Integer (the number of vCenter tasks that finished)
+
+        :param vcenter: The session to use
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            tracked = list(self._tracked.items())
+        if not tracked:
+            return 0
+        spec = inventory.task_filter_spec([rebind(vcenter, x.pending.task) for _, x in tracked],
+                                          ['info.state', 'info.error', 'info.progress', 'info.descriptionId'])
+        try:
+            found = {props['obj']._moId: props for props in inventory.retrieve(vcenter, spec)}
+        except vmodl.fault.ManagedObjectNotFound as doh:
+            # vCenter forgets finished tasks after a while; drop the one it forgot,
+            # so it doesn't spoil the whole batch
+            moid = getattr(doh.obj, '_moId', None)
+            with self._lock:
+                item = self._tracked.pop(moid, None)
+            if item is None:
+                raise
+            self._finish(item, 'vCenter task {} no longer exists'.format(moid))
+            return 1
+        now = time.time()
+        done = 0
+        for moid, item in tracked:
+            props = found.get(moid, {})
+            state = props.get('info.state')
+            if state == vim.TaskInfo.State.success:
+                error = None
+            elif state == vim.TaskInfo.State.error:
+                error = getattr(props.get('info.error'), 'msg', 'vCenter task failed')
+            elif item.deadline < now:
+                error = 'Timeout of {} seconds exceeded'.format(self.timeout)
+            else:
+                self._report_progress(moid, item, props)
+                continue
+            with self._lock:
+                self._tracked.pop(moid, None)
+            self._finish(item, error)
+            done += 1
+        return done
+
+    def _report_progress(self, moid, item, props):
+        """Run the progress callback, if the vCenter task changed since the last poll
+
+        :Returns: None
+        """
+        if item.on_progress is None or not props:
+            return
+        progress = {'operation': props.get('info.descriptionId'),
+                    'state': '{}'.format(props.get('info.state')),
+                    'progress': props.get('info.progress')}
+        if progress == item.progress:
+            return
+        with self._lock:
+            if moid not in self._tracked:
+                return
+            self._tracked[moid] = item._replace(progress=progress)
+        try:
+            item.on_progress(progress)
+        except Exception as doh:
+            logger.exception(doh)
+
+    def _finish(self, item, error):
+        """Run the callback of a vCenter task that's done
+
+        :Returns: None
+        """
+        self.finished += 1
+        try:
+            item.on_done(error)
+        except Exception as doh:
+            logger.exception(doh)
+
+    def start(self):
+        """Start the daemon thread that calls ``poll``
+
+        :Returns: None
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """Runs in the tracker thread until ``stop`` is called"""
+        while not self._stop.wait(self.interval):
+            if not self._tracked:
+                continue
+            try:
+                with get_pool().borrow() as vcenter:
+                    self.poll(vcenter)
+            except Exception as doh:
+                logger.error('Unable to check on vCenter tasks: {}'.format(doh))
+
+    def stop(self):
+        """Stop the tracker thread. vCenter tasks still being tracked keep
+        running in vCenter, but their callbacks never run.
+
+        :Returns: None
+        """
+        self._stop.set()
+        if self._tracked:
+            logger.warning('Stopped tracking {} vCenter tasks before they finished'.format(len(self._tracked)))
+
+    def stats(self):
+        """Counters for what the tracker is doing
+
+        :Returns: Dictionary
+        """
+        return {'tracking': len(self._tracked), 'finished': self.finished}
+
+
+def init_tracker():
+    """Create, and start, the tracker for this process. Celery calls this via
+    the ``worker_process_init`` signal, after the worker process has forked.
+
+    :Returns: TaskTracker
+    """
+    global _TRACKER
+    with _TRACKER_LOCK:
+        _TRACKER = TaskTracker()
+        _TRACKER.start()
+        return _TRACKER
+
+
+def get_tracker():
+    """Obtain the tracker for this process. Unlike the session pool, a tracker
+    is not created on demand; without one, callers wait on vCenter themselves.
+
+    :Returns: TaskTracker, or None
+    """
+    return _TRACKER
+
+
+def stop_tracker():
+    """Stop this process' tracker
+
+    :Returns: None
+    """
+    global _TRACKER
+    with _TRACKER_LOCK:
+        if _TRACKER is not None:
+            logger.info('Stopping vCenter task tracker: {}'.format(_TRACKER.stats()))
+            _TRACKER.stop()
+            _TRACKER = None
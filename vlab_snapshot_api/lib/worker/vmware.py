@@ -2,38 +2,111 @@
 """Business logic for backend worker tasks"""
 import uuid
 import time
+import hashlib
 import random
 import os.path
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
-
-from vlab_snapshot_api.lib import const
+from collections import namedtuple, deque
 
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import Ova, vim, virtual_machine, consume_task
 
-def show_snapshot(username):
+from vlab_snapshot_api.lib import const
+from vlab_snapshot_api.lib.worker import admission, instrument, inventory, records
+from vlab_snapshot_api.lib.worker.resolver import get_resolver
+from vlab_snapshot_api.lib.worker.session_pool import get_pool
+
+
+LAB_GROUP = 'lab'
+# snapshot mode -> (dump_memory, quiesce)
+SNAPSHOT_MODES = {'memory': (True, False),
+                  'quiesced': (False, True),
+                  'crash': (False, False)}
+DEFAULT_MODE = 'memory'
+# A vCenter task that was started, but not waited on. ``content`` is what to
+# report once it's done, ``ticket`` holds the admission slots to release once
+# the task is done, and ``full`` is True when the VM already had the maximum
+# number of snapshots.
+Pending = namedtuple('Pending', 'task content ticket full')
+# ``namedtuple(defaults=...)`` is Python 3.7+
+Pending.__new__.__defaults__ = (None, False)
+
+
+def show_snapshot(username, fingerprint=None):
     """Obtain information about snapshot of virtual machines in a user's lab
 
-    :Returns: Dictionary
+    Every VM gets a short digest of its ``config.changeVersion`` and snapshot
+    names, and the lab's fingerprint is made of those digests. When the caller
+    supplies the fingerprint it last saw, only the VMs whose digest is not in
+    that fingerprint are returned.
+
+    :Returns: Tuple (snapshot_info, params)
 
     :param username: The name of the user who wants info about snapshots in their lab
     :type username: String
+
+    :param fingerprint: The fingerprint of the lab from a previous call
+    :type fingerprint: String
     """
-    info = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        snapshot_vms = {}
-        for vm in folder.childEntity:
-            snapshot_vms[vm.name] = []
-            if vm.snapshot:
-                for snap in _get_snapshots(vm.snapshot.rootSnapshotList):
-                    snap_data = snap.name.split('_')
-                    snap_id = snap_data[const.VLAB_SNAP_ID]
-                    snap_created = snap_data[const.VLAB_SNAP_CREATED]
-                    snap_exp = snap_data[const.VLAB_SNAP_EXPIRES]
-                    snapshot_vms[vm.name].append({'id': snap_id,
-                                                  'created' : int(snap_created),
-                                                  'expires' : int(snap_exp)})
-    return snapshot_vms
+    snapshot_vms = {}
+    checkpoints = {}
+    digests = {}
+    with get_pool().borrow() as vcenter:
+        # One RetrievePropertiesEx for the whole lab; the snapshot trees come
+        # back as data objects, so walking them costs no extra round-trips.
+        def read(folder):
+            spec = inventory.vm_filter_spec(folder, ['name', 'config.changeVersion', 'snapshot.rootSnapshotList'])
+            return list(inventory.retrieve(vcenter, spec))
+        for vm in get_resolver().with_user_folder(vcenter, username, read):
+            snapshot_vms[vm['name']] = []
+            snap_names = []
+            for snap in _iter_snapshots(vm.get('snapshot.rootSnapshotList', [])):
+                snap_names.append(snap.name)
+                info = {'id': snap.id, 'created' : snap.created, 'expires' : snap.expires}
+                metadata = _parse_description(snap.description)
+                if 'mode' in metadata:
+                    # snapshots from before modes existed don't record one
+                    info['mode'] = metadata['mode']
+                if metadata.get('group') == LAB_GROUP:
+                    # every VM has a copy of a lab checkpoint; report it once
+                    checkpoint = checkpoints.setdefault(snap.id, dict(info, machines=[]))
+                    checkpoint['machines'].append(vm['name'])
+                else:
+                    snapshot_vms[vm['name']].append(info)
+            digests[vm['name']] = _vm_digest(vm['name'], vm.get('config.changeVersion', ''), snap_names)
+    params = {'fingerprint': '.'.join(sorted(digests.values()))}
+    if checkpoints:
+        for checkpoint in checkpoints.values():
+            checkpoint['machines'].sort()
+        params['checkpoints'] = sorted(checkpoints.values(), key=lambda x: x['created'])
+    if fingerprint is None:
+        return snapshot_vms, params
+    elif fingerprint == params['fingerprint']:
+        params['modified'] = False
+        return {}, params
+    seen = set(fingerprint.split('.'))
+    changed = {name: snapshot_vms[name] for name, digest in digests.items() if digest not in seen}
+    params['modified'] = True
+    # lets the client drop the VMs that were deleted
+    params['machines'] = sorted(snapshot_vms.keys())
+    return changed, params
+
+
+def _vm_digest(vm_name, change_version, snap_names):
+    """Create a short digest that changes whenever the VM or its snapshots change
+
+    :Returns: String
+
+    :param vm_name: The name of the virtual machine
+    :type vm_name: String
+
+    :param change_version: The ``config.changeVersion`` of the VM
+    :type change_version: String
+
+    :param snap_names: The names of every snapshot the VM has
+    :type snap_names: List
+    """
+    data = '{}|{}|{}'.format(vm_name, change_version, ','.join(snap_names))
+    return hashlib.sha1(data.encode()).hexdigest()[:8]
 
 
 def delete_snapshot(username, snap_id, machine_name, logger):
@@ -53,29 +126,31 @@ def delete_snapshot(username, snap_id, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                if entity.snapshot:
-                    for snap in _get_snapshots(entity.snapshot.rootSnapshotList):
-                        snap_data = snap.name.split('_')
-                        if snap_data[const.VLAB_SNAP_ID] == snap_id:
-                            logger.info('Deleting snapshot {} from {}'.format(snap.name, machine_name))
-                            consume_task(snap.snapshot.RemoveSnapshot_Task(removeChildren=False))
-                            # return exits nested for-loop; break just stop immediate parent loop
-                            return None
-                    else:
-                        error = 'VM has no snapshot by ID {}'.format(snap_id)
-                        raise ValueError(error)
-        else:
+    return run_pending(start_delete_snapshot(username, snap_id, machine_name, logger))
+
+
+def start_delete_snapshot(username, snap_id, machine_name, logger):
+    """Begin destroying a snapshot, without waiting for vCenter to finish.
+    See ``delete_snapshot`` for the params.
+
+    :Returns: Pending
+    """
+    with get_pool().borrow() as vcenter:
+        the_vm = get_resolver().vm(vcenter, username, machine_name)
+        if the_vm is None:
             error = 'No VM named {} found in inventory'.format(machine_name)
             logger.info(error)
             raise ValueError(error)
+        if the_vm.snapshot:
+            snap = _find_by_id(the_vm.snapshot.rootSnapshotList, snap_id)
+            if snap is not None:
+                logger.info('Deleting snapshot {} from {}'.format(snap.name, machine_name))
+                return Pending(snap.snapshot.RemoveSnapshot_Task(removeChildren=False), None)
+        error = 'VM has no snapshot by ID {}'.format(snap_id)
+        raise ValueError(error)
 
 
-def create_snapshot(username, machine_name, shift, logger):
+def create_snapshot(username, machine_name, shift, logger, mode=DEFAULT_MODE):
     """Deploy a new instance of Snapshot
 
     :Returns: Dictionary
@@ -92,49 +167,271 @@ def create_snapshot(username, machine_name, shift, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param mode: One of SNAPSHOT_MODES. A ``memory`` snapshot includes the RAM
+                 of the VM, a ``quiesced`` one has VMware Tools flush the
+                 guest's buffers to disk first, and a ``crash`` consistent one
+                 only captures the disks (which is the fastest).
+    :type mode: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                logger.info("Creating snapshot for {}".format(machine_name))
-                try:
-                    total_snaps = len(_get_snapshots(entity.snapshot.rootSnapshotList))
-                except AttributeError:
-                    # entity.snapshot is None when there are no snapshots...
-                    total_snaps = 0
-                logger.info("Existing snap count: {}".format(total_snaps))
-                if total_snaps >= const.VLAB_MAX_SNAPSHOTS:
-                    if shift:
-                        # delete oldest, make new one
-                        snap_id, created, expires = _take_snapshot(entity)
-                        snaps_deleted = _deleted_old_snaps(entity, logger)
-                        logger.info('Deleted {} snapshots for shift functionality'.format(snaps_deleted))
-                        return {machine_name: [{'id': snap_id,
-                                                'created': created,
-                                                'expires': expires}]}
-                    else:
-                        error = 'Unable to create snapshot. VM has {}, max allowed is {}'.format(total_snaps, const.VLAB_MAX_SNAPSHOTS)
-                        logger.info(error)
-                        raise ValueError(error)
-                else:
-                    snap_id, created, expires = _take_snapshot(entity)
-                    return {machine_name: [{'id': snap_id,
-                                            'created': created,
-                                            'expires': expires}]}
-        else:
+    return run_pending(start_create_snapshot(username, machine_name, shift, logger, mode))
+
+
+def start_create_snapshot(username, machine_name, shift, logger, mode=DEFAULT_MODE):
+    """Begin taking a snapshot, without waiting for vCenter to finish.
+    See ``create_snapshot`` for the params.
+
+    :Returns: Pending
+    """
+    with get_pool().borrow() as vcenter:
+        the_vm = get_resolver().vm(vcenter, username, machine_name)
+        if the_vm is None:
             error = 'No VM named {} found in inventory'.format(machine_name)
             logger.info(error)
             raise ValueError(error)
+        logger.info("Creating snapshot for {}".format(machine_name))
+        try:
+            total_snaps = _count_snapshots(the_vm.snapshot.rootSnapshotList)
+        except AttributeError:
+            # the_vm.snapshot is None when there are no snapshots...
+            total_snaps = 0
+        logger.info("Existing snap count: {}".format(total_snaps))
+        if total_snaps >= const.VLAB_MAX_SNAPSHOTS and not shift:
+            error = 'Unable to create snapshot. VM has {}, max allowed is {}'.format(total_snaps, const.VLAB_MAX_SNAPSHOTS)
+            logger.info(error)
+            raise ValueError(error)
+        # with shift, the oldest snapshots are deleted later; see ``prune_snapshots``
+        dump_memory, quiesce, mode = _snapshot_flags(mode, the_vm.runtime.powerState)
+        ticket = _admit(admission.needs_of(the_vm.runtime.host, the_vm.datastore), logger)
+        try:
+            task, snap_id, created, expires = _start_snapshot(the_vm, dump_memory, quiesce,
+                                                              description=_make_description(mode=mode))
+        except Exception:
+            admission.get_controller().release(ticket)
+            raise
+        content = {machine_name: [{'id': snap_id,
+                                   'created': created,
+                                   'expires': expires,
+                                   'mode': mode}]}
+        return Pending(task, content, ticket, total_snaps >= const.VLAB_MAX_SNAPSHOTS)
+
+
+def _snapshot_flags(mode, power_state):
+    """Translate a snapshot mode into the args of ``CreateSnapshot``. A VM that's
+    powered off has no memory to dump, and no running VMware Tools to quiesce
+    with, so it always gets a (disk only) ``crash`` snapshot.
+
+    :Returns: Tuple (dump_memory, quiesce, mode)
+
+    :param mode: One of SNAPSHOT_MODES
+    :type mode: String
+
+    :param power_state: The ``runtime.powerState`` of the VM
+    :type power_state: vim.VirtualMachine.PowerState
+    """
+    if power_state == vim.VirtualMachine.PowerState.poweredOff:
+        mode = 'crash'
+    dump_memory, quiesce = SNAPSHOT_MODES[mode]
+    return dump_memory, quiesce, mode
 
 
-def _take_snapshot(the_vm, dump_memory=True, quiesce=False, description=''):
-    """Take a new snapshot of the virtual machine.
+def prune_snapshots(username, machine_name, logger, progress=None, before=None):
+    """Delete the oldest snapshots of a VM, until it's within const.VLAB_MAX_SNAPSHOTS.
+    This is the second half of taking a snapshot with ``shift``, and runs after
+    the new snapshot exists. It's safe to run again; only the snapshots over
+    the limit at the time are deleted.
 
-    :Returns: Tuple (snap_id, created_timestamp, expires_timesampt)
+    :Returns: List (the IDs of the deleted snapshots)
+
+    :Raises: ValueError if the VM does not exist, RuntimeError if a deletion fails
+
+    :param username: The user who owns the VM
+    :type username: String
+
+    :param machine_name: The name of the virtual machine with too many snapshots
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param progress: Called with the number of snapshots deleted so far, and
+                     the number to delete, after each deletion.
+    :type progress: Function
+
+    :param before: The ``created`` timestamp of the snapshot just taken, which
+                   is never deleted; see ``_old_snaps``
+    :type before: Integer
+    """
+    deleted = []
+    with get_pool().borrow() as vcenter:
+        the_vm = get_resolver().vm(vcenter, username, machine_name)
+        if the_vm is None:
+            error = 'No VM named {} found in inventory'.format(machine_name)
+            logger.info(error)
+            raise ValueError(error)
+        to_delete = _old_snaps(the_vm, before=before) if the_vm.snapshot else []
+        for snap in to_delete:
+            logger.info('Deleting snapshot {} for shift functionality'.format(snap.name))
+            task = snap.snapshot.RemoveSnapshot_Task(removeChildren=False)
+            with instrument.phase('wait'):
+                consume_task(task, timeout=1800)
+            deleted.append(snap.id)
+            if progress is not None:
+                progress(len(deleted), len(to_delete))
+    return deleted
+
+
+def run_pending(pending, timeout=1800):
+    """Block until a vCenter task completes.
+
+    :Returns: The ``content`` of the Pending
+
+    :Raises: RuntimeError if a vCenter task fails
+
+    :param pending: The vCenter task to wait on
+    :type pending: Pending
+
+    :param timeout: How many seconds to wait on the vCenter task
+    :type timeout: Integer
+    """
+    try:
+        with instrument.phase('wait'):
+            consume_task(pending.task, timeout=timeout)
+    finally:
+        release_pending(pending)
+    return pending.content
+
+
+def release_pending(pending):
+    """Free the admission slots of a Pending, once its vCenter tasks are done
+
+    :Returns: None
+
+    :param pending: The vCenter task that's done
+    :type pending: Pending
+    """
+    admission.get_controller().release(pending.ticket)
 
-    :param the_vm: The virtual machine with snapshots to delete
+
+def _admit(needs, logger):
+    """Wait for a free slot on the hosts and datastores of the VMs about to be
+    snapshot (or reverted). See ``admission.py``.
+
+    :Returns: admission.Ticket
+
+    :Raises: ValueError if the wait times out
+
+    :param needs: The slots needed; see ``admission.needs_of``
+    :type needs: collections.Counter
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    ticket = admission.get_controller().acquire(needs)
+    if ticket.waited:
+        logger.info('Waited {} seconds for a less busy datastore and host'.format(ticket.waited))
+    return ticket
+
+
+def _vm_needs(vm):
+    """The admission slots a VM needs; see ``admission.needs_of``
+
+    :Returns: collections.Counter
+
+    :param vm: The properties of the VM, from ``_lab_vms``
+    :type vm: Dictionary
+    """
+    return admission.needs_of(vm.get('runtime.host'), vm.get('datastore'))
+
+
+def _run_admitted(vcenter, items, start, needs, logger, timeout=1800):
+    """Start a vCenter task for every item, each once its VM is admitted, then
+    wait on them all. Every VM gets its own ticket, so a lab bigger than the
+    per datastore limit waits on its own tasks too; while waiting for a slot,
+    the tasks already started are checked, and the slots of the ones that are
+    done are freed. A fault raised while starting one (i.e. TaskInProgress, or
+    InvalidPowerState) is that item's error, and does not stop the rest.
+
+    :Returns: Tuple (errors, waited); ``errors`` has the error of every item
+              (None for the ones that worked), and ``waited`` is how many
+              seconds were spent waiting for slots.
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param items: The things to start a task for, like VM names
+    :type items: List
+
+    :param start: Called with an item; returns the vCenter task it started
+    :type start: Function
+
+    :param needs: Called with an item; returns the slots it needs
+    :type needs: Function
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param timeout: How many seconds to wait for every task to complete
+    :type timeout: Integer
+    """
+    controller = admission.get_controller()
+    errors = [None] * len(items)
+    # index of an item -> (task, ticket)
+    running = {}
+    waited = 0
+    timed_out = None
+
+    def free_done():
+        if not running:
+            return
+        done = _poll_tasks(vcenter, [x[0] for x in running.values()])
+        for index, (task, ticket) in list(running.items()):
+            if task._moId in done:
+                errors[index] = done[task._moId]
+                controller.release(ticket)
+                del running[index]
+
+    try:
+        for index, item in enumerate(items):
+            if timed_out:
+                # the others would only time out too
+                errors[index] = timed_out
+                continue
+            try:
+                ticket = controller.acquire(needs(item), waiting=free_done)
+            except ValueError as doh:
+                timed_out = errors[index] = '{}'.format(doh)
+                waited += controller.timeout
+                continue
+            waited += ticket.waited
+            try:
+                running[index] = (start(item), ticket)
+            except vmodl.MethodFault as doh:
+                controller.release(ticket)
+                errors[index] = _fault_message(doh)
+            except Exception:
+                # i.e. the session dropped; don't throttle the datastore until the lease is up
+                controller.release(ticket)
+                raise
+        indexes = list(running.keys())
+        for index, error in zip(indexes, _consume_tasks(vcenter, [running[x][0] for x in indexes], timeout=timeout)):
+            errors[index] = error
+    finally:
+        for _, ticket in running.values():
+            controller.release(ticket)
+    waited = round(waited, 2)
+    if waited:
+        logger.info('Waited {} seconds for a less busy datastore and host'.format(waited))
+    return errors, waited
+
+
+def _start_snapshot(the_vm, dump_memory=True, quiesce=False, description='', snap_info=None):
+    """Begin taking a new snapshot of the virtual machine, without waiting for
+    vCenter to finish.
+
+    :Returns: Tuple (task, snap_id, created_timestamp, expires_timesampt)
+
+    :param the_vm: The virtual machine to snapshot
     :type the_vm: vim.VirtualMachine
 
     :param dump_memory: When True, includes the running memory state of the VM in
@@ -146,33 +443,408 @@ def _take_snapshot(the_vm, dump_memory=True, quiesce=False, description=''):
                     are flushed to disk. Useless to use when ``dump_memory`` is
                     set to True. Default False
     :type quiesce: Boolean
+
+    :param description: Stored with the snapshot; see ``_make_description``
+    :type description: String
+
+    :param snap_info: The (snap_id, created, expires) to use, instead of making new ones
+    :type snap_info: Tuple
+    """
+    if snap_info is None:
+        snap_info = _new_snap_info()
+    snap_id, created, expires = snap_info
+    snap_name = records.encode_name(snap_id, created, expires)
+    task = the_vm.CreateSnapshot(snap_name, description, dump_memory, quiesce)
+    return task, snap_id, created, expires
+
+
+def _new_snap_info():
+    """Generate the ID, and timestamps of a new snapshot
+
+    :Returns: Tuple (snap_id, created_timestamp, expires_timesampt)
     """
     created = int(time.time())
     snap_id = '{}'.format(uuid.uuid4())[:6]
     expires = created + const.VLAB_SNAPSHOT_EXPIRES_AFTER
-    snap_name = '{}_{}_{}'.format(snap_id, created, expires)
-    consume_task(the_vm.CreateSnapshot(snap_name, description, dump_memory, quiesce), timeout=1800)
     return snap_id, created, expires
 
 
-def _deleted_old_snaps(the_vm, logger):
-    """Delete all snapshots such that const.VLAB_SNAP_CREATED is not exceeded.
-    Returns the number of snapshots deleted.
+def _make_description(**metadata):
+    """Encode metadata into a snapshot description, like ``group=lab``
 
-    :Returns: Integer
+    :Returns: String
+
+    :param metadata: The key/value pairs to store with the snapshot
+    :type metadata: Dictionary
+    """
+    return ' '.join('{}={}'.format(key, value) for key, value in sorted(metadata.items()))
+
+
+def _parse_description(description):
+    """Decode the metadata stored in a snapshot description. Anything that
+    isn't a ``key=value`` pair (i.e. a description set outside of vLab) is ignored.
+
+    :Returns: Dictionary
+
+    :param description: The description of a snapshot
+    :type description: String
+    """
+    metadata = {}
+    for item in (description or '').split():
+        key, sep, value = item.partition('=')
+        if sep:
+            metadata[key] = value
+    return metadata
+
+
+def _old_snaps(the_vm, before=None):
+    """Find the oldest snapshots of a VM that exceed const.VLAB_MAX_SNAPSHOTS.
+    Every snapshot counts toward the limit, but only the ones vLab took before
+    ``before`` are ever deleted; a VM full of manual snapshots can end up over
+    the limit, but never loses the snapshot that was just taken.
+
+    :Returns: List
+
+    :param the_vm: The virtual machine with too many snapshots
+    :type the_vm: vim.VirtualMachine
+
+    :param before: The ``created`` timestamp of the snapshot just taken; only
+                   snapshots strictly older than it are returned. None means
+                   every vLab snapshot can be returned.
+    :type before: Integer
+    """
+    snap_root = the_vm.snapshot.rootSnapshotList
+    older = [x for x in _iter_snapshots(snap_root) if before is None or x.created < before]
+    older.sort(key=lambda x: x.created)
+    delete_count = _count_snapshots(snap_root) - const.VLAB_MAX_SNAPSHOTS
+    return older[:max(0, delete_count)]
 
-    :param the_vm: The virtual machine with snapshots to delete
+
+def create_snapshots(username, machine_names, shift, logger, mode=DEFAULT_MODE):
+    """Snapshot many virtual machines at once. The CreateSnapshot tasks all run
+    in parallel within vCenter, so this takes about as long as the slowest VM.
+
+    :Returns: Tuple (snapshot_info, errors, admission_wait)
+
+    :param username: The name of the user who wants to create the snapshots
+    :type username: String
+
+    :param machine_names: The virtual machines to snapshot
+    :type machine_names: List
+
+    :param shift: When a VM already has the maximum number of snapshots, automatically
+                  delete the oldest snapshot and take a new snapshot.
+    :type shift: Boolean
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param mode: One of SNAPSHOT_MODES; see ``create_snapshot``
+    :type mode: String
+    """
+    snapshot_vms = {}
+    errors = []
+    with get_pool().borrow() as vcenter:
+        vms = _lab_vms(vcenter, username, ['name', 'runtime.powerState', 'runtime.host', 'datastore', 'snapshot.rootSnapshotList'])
+        targets = []
+        for machine_name in dict.fromkeys(machine_names):
+            if machine_name not in vms:
+                errors.append('No VM named {} found in inventory'.format(machine_name))
+                continue
+            total_snaps = _count_snapshots(vms[machine_name].get('snapshot.rootSnapshotList', []))
+            if total_snaps >= const.VLAB_MAX_SNAPSHOTS and not shift:
+                errors.append('Unable to create snapshot of {}. VM has {}, max allowed is {}'.format(machine_name, total_snaps, const.VLAB_MAX_SNAPSHOTS))
+                continue
+            targets.append((machine_name, total_snaps))
+        infos = {}
+
+        def start(machine_name):
+            the_vm = vms[machine_name]
+            logger.info("Creating snapshot for {}".format(machine_name))
+            dump_memory, quiesce, vm_mode = _snapshot_flags(mode, the_vm.get('runtime.powerState'))
+            task, snap_id, created, expires = _start_snapshot(the_vm['obj'], dump_memory, quiesce,
+                                                              description=_make_description(mode=vm_mode))
+            infos[machine_name] = {'id': snap_id, 'created': created, 'expires': expires, 'mode': vm_mode}
+            return task
+
+        task_errors, waited = _run_admitted(vcenter, [x[0] for x in targets], start, lambda x: _vm_needs(vms[x]), logger)
+        to_shift = []
+        for (machine_name, total_snaps), error in zip(targets, task_errors):
+            if error:
+                errors.append('Unable to create snapshot of {}: {}'.format(machine_name, error))
+                continue
+            snapshot_vms[machine_name] = [infos[machine_name]]
+            if total_snaps >= const.VLAB_MAX_SNAPSHOTS:
+                to_shift.append((machine_name, _old_snaps(vms[machine_name]['obj'], before=infos[machine_name]['created'])))
+        errors += _remove_snapshots(vcenter, to_shift, logger)[1]
+    return snapshot_vms, errors, waited
+
+
+def delete_snapshots(username, snapshots, logger):
+    """Destroy many snapshots, across many virtual machines, at once.
+
+    :Returns: Tuple (deleted, errors)
+
+    :param username: The user who wants to delete the snapshots
+    :type username: String
+
+    :param snapshots: The snapshots to delete, as dictionaries with the VM
+                      ``name``, and the snapshot ``id``
+    :type snapshots: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    errors = []
+    with get_pool().borrow() as vcenter:
+        vms = _lab_vms(vcenter, username, ['name', 'snapshot.rootSnapshotList'])
+        to_delete = {}
+        indexes = {}
+        for item in snapshots:
+            machine_name, snap_id = item['name'], item['id']
+            if machine_name not in vms:
+                errors.append('No VM named {} found in inventory'.format(machine_name))
+                continue
+            if machine_name not in indexes:
+                # many snapshots of the same VM only walk its tree once
+                indexes[machine_name] = _snapshot_index(vms[machine_name].get('snapshot.rootSnapshotList', []))
+            snap = indexes[machine_name].get(snap_id)
+            if snap is None:
+                errors.append('VM {} has no snapshot by ID {}'.format(machine_name, snap_id))
+            else:
+                to_delete.setdefault(machine_name, []).append(snap)
+        deleted, remove_errors = _remove_snapshots(vcenter, to_delete.items(), logger)
+    return deleted, errors + remove_errors
+
+
+def _remove_snapshots(vcenter, snaps_by_vm, logger):
+    """Delete snapshots from many VMs in parallel. vCenter only runs one task
+    per VM at a time, so the deletions run in rounds of one snapshot per VM.
+
+    :Returns: Tuple (deleted, errors)
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param snaps_by_vm: Pairs of the VM name, and a list of snapshots to delete
+    :type snaps_by_vm: Iterable
+    """
+    deleted = {}
+    errors = []
+    queues = [(machine_name, list(snaps)) for machine_name, snaps in snaps_by_vm if snaps]
+    while queues:
+        batch = [(machine_name, snaps.pop(0)) for machine_name, snaps in queues]
+        queues = [(machine_name, snaps) for machine_name, snaps in queues if snaps]
+        started = []
+        tasks = []
+        for machine_name, snap in batch:
+            logger.info('Deleting snapshot {} from {}'.format(snap.name, machine_name))
+            try:
+                tasks.append(snap.snapshot.RemoveSnapshot_Task(removeChildren=False))
+            except vmodl.MethodFault as doh:
+                errors.append('Unable to delete snapshot {} of {}: {}'.format(snap.name, machine_name, _fault_message(doh)))
+            else:
+                started.append((machine_name, snap))
+        for (machine_name, snap), error in zip(started, _consume_tasks(vcenter, tasks)):
+            if error:
+                errors.append('Unable to delete snapshot {} of {}: {}'.format(snap.name, machine_name, error))
+            else:
+                deleted.setdefault(machine_name, []).append(snap.id)
+    return deleted, errors
+
+
+def _lab_vms(vcenter, username, path_set):
+    """Read some properties of every VM a user owns, in one call.
+
+    :Returns: Dictionary of VM name to its properties
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The user who owns the VMs
+    :type username: String
+
+    :param path_set: The VM properties to read
+    :type path_set: List
+    """
+    def read(folder):
+        spec = inventory.vm_filter_spec(folder, path_set)
+        return {vm['name']: vm for vm in inventory.retrieve(vcenter, spec)}
+    return get_resolver().with_user_folder(vcenter, username, read)
+
+
+def _fault_message(fault):
+    """The message of a fault vCenter raised when starting a task
+
+    :Returns: String
+
+    :param fault: The fault, like vim.fault.TaskInProgress
+    :type fault: vmodl.MethodFault
+    """
+    return fault.msg or type(fault).__name__.split('.')[-1]
+
+
+def _poll_tasks(vcenter, tasks):
+    """Check on many vCenter tasks, in a single call
+
+    :Returns: Dictionary; the error message (None if it worked) of every task
+              that's done, by the moid of the task
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param tasks: The tasks to check on
+    :type tasks: List
+    """
+    done = {}
+    spec = inventory.task_filter_spec(tasks, ['info.state', 'info.error'])
+    for props in inventory.retrieve(vcenter, spec):
+        if props.get('info.state') in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+            error = props.get('info.error')
+            done[props['obj']._moId] = error.msg if error else None
+    return done
+
+
+@instrument.in_phase('wait')
+def _consume_tasks(vcenter, tasks, timeout=600):
+    """Wait for many vCenter tasks to complete. Reads the state of every task
+    in a single call, once per second.
+
+    :Returns: List of error messages (None for tasks that worked), in the same
+              order as ``tasks``
+
+    :param vcenter: The session to use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param tasks: The tasks to wait on
+    :type tasks: List
+
+    :param timeout: How many seconds to wait for every task to complete
+    :type timeout: Integer
+    """
+    errors = {}
+    waiting = {task._moId: task for task in tasks}
+    for _ in range(timeout):
+        if not waiting:
+            break
+        for moid, error in _poll_tasks(vcenter, list(waiting.values())).items():
+            errors[moid] = error
+            waiting.pop(moid, None)
+        if waiting:
+            time.sleep(1)
+    for moid in waiting:
+        errors[moid] = 'Timeout of {} seconds exceeded'.format(timeout)
+    return [errors[task._moId] for task in tasks]
+
+
+def checkpoint_lab(username, shift, logger):
+    """Snapshot every VM in a user's lab, with one shared snapshot ID and
+    timestamp. The CreateSnapshot tasks all run in parallel within vCenter. If
+    any VM fails to snapshot, the snapshots that were created are removed so a
+    checkpoint is never only partially taken.
+
+    :Returns: Tuple (checkpoint, admission_wait)
+
+    :param username: The name of the user who wants to checkpoint their lab
+    :type username: String
+
+    :param shift: When a VM already has the maximum number of snapshots, automatically
+                  delete the oldest snapshot and take a new snapshot.
+    :type shift: Boolean
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with get_pool().borrow() as vcenter:
+        vms = _lab_vms(vcenter, username, ['name', 'runtime.host', 'datastore', 'snapshot.rootSnapshotList'])
+        if not vms:
+            raise ValueError('No VMs found in lab')
+        at_max = []
+        for machine_name, the_vm in vms.items():
+            total_snaps = _count_snapshots(the_vm.get('snapshot.rootSnapshotList', []))
+            if total_snaps >= const.VLAB_MAX_SNAPSHOTS:
+                at_max.append(machine_name)
+        if at_max and not shift:
+            error = 'Unable to checkpoint lab. Max snapshots per VM is {}, and reached by: {}'.format(const.VLAB_MAX_SNAPSHOTS, ', '.join(sorted(at_max)))
+            logger.info(error)
+            raise ValueError(error)
+        snap_info = _new_snap_info()
+        description = _make_description(group=LAB_GROUP)
+        logger.info('Creating lab checkpoint {} of {} VMs'.format(snap_info[0], len(vms)))
+        names = sorted(vms.keys())
+        task_errors, waited = _run_admitted(vcenter, names,
+                                            lambda x: _start_snapshot(vms[x]['obj'], description=description, snap_info=snap_info)[0],
+                                            lambda x: _vm_needs(vms[x]), logger)
+        failed = ['{}: {}'.format(name, error) for name, error in zip(names, task_errors) if error]
+        if failed:
+            # the VMs that worked now have a snapshot the others don't; undo them
+            snap_name = records.encode_name(*snap_info)
+            created = [(name, _find_snapshot(vms[name]['obj'], snap_name)) for name, error in zip(names, task_errors) if not error]
+            _remove_snapshots(vcenter, [(name, [snap]) for name, snap in created if snap], logger)
+            error = 'Unable to checkpoint lab. {}'.format('; '.join(failed))
+            logger.info(error)
+            raise ValueError(error)
+        _remove_snapshots(vcenter, [(name, _old_snaps(vms[name]['obj'], before=snap_info[1])) for name in at_max], logger)
+    snap_id, created, expires = snap_info
+    return {'id': snap_id, 'created': created, 'expires': expires, 'machines': names}, waited
+
+
+def revert_lab(username, snap_id, logger):
+    """Revert every VM in a user's lab to a checkpoint. The RevertToSnapshot
+    tasks all run in parallel within vCenter.
+
+    :Returns: Tuple (reverted, errors, admission_wait)
+
+    :param username: The name of the user who wants to revert their lab
+    :type username: String
+
+    :param snap_id: The lab checkpoint to revert to
+    :type snap_id: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    errors = []
+    with get_pool().borrow() as vcenter:
+        vms = _lab_vms(vcenter, username, ['name', 'runtime.host', 'datastore', 'snapshot.rootSnapshotList'])
+        pending = []
+        for machine_name in sorted(vms.keys()):
+            snap = _find_by_id(vms[machine_name].get('snapshot.rootSnapshotList', []), snap_id)
+            if snap is not None:
+                pending.append((machine_name, snap))
+            else:
+                # i.e. the VM was created after the checkpoint
+                errors.append('VM {} has no snapshot by ID {}'.format(machine_name, snap_id))
+        if not pending:
+            raise ValueError('Lab has no checkpoint by ID {}'.format(snap_id))
+        logger.info('Reverting {} VMs to lab checkpoint {}'.format(len(pending), snap_id))
+        task_errors, waited = _run_admitted(vcenter, pending, lambda x: x[1].snapshot.RevertToSnapshot_Task(),
+                                            lambda x: _vm_needs(vms[x[0]]), logger)
+        reverted = []
+        for (machine_name, _), error in zip(pending, task_errors):
+            if error:
+                errors.append('Unable to revert {}: {}'.format(machine_name, error))
+            else:
+                reverted.append(machine_name)
+    return reverted, errors, waited
+
+
+def _find_snapshot(the_vm, snap_name):
+    """Lookup a snapshot of a VM by name
+
+    :Returns: records.SnapshotRecord or None
+
+    :param the_vm: The virtual machine that owns the snapshot
     :type the_vm: vim.VirtualMachine
+
+    :param snap_name: The name of the snapshot
+    :type snap_name: String
     """
-    all_snaps = _get_snapshots(the_vm.snapshot.rootSnapshotList)
-    all_snaps = sorted(all_snaps, key=lambda x: int(x.name.split('_')[const.VLAB_SNAP_CREATED]))
-    delete_count = len(all_snaps) - const.VLAB_MAX_SNAPSHOTS
-    to_delete = []
-    for _ in range(delete_count):
-        to_delete.append(all_snaps.pop(0))
-    for snap in to_delete:
-        consume_task(snap.snapshot.RemoveSnapshot_Task(removeChildren=False))
-    return delete_count
+    if the_vm.snapshot:
+        for snap in _iter_snapshots(the_vm.snapshot.rootSnapshotList):
+            if snap.name == snap_name:
+                return snap
+    return None
 
 
 def apply_snapshot(username, snap_id, machine_name, logger):
@@ -192,41 +864,106 @@ def apply_snapshot(username, snap_id, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                if entity.snapshot:
-                    for snap in _get_snapshots(entity.snapshot.rootSnapshotList):
-                        snap_data = snap.name.split('_')
-                        if snap_data[const.VLAB_SNAP_ID] == snap_id:
-                            logger.info("Applying snapshot {} to {}".format(snap.name, machine_name))
-                            consume_task(snap.snapshot.RevertToSnapshot_Task())
-                            return None
-                    else:
-                        error = 'VM has no snapshot by id {}'.format(snap_id)
-                        raise ValueError(error)
-        else:
+    return run_pending(start_apply_snapshot(username, snap_id, machine_name, logger))
+
+
+def start_apply_snapshot(username, snap_id, machine_name, logger):
+    """Begin applying a snapshot, without waiting for vCenter to finish.
+    See ``apply_snapshot`` for the params.
+
+    :Returns: Pending
+    """
+    with get_pool().borrow() as vcenter:
+        the_vm = get_resolver().vm(vcenter, username, machine_name)
+        if the_vm is None:
             error = 'No VM named {} found in inventory'.format(machine_name)
             logger.info(error)
             raise ValueError(error)
+        if the_vm.snapshot:
+            snap = _find_by_id(the_vm.snapshot.rootSnapshotList, snap_id)
+            if snap is not None:
+                ticket = _admit(admission.needs_of(the_vm.runtime.host, the_vm.datastore), logger)
+                logger.info("Applying snapshot {} to {}".format(snap.name, machine_name))
+                try:
+                    return Pending(snap.snapshot.RevertToSnapshot_Task(), None, ticket)
+                except Exception:
+                    admission.get_controller().release(ticket)
+                    raise
+        error = 'VM has no snapshot by id {}'.format(snap_id)
+        raise ValueError(error)
 
 
-def _get_snapshots(snap_root):
-    """Traverses the snapshot tree to obtain a list of all snapshots
+def _iter_snapshots(snap_root):
+    """Traverses the snapshot tree, yielding every snapshot taken by vLab.
+    Snapshots taken outside of vLab are skipped (but their children are not).
+    Stopping early, i.e. once the snapshot you want is found, skips the rest
+    of the tree.
 
-    :Returns: List
+    :Returns: Generator of records.SnapshotRecord
 
     :param snap_root: The top-level object of the snapshot tree on a Virtual Machine
-    :type snap_root: ?
+    :type snap_root: vim.vm.SnapshotTree.Array
     """
-    snapshots = []
-    branches = [snap_root]
+    for snap_object in _iter_tree(snap_root):
+        record = records.from_tree(snap_object)
+        if record is not None:
+            yield record
+
+
+def _iter_tree(snap_root):
+    """Traverses the snapshot tree, yielding every node; including snapshots
+    taken outside of vLab.
+
+    :Returns: Generator of vim.vm.SnapshotTree
+
+    :param snap_root: The top-level object of the snapshot tree on a Virtual Machine
+    :type snap_root: vim.vm.SnapshotTree.Array
+    """
+    branches = deque([snap_root])
     while branches:
-        current = branches.pop(0)
-        for snap_object in current:
-            snapshots.append(snap_object)
-            for child in snap_object.childSnapshotList:
-                branches.append([child])
-    return snapshots
+        for snap_object in branches.popleft():
+            yield snap_object
+            if snap_object.childSnapshotList:
+                branches.append(snap_object.childSnapshotList)
+
+
+def _count_snapshots(snap_root):
+    """Count every snapshot of a VM, without building a list of them. Snapshots
+    taken outside of vLab count toward const.VLAB_MAX_SNAPSHOTS too; they use
+    the datastore just the same.
+
+    :Returns: Integer
+
+    :param snap_root: The top-level object of the snapshot tree on a Virtual Machine
+    :type snap_root: vim.vm.SnapshotTree.Array
+    """
+    return sum(1 for _ in _iter_tree(snap_root))
+
+
+def _find_by_id(snap_root, snap_id):
+    """Lookup one snapshot of a VM, stopping as soon as it's found
+
+    :Returns: records.SnapshotRecord, or None
+
+    :param snap_root: The top-level object of the snapshot tree on a Virtual Machine
+    :type snap_root: vim.vm.SnapshotTree.Array
+
+    :param snap_id: The snapshot to find
+    :type snap_id: String
+    """
+    for snap in _iter_snapshots(snap_root):
+        if snap.id == snap_id:
+            return snap
+    return None
+
+
+def _snapshot_index(snap_root):
+    """Map the ID of every snapshot of a VM to its record, for looking up many
+    snapshots of the same VM.
+
+    :Returns: Dictionary
+
+    :param snap_root: The top-level object of the snapshot tree on a Virtual Machine
+    :type snap_root: vim.vm.SnapshotTree.Array
+    """
+    return {snap.id: snap for snap in _iter_snapshots(snap_root)}
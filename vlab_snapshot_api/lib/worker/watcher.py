@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+Tracks changes to VMs via PropertyCollector updates.
+
+Instead of periodically reading the whole inventory, a PropertyFilter is
+created once, and ``WaitForUpdatesEx`` returns only what changed since the last
+call. The cost of keeping the view current is proportional to the number of
+changes, not the size of the inventory.
+"""
+from vlab_snapshot_api.lib.worker import inventory
+
+
+class InventoryWatcher(object):
+    """Maintains an in-memory view of some properties of every VM under a folder.
+
+    :param vcenter: The vCenter server that hosts the Virtual Machines
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param path_set: The VM properties to track, like ``['name', 'snapshot.rootSnapshotList']``
+    :type path_set: List
+
+    :param batch_size: The max number of changed VMs returned per SOAP call
+    :type batch_size: Integer
+    """
+    def __init__(self, vcenter, path_set, batch_size=None):
+        self.vms = {}
+        self._vcenter = vcenter
+        self._path_set = path_set
+        self._batch_size = batch_size
+        self._collector = None
+        self._version = ''
+
+    def start(self, root):
+        """Begin watching every VM under the folder, including sub-folders.
+        The first call to ``updates`` returns every VM that exists.
+
+        :Returns: None
+
+        :param root: The folder that contains the VMs
+        :type root: vim.Folder
+        """
+        # A dedicated collector, so our filter and version never get mixed up
+        # with anything else using the session's default PropertyCollector.
+        self._collector = self._vcenter.content.propertyCollector.CreatePropertyCollector()
+        spec = inventory.vm_filter_spec(root, self._path_set, recursive=True)
+        self._collector.CreateFilter(spec, partialUpdates=False)
+        self._version = ''
+
+    def stop(self):
+        """Destroy the PropertyCollector, and the filter with it
+
+        :Returns: None
+        """
+        if self._collector is not None:
+            self._collector.DestroyPropertyCollector()
+            self._collector = None
+
+    def updates(self, timeout):
+        """Generator that waits up to ``timeout`` seconds for VMs to change, and
+        yields the (updated) properties of every VM that was created or changed.
+        VMs that are deleted are dropped from ``vms``, and yielded with only the
+        ``obj`` key; so to callers they look like a VM without any snapshots.
+
+        :Returns: Generator
+
+        :param timeout: How many seconds to wait for a change
+        :type timeout: Integer
+        """
+        options = inventory.PC.WaitOptions(maxWaitSeconds=int(timeout),
+                                           maxObjectUpdates=self._batch_size)
+        while True:
+            update_set = self._collector.WaitForUpdatesEx(version=self._version, options=options)
+            if update_set is None:
+                # timed out without any changes
+                return
+            self._version = update_set.version
+            for filter_update in update_set.filterSet:
+                for obj_update in filter_update.objectSet:
+                    yield self._apply(obj_update)
+            if not update_set.truncated:
+                return
+            # more changes are queued on the server; fetch them without waiting
+            options = inventory.PC.WaitOptions(maxWaitSeconds=0,
+                                               maxObjectUpdates=self._batch_size)
+
+    def _apply(self, obj_update):
+        """Update the view with the changes to a single VM
+
+        :Returns: Dictionary
+
+        :param obj_update: The changes to the VM
+        :type obj_update: vmodl.query.PropertyCollector.ObjectUpdate
+        """
+        moid = obj_update.obj._moId
+        if obj_update.kind == 'leave':
+            self.vms.pop(moid, None)
+            return {'obj': obj_update.obj}
+        vm = self.vms.setdefault(moid, {'obj': obj_update.obj})
+        for change in obj_update.changeSet:
+            if change.op in ('remove', 'indirectRemove') or change.val is None:
+                vm.pop(change.name, None)
+            else:
+                vm[change.name] = change.val
+        return vm